@@ -1,123 +1,447 @@
-from owl_wms.models import get_model_cls
-from owl_wms.utils.owl_vae_bridge import get_decoder_only
-from owl_wms.configs import Config
-from owl_wms.data import get_loader
+import time
 
-def zlerp(x, alpha):
-    return x * (1. - alpha) + alpha * torch.randn_like(x)
+import torch
+
+from owl_wms.sampling.schedules import get_timesteps
+from owl_wms.sampling.window import RollingWindow
+from owl_wms.utils.decode_worker import DecodeWorker, pipelined
+from owl_wms.utils.audio_stream import decode_last_frame, find_left_context
+from owl_wms.utils.profiling import StageTimer
 
 class AVPipeline:
-    def __init__(cfg_path="configs/av.yml", ckpt_path="av_dfot_35k_ema_200m.pt"):
+    """
+    Real-time audio/video generation for one player, one frame per step().
+
+    Latent, audio, mouse and button history live in fixed size ring buffers (RollingWindow),
+    and the CFG batch ([cond, uncond] for every input) is allocated once and refilled in place,
+    so the only allocations in a step are the model's own.
+
+    :param model: GameRFTAudioCore (or anything with its forward)
+    :param frame_decode_fn: Optional [b,n,c,h,w] latent -> frames decoder (see make_batched_decode_fn)
+    :param audio_decode_fn: Optional [b,n,c] latent -> [b,n_samples,2] decoder (see make_batched_audio_decode_fn)
+    :param frame_scale: Latents are multiplied by it before decoding
+    :param audio_scale: Audio latents are multiplied by it before decoding
+    :param window_length: Frames the model sees, defaults to the model's n_frames
+    :param sampling_steps: Diffusion steps per frame
+    :param cfg_scale: CFG scale
+    :param noise_prev: Noise level of the context frames
+    :param schedule: Noise level schedule for each frame (see owl_wms/sampling/schedules.py)
+    :param audio_f: Audio samples per frame
+    :param audio_context: Audio latents before the new one the audio decoder gets, None decodes the
+        whole window every frame. See calibrate_audio_context().
+    :param timer: StageTimer recording every stage of step() (see owl_wms/utils/profiling.py), off if None
+
+    Quality can be lowered at runtime with set_quality() (i.e. by a QualityController):
+    fewer sampling steps, no CFG on the last cfg_skip steps, a shorter context and decoding
+    video only every decode_interval frames.
+    """
+    def __init__(self, model, frame_decode_fn = None, audio_decode_fn = None, frame_scale = 1, audio_scale = 1, window_length = None, sampling_steps = 10, cfg_scale = 1.3, noise_prev = 0.2, schedule = "linear", schedule_kwargs = None, audio_f = 735, audio_context = None, timer = None):
+        self.model = model
+        self.frame_decode_fn = frame_decode_fn
+        self.audio_decode_fn = audio_decode_fn
+        self.frame_scale = frame_scale
+        self.audio_scale = audio_scale
+
+        self.window_length = window_length or model.config.n_frames
+        self.alpha = noise_prev
+        self.cfg_scale = cfg_scale
+        self.sampling_steps = sampling_steps
+        self.schedule = schedule
+        self.schedule_kwargs = schedule_kwargs or {}
+        self.timesteps = get_timesteps(self.schedule, self.sampling_steps, **self.schedule_kwargs)
+        self.cfg_skip = 0
+        self.context_length = self.window_length
+        self.decode_interval = 1
+        self.audio_f = audio_f
+        self.audio_context = audio_context
+        self.timer = timer or StageTimer(enabled = False)
+
+        self.loader = None
+        self.latencies = []
+
+    @classmethod
+    def from_config(cls, cfg_path = "configs/av.yml", ckpt_path = "av_dfot_35k_ema_200m.pt", device = 'cuda', compile = True, **kwargs):
+        """
+        Loads the model, both decoders and a data loader to draw starting histories from
+        """
+        from owl_wms.models import get_model_cls
+        from owl_wms.utils import versatile_load
+        from owl_wms.utils.owl_vae_bridge import get_decoder_only, make_batched_decode_fn, make_batched_audio_decode_fn
+        from owl_wms.configs import Config
+        from owl_wms.data import get_loader
+
         cfg = Config.from_yaml(cfg_path)
         model_cfg = cfg.model
         train_cfg = cfg.train
-        
+
         model = get_model_cls(model_cfg.model_id)(model_cfg).core
-        model.load_state_dict(ckpt_path)
+        model.load_state_dict(versatile_load(ckpt_path))
+        model = model.to(device).bfloat16().eval()
 
         frame_decoder = get_decoder_only(
             None,
             train_cfg.vae_cfg_path,
             train_cfg.vae_ckpt_path
         )
-
         audio_decoder = get_decoder_only(
             None,
             train_cfg.audio_vae_cfg_path,
             train_cfg.audio_vae_ckpt_path
         )
 
-        frame_scale = train_cfg.vae_scale
-        audio_scale = train_cfg.audio_vae_scale
-
-        self.history_buffer = None
-        self.audio_buffer = None
-        self.mouse_buffer = None
-        self.button_buffer = None
+        if compile:
+            model = torch.compile(model)
+            frame_decoder = torch.compile(frame_decoder)
+            audio_decoder = torch.compile(audio_decoder)
+
+        pipeline = cls(
+            model,
+            make_batched_decode_fn(frame_decoder),
+            make_batched_audio_decode_fn(audio_decoder),
+            train_cfg.vae_scale,
+            train_cfg.audio_vae_scale,
+            window_length = kwargs.pop("window_length", model_cfg.n_frames),
+            **kwargs
+        )
 
         loader = get_loader(
             "cod_s3_audio",
             1,
-            window_length=30,
-            bucket_name='cod-data-latent-360x640to4x4'
+            window_length = pipeline.window_length,
+            bucket_name = 'cod-data-latent-360x640to4x4'
         )
-        self.loader = iter(loader)
-
-        self.alpha = 0.2
-        self.cfg = 1.3
-        self.sampling_steps = 10
-
-        torch.compile(self.model)
-        torch.compile(self.frame_decoder)
-        torch.compile(self.audio_decoder)
-
-        self.audio_f = 735
-
-    def init_buffers(self):
-        self.history_buffer,self.audio_buffer,self.mouse_buffer,self.button_buffer=next(self.loader)
-        # [1,n,c,h,w], [1,n,c], [1,n,2], [1,n,11]
-
-        self.history_buffer = self.history_buffer / self.frame_scale
-        self.audio_buffer = self.audio_buffer / self.audio_scale
+        pipeline.loader = iter(loader)
+        return pipeline
+
+    def init_buffers(self, history = None, audio = None, mouse = None, btn = None):
+        """
+        Sets the starting history and allocates every buffer. Without arguments it's drawn from the loader.
+
+        :param history: [1,n,c,h,w] latents (already divided by the vae scale if given), n >= window_length
+        :param audio: [1,n,c]
+        :param mouse: [1,n,2]
+        :param btn: [1,n,n_buttons]
+        """
+        if history is None:
+            history, audio, mouse, btn = next(self.loader)
+            param = next(self.model.parameters())
+            history, audio, mouse, btn = (t.to(param.device, param.dtype) for t in (history, audio, mouse, btn))
+            history = history / self.frame_scale
+            audio = audio / self.audio_scale
+
+        W = self.window_length
+        assert history.shape[1] >= W, f"Need {W} frames of history, got {history.shape[1]}"
+
+        self.history_buffer = RollingWindow(history, W)
+        self.audio_buffer = RollingWindow(audio, W)
+        self.mouse_buffer = RollingWindow(mouse, W)
+        self.button_buffer = RollingWindow(btn, W)
+
+        # CFG batch, uncond controls stay zero
+        self.x_batch = history.new_empty(2, W, *history.shape[2:])
+        self.a_batch = audio.new_empty(2, W, *audio.shape[2:])
+        self.ts_batch = history.new_full((2, W), self.alpha)
+        self.mouse_batch = mouse.new_zeros(2, W, *mouse.shape[2:])
+        self.btn_batch = btn.new_zeros(2, W, *btn.shape[2:])
+        self.new_mouse = mouse.new_empty(1, 1, *mouse.shape[2:])
+        self.new_btn = btn.new_empty(1, 1, *btn.shape[2:])
+
+        self.latencies = []
+        self.n_frames = 0
+        self.last_frame = None
+
+    def set_quality(self, sampling_steps = None, cfg_skip = None, context_length = None, decode_interval = None):
+        """
+        Change quality knobs between frames, arguments left as None are kept.
+
+        :param sampling_steps: Diffusion steps per frame
+        :param cfg_skip: Run the last cfg_skip steps on the conditional branch only
+        :param context_length: Frames the model sees (context plus the new frame), at most window_length
+        :param decode_interval: Decode video every decode_interval frames and repeat the last one in between
+        """
+        if sampling_steps is not None:
+            self.sampling_steps = sampling_steps
+            self.timesteps = get_timesteps(self.schedule, self.sampling_steps, **self.schedule_kwargs)
+        if cfg_skip is not None:
+            self.cfg_skip = cfg_skip
+        if context_length is not None:
+            assert 1 <= context_length <= self.window_length, f"context_length must be in [1, {self.window_length}]"
+            self.context_length = context_length
+        if decode_interval is not None:
+            self.decode_interval = max(decode_interval, 1)
+
+    def quality(self):
+        return {
+            "sampling_steps" : self.sampling_steps,
+            "cfg_skip" : self.cfg_skip,
+            "context_length" : self.context_length,
+            "decode_interval" : self.decode_interval
+        }
+
+    def _noise_context(self, batch, window, n):
+        # batch[0,-n:] = noised last n-1 frames of the window followed by a noise frame
+        if n > 1:
+            ctx = batch[:1,-n:-1]
+            ctx.normal_().mul_(self.alpha).add_(window.view()[:,-(n-1):], alpha = 1. - self.alpha)
+        batch[:1,-1:].normal_()
 
     @torch.no_grad()
-    def __call__(self, new_mouse, new_btn):
-        # [2,] float and [11,] bool
-        noised_history = zlerp(self.history_buffer[:,1:], self.alpha)
-        noised_audio = zlerp(self.audio_buffer[:,1:], self.alpha)
-
-        noised_history = torch.cat([noised_history, torch.randn_like(noised_history[:,0:1])], dim = 1)
-        noised_audio = torch.cat([noised_audio, torch.randn_like(noised_audio[:,0:1])], dim = 1)
-
-        new_mouse = new_mouse[None,None,:]
-        new_btn = new_btn[None,None,:]
-
-        self.mouse_buffer = torch.cat([self.mouse_buffer[:,1:],new_mouse],dim=1)
-        self.button_buffer = torch.cat([self.button_buffer[:,1:],new_btn],dim=1)
-
-        dt = 1. / self.sampling_steps
-
-        x = noised_history
-        a = noised_audio
-        ts = torch.ones_like(noised_history[:,:,0,0,0])
-        ts[:,:-1] = self.alpha
-
-        mouse_batch = torch.cat([self.mouse_buffer, torch.zeros_like(mouse)], dim=0) 
-        btn_batch = torch.cat([self.button_buffer, torch.zeros_like(btn)], dim=0)
-        for _ in range(self.sampling_steps):
-            x_batch = torch.cat([x, x], dim=0)
-            a_batch = torch.cat([a, a], dim=0)
-            ts_batch = torch.cat([ts, ts], dim=0)
-
-            pred_vid_batch, pred_audio_batch = model(x_batch,a_batch,ts_batch,mouse_batch,btn_batch)
-
-            cond_pred_video, uncond_pred_video = pred_video_batch.chunk(2)
-            cond_pred_audio, uncond_pred_audio = pred_audio_batch.chunk(2)
-
-            pred_video = uncond_pred_video + self.cfg_scale * (cond_pred_video - uncond_pred_video)
-            pred_audio = uncond_pred_audio + self.cfg_scale * (cond_pred_audio - uncond_pred_audio)
-
-            x[:,-1] = x[:,-1] - dt * pred_video[:,-1]
-            a[:,-1] = a[:,-1] - dt * pred_audio[:,-1]
-            ts[:,-1] = ts[:,-1] - dt
-        
-        new_frame = x[:,-1:] # [1,1,c,h,w]
-        new_audio = audio[:,-1:] # [1,1,c]
-
-        self.history_buffer = torch.cat([self.history_buffer[:,1:], new_frame], dim=1)
-        self.audio_buffer = torch.cat([self.audio_buffer[:,1:], new_audio], dim=1)
-
-        x_to_dec = new_frame[0] * self.image_scale
-        a_to_dec = self.audio_buffer * self.audio_scale
-
-        frame = self.frame_decoder(x_to_dec).squeeze() # [c,h,w]
-        audio = self.audio_decoder(a_to_dec).squeeze()[-self.audio_f:] # [735,2]
-
+    def step(self, new_mouse, new_btn, decode = True, sync = True):
+        """
+        Generates the next frame for the given controls.
+
+        :param new_mouse: [2] float
+        :param new_btn: [n_buttons] bool
+        :param decode: Decode the frame and audio (needs the decode functions)
+        :param sync: Wait for the current CUDA stream before returning, so latencies include the GPU work.
+            stream() turns it off to keep queueing the next frame while earlier ones decode.
+        :return: (frame, audio), decoded [c,h,w] and [audio_f,2] if decode else latents [1,1,c,h,w] and [1,1,c]
+        """
+        start = time.perf_counter()
+        timer = self.timer
+
+        with timer.frame():
+            with timer.stage("control_ingest"):
+                self.new_mouse.view(-1).copy_(new_mouse.view(-1))
+                self.new_btn.view(-1).copy_(new_btn.view(-1))
+                self.mouse_buffer.append(self.new_mouse)
+                self.button_buffer.append(self.new_btn)
+                self.mouse_batch[:1].copy_(self.mouse_buffer.view())
+                self.btn_batch[:1].copy_(self.button_buffer.view())
+
+            n = self.context_length
+            with timer.stage("noise_context"):
+                self._noise_context(self.x_batch, self.history_buffer, n)
+                self._noise_context(self.a_batch, self.audio_buffer, n)
+                self.x_batch[1:,-n:].copy_(self.x_batch[:1,-n:])
+                self.a_batch[1:,-n:].copy_(self.a_batch[:1,-n:])
+
+            # Views of the last n frames, the model takes any number of frames up to window_length
+            inputs = [buf[:,-n:] for buf in (self.x_batch, self.a_batch, self.ts_batch, self.mouse_batch, self.btn_batch)]
+            n_guided = len(self.timesteps) - 1 - self.cfg_skip
+            for i, (t, t_next) in enumerate(zip(self.timesteps[:-1], self.timesteps[1:])):
+                guided = i < n_guided
+                with timer.stage("diffusion_step"):
+                    self.ts_batch[:,-1] = t
+                    pred_video, pred_audio = self.model(*(inputs if guided else [x[:1] for x in inputs]))
+
+                with timer.stage("cfg_combine"):
+                    # Only the last frame moves, both halves of the batch get the same update
+                    for x, pred in [(self.x_batch, pred_video), (self.a_batch, pred_audio)]:
+                        if guided:
+                            cond_pred, uncond_pred = pred[:,-1:].chunk(2)
+                            pred = torch.lerp(uncond_pred, cond_pred, self.cfg_scale)
+                        else:
+                            pred = pred[:,-1:]
+                        x[:,-1:].add_(pred, alpha = t_next - t)
+            self.ts_batch[:,-1] = self.alpha
+
+            new_frame = self.x_batch[:1,-1:] # [1,1,c,h,w]
+            new_audio = self.a_batch[:1,-1:] # [1,1,c]
+            self.history_buffer.append(new_frame)
+            self.audio_buffer.append(new_audio)
+
+            if decode:
+                skip_video = self.last_frame is not None and self.n_frames % self.decode_interval != 0
+                frame, audio = self.decode(None if skip_video else new_frame, self.audio_window())
+                if skip_video:
+                    frame = self.last_frame
+                self.last_frame = frame
+            else:
+                frame, audio = new_frame.clone(), new_audio.clone()
+            self.n_frames += 1
+
+            if sync and frame.is_cuda:
+                # Current stream only, a DecodeWorker's stream keeps running
+                torch.cuda.current_stream().synchronize()
+        self.latencies.append(time.perf_counter() - start)
         return frame, audio
 
+    __call__ = step
+
+    def decode(self, new_frame, audio_window):
+        """
+        :param new_frame: [1,1,c,h,w] latent, None skips the video decode
+        :param audio_window: [1,n,c] audio latents ending with the new frame's
+        :return: [c,h,w] frame (None if skipped) and [audio_f,2] audio
+        """
+        frame = None
+        if new_frame is not None:
+            with self.timer.stage("decode_video"):
+                frame = self.frame_decode_fn(new_frame * self.frame_scale)[0,0] # [c,h,w]
+        with self.timer.stage("decode_audio"):
+            audio = decode_last_frame(self.audio_decode_fn, audio_window * self.audio_scale, self.audio_context, self.audio_f)[0] # [735,2]
+        return frame, audio
 
+    def audio_window(self):
+        # Audio latents the decoder needs for the newest frame
+        window = self.audio_buffer.view()
+        if self.audio_context is not None:
+            window = window[:,-(self.audio_context + 1):]
+        return window
 
-            
-
-
-
+    @torch.no_grad()
+    def calibrate_audio_context(self, tolerance = 1.0e-3):
+        """
+        Sets audio_context to the smallest left context that decodes the newest frame's audio
+        like the whole window does (within tolerance), measured on the current history
+        """
+        window = self.audio_buffer.view() * self.audio_scale
+        self.audio_context, err = find_left_context(self.audio_decode_fn, window, self.audio_f, tolerance)
+        return self.audio_context, err
+
+    def stream(self, controls, max_lag = 1, worker = None):
+        """
+        Generates a frame for every (mouse, btn) in controls and decodes it on a DecodeWorker,
+        so decoding frame t overlaps the diffusion of frame t+1. Yields decoded (frame, audio)
+        in order, max_lag frames behind the diffusion.
+
+        :param worker: DecodeWorker wrapping self.decode to use (i.e. to read its stats()), made here if None
+
+        Video is only decoded every decode_interval frames like in step(), the last frame is repeated in between.
+        """
+        have_frame = self.last_frame is not None
+        def latents():
+            nonlocal have_frame
+            for new_mouse, new_btn in controls:
+                new_frame, _ = self.step(new_mouse, new_btn, decode = False, sync = False)
+                skip_video = have_frame and (self.n_frames - 1) % self.decode_interval != 0
+                have_frame = True
+                # The ring buffer keeps changing, the worker gets its own copy of the window
+                yield None if skip_video else new_frame, self.audio_window().clone()
+
+        for frame, audio in pipelined(latents(), self.decode, max_lag = max_lag, worker = worker):
+            if frame is None:
+                frame = self.last_frame
+            self.last_frame = frame
+            yield frame, audio
+
+    def warmup(self, n_frames = 3, decode = True):
+        """
+        Runs a few frames (compiling, autotuning, filling the allocator) and puts the history back
+        """
+        rings = [self.history_buffer, self.audio_buffer, self.mouse_buffer, self.button_buffer]
+        saved = [(ring.buffer.clone(), ring.start, ring.end) for ring in rings]
+
+        mouse = self.mouse_batch.new_zeros(self.mouse_batch.shape[-1])
+        btn = self.btn_batch.new_zeros(self.btn_batch.shape[-1])
+        for _ in range(n_frames):
+            self.step(mouse, btn, decode = decode)
+
+        for ring, (buffer, start, end) in zip(rings, saved):
+            ring.buffer.copy_(buffer)
+            ring.start, ring.end = start, end
+        self.latencies = []
+        self.timer.reset()
+        self.n_frames = 0
+        self.last_frame = None
+
+    def latency_stats(self):
+        """
+        Per frame latency in ms since init_buffers (or warmup)
+        """
+        if not self.latencies:
+            return {}
+        lat = sorted(self.latencies)
+        pick = lambda q: 1000 * lat[min(int(q * len(lat)), len(lat) - 1)]
+        return {
+            "frames" : len(lat),
+            "mean_ms" : 1000 * sum(lat) / len(lat),
+            "p50_ms" : pick(0.5),
+            "p99_ms" : pick(0.99),
+            "max_ms" : 1000 * lat[-1]
+        }
+
+@torch.no_grad()
+def test_av_pipeline(n_frames = 40):
+    """
+    Steps a tiny randomly initialized GameRFTAudioCore on CPU against a reference that
+    rebuilds the history with torch.cat every frame, and reports the latency
+    """
+    from owl_wms.configs import TransformerConfig
+    from owl_wms.models.gamerft_audio import GameRFTAudioCore
+
+    config = TransformerConfig(
+        n_layers = 2, n_heads = 4, d_model = 64,
+        channels = 16, audio_channels = 8, sample_size = 2, tokens_per_frame = 5,
+        n_buttons = 11, n_frames = 8
+    )
+    torch.manual_seed(0)
+    model = GameRFTAudioCore(config).eval()
+
+    W = config.n_frames
+    history = torch.randn(1, W, 16, 2, 2)
+    audio = torch.randn(1, W, 8)
+    mouse = torch.randn(1, W, 2)
+    btn = (torch.rand(1, W, 11) > 0.5).float()
+    controls = torch.randn(n_frames, 2), (torch.rand(n_frames, 11) > 0.5).float()
+
+    pipeline = AVPipeline(model, window_length = W, sampling_steps = 4, timer = StageTimer(deadline_ms = 1000 / 60))
+    pipeline.init_buffers(history, audio, mouse, btn)
+    pipeline.warmup(decode = False)
+
+    torch.manual_seed(1)
+    frames = [pipeline.step(controls[0][i], controls[1][i], decode = False)[0] for i in range(n_frames)]
+
+    # Reference: cat based history, same noise draws
+    torch.manual_seed(1)
+    h, a, m, b = history, audio, mouse, btn
+    timesteps = get_timesteps("linear", 4)
+    for i in range(n_frames):
+        m = torch.cat([m[:,1:], controls[0][i][None,None]], dim = 1)
+        b = torch.cat([b[:,1:], controls[1][i][None,None]], dim = 1)
+        x = torch.cat([h[:,1:] + (torch.randn_like(h[:,1:]) * 0.2 - h[:,1:] * 0.2), torch.randn_like(h[:,:1])], dim = 1)
+        xa = torch.cat([a[:,1:] + (torch.randn_like(a[:,1:]) * 0.2 - a[:,1:] * 0.2), torch.randn_like(a[:,:1])], dim = 1)
+        ts = torch.full((1, W), 0.2)
+        for t, t_next in zip(timesteps[:-1], timesteps[1:]):
+            ts[:,-1] = t
+            v, va = model(torch.cat([x, x]), torch.cat([xa, xa]), torch.cat([ts, ts]), torch.cat([m, 0 * m]), torch.cat([b, 0 * b]))
+            for y, pred in [(x, v), (xa, va)]:
+                cond, uncond = pred[:,-1:].chunk(2)
+                y[:,-1:] += (t_next - t) * (uncond + 1.3 * (cond - uncond))
+        h = torch.cat([h[:,1:], x[:,-1:]], dim = 1)
+        a = torch.cat([a[:,1:], xa[:,-1:]], dim = 1)
+
+        err = (frames[i] - x[:,-1:]).abs().max().item()
+        assert err < 1.0e-4, f"Frame {i} differs from the reference by {err}"
+
+    print(pipeline.latency_stats())
+    print(pipeline.timer.format())
+    assert pipeline.timer.summary()["stages"]["diffusion_step"]["count"] == 4 * n_frames
+    print("AVPipeline OK")
+
+    # Pipelined decoding gives the same frames as decoding in step()
+    pipeline.frame_decode_fn = lambda x: torch.tanh(x).repeat_interleave(4, dim = -1).repeat_interleave(4, dim = -2)
+    pipeline.audio_decode_fn = lambda a: torch.tanh(a[...,:2]).repeat_interleave(4, dim = 1)
+    pipeline.audio_f = 4
+
+    pipeline.init_buffers(history, audio, mouse, btn)
+    torch.manual_seed(2)
+    start = time.perf_counter()
+    serial = [pipeline.step(controls[0][i], controls[1][i]) for i in range(n_frames)]
+    serial_ms = (time.perf_counter() - start) / n_frames * 1000
+
+    pipeline.init_buffers(history, audio, mouse, btn)
+    torch.manual_seed(2)
+    worker = DecodeWorker(pipeline.decode)
+    streamed = list(pipeline.stream(zip(*controls), worker = worker))
+    worker.close()
+    for (f, a), (f_ref, a_ref) in zip(streamed, serial, strict = True):
+        assert torch.equal(f, f_ref) and torch.equal(a, a_ref), "Pipelined decode differs from serial"
+    stats = worker.stats()
+    print(f"serial {serial_ms:.1f}ms/frame, pipelined {stats['wall_ms']:.1f}ms/frame ({100 * stats['hidden']:.0f}% of decode hidden)")
+    print("AVPipeline stream OK")
+
+    # Decoding only the new audio latent and its left context matches decoding the window
+    from owl_wms.utils.audio_stream import _toy_audio_decoder
+    pipeline.audio_decode_fn = _toy_audio_decoder(channels = 8, samples_per_frame = 4)
+    pipeline.init_buffers(history, audio, mouse, btn)
+    left_context, _ = pipeline.calibrate_audio_context()
+    for i in range(n_frames):
+        _, audio_out = pipeline.step(controls[0][i], controls[1][i])
+        full = decode_last_frame(pipeline.audio_decode_fn, pipeline.audio_buffer.view(), None, 4)[0]
+        assert (audio_out - full).abs().max() <= 1.0e-3 * full.abs().max(), f"Streaming audio decode differs at frame {i}"
+    print(f"AVPipeline streaming audio decode OK (left context {left_context})")
+
+if __name__ == "__main__":
+    test_av_pipeline()
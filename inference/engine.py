@@ -0,0 +1,355 @@
+"""
+Continuous batching engine that serves many player sessions with one model.
+
+Every tick the sessions with pending input are gathered into one batched model call
+(doubled for CFG), the new frames are scattered back to their sessions, and sessions
+are admitted or evicted between ticks.
+
+CPU smoke test with a toy model: python -m inference.engine
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+
+from owl_wms.nn.kv_cache import KVCache
+from owl_wms.sampling.window import RollingWindow
+from owl_wms.sampling.solvers import get_solver
+from owl_wms.sampling.schedules import get_timesteps
+from owl_wms.sampling.guidance import CFGGuidance
+
+class Session:
+    """
+    One player: its latent history, control history, pending input and stats.
+
+    :param history: Tuple of [1,n,...] latents the model generates (i.e. (video,) or (video, audio)), n >= window_length
+    :param mouse: [1,n,2] controls of the history frames
+    :param btn: [1,n,n_buttons]
+    :param seed: Seeds the session's own noise, so its frames don't depend on the rest of the batch
+    """
+    def __init__(self, session_id, history, mouse, btn, window_length, seed = None):
+        assert all(h.shape[1] >= window_length for h in history), "Sessions need window_length frames of history"
+        assert mouse.shape[1] >= window_length and btn.shape[1] >= window_length, "Sessions need window_length frames of controls"
+
+        self.session_id = session_id
+        self.windows = [RollingWindow(h, window_length) for h in history]
+        self.mouse_window = RollingWindow(mouse, window_length)
+        self.btn_window = RollingWindow(btn, window_length)
+
+        device = history[0].device
+        self.generator = torch.Generator(device = device)
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+
+        self.pending = None # (mouse, btn, submit time)
+        self.last_frame = None
+        self.latencies = []
+        self.n_frames = 0
+
+    def randn_like(self, x):
+        return torch.randn(x.shape, generator = self.generator, device = x.device, dtype = x.dtype)
+
+class InferenceEngine:
+    """
+    :param model: Core model, called as model(*latents, ts, mouse, btn) (plus kv_cache= when cached)
+    :param window_length: Frames the model sees, context plus the new frame
+    :param n_steps: Diffusion steps for each frame
+    :param cfg_scale: CFG scale, the conditional and unconditional branches share the batched call
+    :param noise_prev: Noise level of the context frames
+    :param max_batch: Most sessions stepped in one tick, those waiting longest go first
+    :param use_kv_cache: Causal models only, prefill the context once per tick and run only the new
+        frames for every step. One cache is shared by the tick's batch, so sessions don't hold one each.
+    :param decode_fn: Optional batched decoder for the new video frames, given frames * scale
+    :param solver: ODE solver for each frame (see owl_wms/sampling/solvers.py)
+    :param schedule: Noise level schedule for each frame (see owl_wms/sampling/schedules.py)
+    """
+    def __init__(self, model, window_length = 60, n_steps = 10, cfg_scale = 1.3, noise_prev = 0.2, max_batch = 16, use_kv_cache = False, decode_fn = None, scale = 1, solver = "euler", solver_kwargs = None, schedule = "linear", schedule_kwargs = None):
+        self.model = model
+        self.window_length = window_length
+        self.noise_prev = noise_prev
+        self.max_batch = max_batch
+        self.decode_fn = decode_fn
+        self.scale = scale
+
+        self.solver = get_solver(solver, **(solver_kwargs or {}))
+        self.timesteps = get_timesteps(schedule, n_steps, **(schedule_kwargs or {}))
+        self.guidance = CFGGuidance(cfg_scale)
+
+        self.kv_cache = None
+        if use_kv_cache:
+            assert model.config.causal, "KV cached sampling needs a causal model"
+            self.kv_cache = KVCache(model.config)
+
+        self.sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._to_admit = []
+        self._to_evict = []
+
+        self.n_ticks = 0
+        self.n_frames = 0
+        self.busy_time = 0.
+        self.start_time = None
+
+    def admit(self, session_id, history, mouse, btn, seed = None):
+        """
+        Queue a new session, it joins at the next tick. See Session for the arguments,
+        history can be a single video latent or a tuple of latents.
+        """
+        if torch.is_tensor(history):
+            history = (history,)
+        session = Session(session_id, history, mouse, btn, self.window_length, seed)
+        with self._lock:
+            self._to_admit.append(session)
+        return session
+
+    def evict(self, session_id):
+        """
+        Queue a session for removal, it leaves before the next tick.
+        """
+        with self._lock:
+            self._to_evict.append(session_id)
+
+    def submit(self, session_id, mouse, btn):
+        """
+        Input for a session's next frame, mouse [2] or [1,1,2] and btn [n_buttons] or [1,1,n_buttons].
+        A newer input replaces one that hasn't been served yet, latency counts from the first.
+        """
+        mouse, btn = mouse.reshape(1, 1, -1), btn.reshape(1, 1, -1)
+        with self._lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = next((s for s in self._to_admit if s.session_id == session_id), None)
+            if session is None:
+                raise KeyError(f"Unknown session {session_id}")
+            submitted = time.perf_counter() if session.pending is None else session.pending[2]
+            session.pending = (mouse, btn, submitted)
+
+    def _apply_admissions(self):
+        with self._lock:
+            for session in self._to_admit:
+                self.sessions[session.session_id] = session
+            for session_id in self._to_evict:
+                self.sessions.pop(session_id, None)
+            self._to_admit, self._to_evict = [], []
+
+            ready = [s for s in self.sessions.values() if s.pending is not None]
+            ready = sorted(ready, key = lambda s: s.pending[2])[:self.max_batch]
+            inputs = [s.pending for s in ready]
+            for s in ready:
+                s.pending = None
+        return ready, inputs
+
+    @torch.no_grad()
+    def tick(self):
+        """
+        Generates one frame for every session with pending input (up to max_batch).
+
+        :return: {session_id: new frame}, a [1,1,...] latent (decoded if decode_fn is set),
+            or a tuple of them for multi latent models
+        """
+        ready, inputs = self._apply_admissions()
+        if not ready:
+            return {}
+
+        start = time.perf_counter()
+        if self.start_time is None:
+            self.start_time = start
+
+        # Gather: every session's noised context plus a noise frame, and its controls window
+        for session, (mouse, btn, _) in zip(ready, inputs):
+            session.mouse_window.append(mouse)
+            session.btn_window.append(btn)
+
+        latents = []
+        for i in range(len(ready[0].windows)):
+            per_session = []
+            for session in ready:
+                clean = session.windows[i].view()
+                noised = torch.empty_like(clean)
+                noised[:,:-1] = clean[:,1:] * (1. - self.noise_prev) + session.randn_like(clean[:,1:]) * self.noise_prev
+                noised[:,-1:] = session.randn_like(clean[:,-1:])
+                per_session.append(noised)
+            latents.append(torch.cat(per_session, dim = 0))
+
+        mouse = torch.cat([s.mouse_window.view() for s in ready], dim = 0)
+        btn = torch.cat([s.btn_window.view() for s in ready], dim = 0)
+        self.guidance.prepare(mouse, btn, self.timesteps)
+
+        new_frames = self.denoise(latents)
+
+        # Scatter
+        video = new_frames[0]
+        if self.decode_fn is not None:
+            video = self.decode_fn(video * self.scale)
+        if video.is_cuda:
+            torch.cuda.current_stream().synchronize()
+        done = time.perf_counter()
+
+        outputs = {}
+        for i, session in enumerate(ready):
+            for window, frame in zip(session.windows, new_frames):
+                window.append(frame[i:i+1])
+            out = tuple([video[i:i+1]] + [f[i:i+1] for f in new_frames[1:]])
+            session.last_frame = out[0] if len(out) == 1 else out
+            session.latencies.append(done - inputs[i][2])
+            session.n_frames += 1
+            outputs[session.session_id] = session.last_frame
+
+        self.n_ticks += 1
+        self.n_frames += len(ready)
+        self.busy_time += done - start
+        return outputs
+
+    def denoise(self, latents):
+        """
+        Denoises the last frame of every latent in the list, the rest is context.
+        :return: List of [b,1,...] clean frames
+        """
+        b, n = latents[0].shape[:2]
+        ts_history = torch.full((b, n), self.noise_prev, device = latents[0].device, dtype = latents[0].dtype)
+        ts_history[:,-1] = 1.
+
+        if self.kv_cache is None:
+            def fn(last, t):
+                inputs = [x.clone() for x in latents]
+                for x, x_last in zip(inputs, last):
+                    x[:,-1:] = x_last
+                ts = ts_history.clone()
+                ts[:,-1] = t
+                preds = self.guidance(self.model, tuple(inputs), ts, t)
+                preds = preds if isinstance(preds, tuple) else (preds,)
+                return tuple(p[:,-1:] for p in preds)
+        else:
+            self.kv_cache.to(latents[0].device, self._cache_dtype(latents[0].device))
+            self.kv_cache.reset(2 * b)
+            mouse, btn = self.guidance.batched_controls
+            self.kv_cache.enable_cache_updates()
+            self.model(
+                *(torch.cat([x[:,:-1], x[:,:-1]], dim = 0) for x in latents),
+                torch.cat([ts_history[:,:-1], ts_history[:,:-1]], dim = 0),
+                mouse[:,:-1], btn[:,:-1],
+                kv_cache = self.kv_cache
+            )
+            self.kv_cache.disable_cache_updates()
+
+            def fn(last, t):
+                ts = torch.full((b, 1), t, device = ts_history.device, dtype = ts_history.dtype)
+                preds = self.guidance(self.model, tuple(last), ts, t, slice(n - 1, n), kv_cache = self.kv_cache)
+                return preds if isinstance(preds, tuple) else (preds,)
+
+        last = tuple(x[:,-1:].clone() for x in latents)
+        return list(self.solver.solve(fn, last, self.timesteps))
+
+    def _cache_dtype(self, device):
+        device_type = torch.device(device).type
+        if torch.is_autocast_enabled(device_type):
+            return torch.get_autocast_dtype(device_type)
+        return next(self.model.parameters()).dtype
+
+    def report(self):
+        """
+        Per session latency (submit to frame ready) and aggregate throughput
+        """
+        sessions = {}
+        for session_id, session in self.sessions.items():
+            lat = sorted(session.latencies)
+            sessions[session_id] = {
+                "frames" : session.n_frames,
+                "mean_latency_ms" : 1000 * sum(lat) / len(lat) if lat else None,
+                "max_latency_ms" : 1000 * lat[-1] if lat else None
+            }
+        elapsed = 0. if self.start_time is None else time.perf_counter() - self.start_time
+        return {
+            "sessions" : sessions,
+            "ticks" : self.n_ticks,
+            "frames" : self.n_frames,
+            "frames_per_tick" : self.n_frames / max(self.n_ticks, 1),
+            "fps" : self.n_frames / elapsed if elapsed > 0 else 0.,
+            "busy_fps" : self.n_frames / self.busy_time if self.busy_time > 0 else 0.
+        }
+
+def _toy_model(causal = False):
+    from owl_wms.configs import TransformerConfig
+    from owl_wms.models.gamerft import GameRFTCore
+
+    config = TransformerConfig(
+        n_layers = 2, n_heads = 4, d_model = 64,
+        channels = 16, sample_size = 2, tokens_per_frame = 4,
+        n_buttons = 11, n_frames = 8, causal = causal
+    )
+    torch.manual_seed(0)
+    return GameRFTCore(config).eval()
+
+def _toy_session(seed):
+    g = torch.Generator().manual_seed(seed)
+    return (
+        torch.randn(1, 8, 16, 2, 2, generator = g),
+        torch.randn(1, 8, 2, generator = g),
+        (torch.rand(1, 8, 11, generator = g) > 0.5).float()
+    )
+
+@torch.no_grad()
+def test_engine(n_sessions = 4, n_frames = 3):
+    """
+    Sessions served together should get the frames they'd get alone,
+    and admitting/evicting between ticks should only change who's in the batch
+    """
+    for causal in [False, True]:
+        model = _toy_model(causal)
+        inputs = [torch.randn(n_frames, 2) for _ in range(n_sessions)], [(torch.rand(n_frames, 11) > 0.5).float() for _ in range(n_sessions)]
+
+        def run(session_ids):
+            engine = InferenceEngine(model, window_length = 8, n_steps = 4, use_kv_cache = causal)
+            for i in session_ids:
+                engine.admit(i, *_toy_session(i), seed = i)
+            frames = {i : [] for i in session_ids}
+            for f in range(n_frames):
+                for i in session_ids:
+                    engine.submit(i, inputs[0][i][f], inputs[1][i][f])
+                out = engine.tick()
+                assert set(out) == set(session_ids)
+                for i, frame in out.items():
+                    frames[i].append(frame)
+            return {i : torch.cat(v, dim = 1) for i, v in frames.items()}
+
+        batched = run(list(range(n_sessions)))
+        for i in range(n_sessions):
+            alone = run([i])[i]
+            err = (alone - batched[i]).abs().max().item()
+            assert err < 1.0e-4, f"Session {i} differs by {err} when batched (causal={causal})"
+
+    engine = InferenceEngine(model, window_length = 8, n_steps = 2, max_batch = 2)
+    for i in range(3):
+        engine.admit(i, *_toy_session(i))
+        engine.submit(i, torch.zeros(2), torch.zeros(11))
+    assert len(engine.tick()) == 2 and len(engine.tick()) == 1, "max_batch not respected"
+    engine.evict(0)
+    engine.submit(1, torch.zeros(2), torch.zeros(11))
+    assert list(engine.tick()) == [1] and 0 not in engine.sessions
+    print("Engine OK")
+
+@torch.no_grad()
+def bench_engine(session_counts = (1, 2, 4, 8, 16), n_ticks = 5):
+    """
+    Aggregate frames per second as more sessions share the batch
+    """
+    model = _toy_model()
+    for n_sessions in session_counts:
+        engine = InferenceEngine(model, window_length = 8, n_steps = 4, max_batch = n_sessions)
+        for i in range(n_sessions):
+            engine.admit(i, *_toy_session(i), seed = i)
+        for _ in range(n_ticks):
+            for i in range(n_sessions):
+                engine.submit(i, torch.randn(2), torch.zeros(11))
+            engine.tick()
+        report = engine.report()
+        latency = max(s["mean_latency_ms"] for s in report["sessions"].values())
+        print(f"{n_sessions:3d} sessions: {report['busy_fps']:7.1f} frames/s, mean latency {latency:6.1f}ms")
+
+if __name__ == "__main__":
+    test_engine()
+    bench_engine()
@@ -0,0 +1,210 @@
+"""
+Deadline-adaptive quality for AVPipeline: drops to cheaper settings when frames run late
+and climbs back when there's headroom.
+
+Test with a toy model on CPU: python -m inference.quality
+"""
+
+import json
+import time
+from collections import deque
+
+def default_levels(sampling_steps, window_length):
+    """
+    Quality ladder from the pipeline's full settings down to the cheapest. Each level is cheaper
+    than the one before: CFG is dropped on later steps first, then steps, then context, then video decodes.
+    """
+    half_steps = max(sampling_steps // 2, 1)
+    return [
+        {"sampling_steps" : sampling_steps, "cfg_skip" : 0, "context_length" : window_length, "decode_interval" : 1},
+        {"sampling_steps" : sampling_steps, "cfg_skip" : sampling_steps // 2, "context_length" : window_length, "decode_interval" : 1},
+        {"sampling_steps" : half_steps, "cfg_skip" : half_steps // 2, "context_length" : window_length, "decode_interval" : 1},
+        {"sampling_steps" : half_steps, "cfg_skip" : half_steps, "context_length" : window_length, "decode_interval" : 1},
+        {"sampling_steps" : half_steps, "cfg_skip" : half_steps, "context_length" : max(window_length // 2, 2), "decode_interval" : 1},
+        {"sampling_steps" : half_steps, "cfg_skip" : half_steps, "context_length" : max(window_length // 2, 2), "decode_interval" : 2}
+    ]
+
+class QualityController:
+    """
+    Watches per frame latency and moves the pipeline along a ladder of quality levels
+    (see AVPipeline.set_quality) to hold a target frame rate.
+
+    Quality drops a level when the mean latency over the last `window` frames is over the
+    deadline, and rises a level when it's under headroom * deadline. Latencies measured at the
+    old level are dropped after a change, so every decision is based on `window` frames at the current one.
+
+    :param pipeline: AVPipeline (anything with set_quality(**knobs) works)
+    :param target_fps: Frame rate to hold, the deadline is 1000 / target_fps ms
+    :param levels: List of knob dicts from best to cheapest, defaults to default_levels()
+    :param window: Frames averaged before each decision
+    :param headroom: Fraction of the deadline under which quality is raised again.
+        Should be below the cost ratio between neighbouring levels or the controller oscillates.
+    :param log_path: Optional JSON lines file every change is appended to
+    """
+    def __init__(self, pipeline, target_fps = 30, levels = None, window = 10, headroom = 0.6, log_path = None):
+        self.pipeline = pipeline
+        self.deadline_ms = 1000 / target_fps
+        self.levels = levels or default_levels(pipeline.sampling_steps, pipeline.window_length)
+        self.headroom = headroom
+        self.log_path = log_path
+
+        self.recent = deque(maxlen = window)
+        self.changes = []
+        self.n_frames = 0
+        self.level = 0
+        self.pipeline.set_quality(**self.levels[0])
+
+    def __call__(self, new_mouse, new_btn, **kwargs):
+        """
+        pipeline.step(), then update() with its latency
+        """
+        start = time.perf_counter()
+        out = self.pipeline.step(new_mouse, new_btn, **kwargs)
+        self.update(1000 * (time.perf_counter() - start))
+        return out
+
+    def stream(self, controls, **kwargs):
+        """
+        pipeline.stream(), with update() getting the time it took to produce each frame
+        (not counting the time the caller holds on to it)
+        """
+        start = time.perf_counter()
+        for out in self.pipeline.stream(controls, **kwargs):
+            self.update(1000 * (time.perf_counter() - start))
+            yield out
+            start = time.perf_counter()
+
+    def update(self, latency_ms):
+        """
+        Record one frame's latency and change level if needed
+        :return: New level if it changed, else None
+        """
+        self.n_frames += 1
+        self.recent.append(latency_ms)
+        if len(self.recent) < self.recent.maxlen:
+            return None
+
+        mean_ms = sum(self.recent) / len(self.recent)
+        if mean_ms > self.deadline_ms and self.level < len(self.levels) - 1:
+            return self.set_level(self.level + 1, "over deadline", mean_ms)
+        if mean_ms < self.headroom * self.deadline_ms and self.level > 0:
+            return self.set_level(self.level - 1, "headroom", mean_ms)
+        return None
+
+    def set_level(self, level, reason = "manual", mean_ms = None):
+        change = {
+            "time" : time.time(),
+            "frame" : self.n_frames,
+            "from_level" : self.level,
+            "to_level" : level,
+            "reason" : reason,
+            "mean_latency_ms" : mean_ms,
+            "deadline_ms" : self.deadline_ms,
+            "knobs" : dict(self.levels[level])
+        }
+        self.level = level
+        self.pipeline.set_quality(**self.levels[level])
+        self.recent.clear()
+
+        self.changes.append(change)
+        if self.log_path is not None:
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps(change) + "\n")
+        return level
+
+class _SimulatedPipeline:
+    # Latency is a cost model of the knobs scaled by a load factor, to test the control loop
+    def __init__(self, sampling_steps = 10, window_length = 60):
+        self.sampling_steps = sampling_steps
+        self.window_length = window_length
+        self.knobs = {}
+        self.load = 1.0
+
+    def set_quality(self, **knobs):
+        self.knobs = knobs
+
+    def latency_ms(self):
+        k = self.knobs
+        evals = k["sampling_steps"] + (k["sampling_steps"] - k["cfg_skip"]) # CFG doubles the batch
+        per_eval = 0.3 + 0.9 * k["context_length"] / self.window_length
+        decode = 4.0 / k["decode_interval"]
+        return self.load * (evals * per_eval + decode)
+
+def test_quality_controller():
+    pipeline = _SimulatedPipeline()
+    controller = QualityController(pipeline, target_fps = 30)
+    levels_seen = []
+    for load in [1.0, 2.0, 4.0, 1.0, 0.5]:
+        pipeline.load = load
+        for _ in range(200):
+            controller.update(pipeline.latency_ms())
+        levels_seen.append(controller.level)
+        if load <= 1.0:
+            assert pipeline.latency_ms() <= controller.deadline_ms, f"Over deadline at load {load}"
+
+    # Quality goes down with load and back up when it's gone
+    assert levels_seen[0] == 0, levels_seen
+    assert levels_seen[2] > levels_seen[1] > levels_seen[0], levels_seen
+    assert levels_seen[-1] == 0, levels_seen
+    assert all(c["knobs"] == controller.levels[c["to_level"]] for c in controller.changes)
+    print(f"Levels per load: {levels_seen}, {len(controller.changes)} changes")
+    print("Quality controller OK")
+
+def test_quality_controller_pipeline(n_frames = 30):
+    """
+    Every level of the default ladder runs on a real (tiny) AVPipeline
+    """
+    import torch
+
+    from owl_wms.configs import TransformerConfig
+    from owl_wms.models.gamerft_audio import GameRFTAudioCore
+    from .av_pipeline import AVPipeline
+
+    config = TransformerConfig(
+        n_layers = 2, n_heads = 4, d_model = 64,
+        channels = 16, audio_channels = 8, sample_size = 2, tokens_per_frame = 5,
+        n_buttons = 11, n_frames = 8
+    )
+    torch.manual_seed(0)
+    model = GameRFTAudioCore(config).eval()
+
+    W = config.n_frames
+    pipeline = AVPipeline(
+        model, window_length = W, sampling_steps = 4, audio_f = 4,
+        frame_decode_fn = lambda x: torch.tanh(x),
+        audio_decode_fn = lambda a: torch.tanh(a[...,:2]).repeat_interleave(4, dim = 1)
+    )
+    pipeline.init_buffers(torch.randn(1, W, 16, 2, 2), torch.randn(1, W, 8), torch.randn(1, W, 2), torch.zeros(1, W, 11))
+
+    controller = QualityController(pipeline, target_fps = 30)
+    mouse, btn = torch.zeros(2), torch.zeros(11)
+    for level in range(len(controller.levels)):
+        controller.set_level(level)
+        frames = [controller(mouse, btn)[0] for _ in range(4)]
+        assert all(torch.isfinite(f).all() for f in frames)
+        if pipeline.decode_interval > 1:
+            assert frames[1] is frames[0], "Video decode wasn't skipped"
+        print(f"level {level}: {pipeline.quality()}, {sum(pipeline.latencies[-4:]) / 4 * 1000:.1f}ms/frame")
+
+    # Skipped decodes on the pipelined path too
+    controller.set_level(len(controller.levels) - 1)
+    frames = [frame for frame, audio in controller.stream([(mouse, btn)] * 4)]
+    assert frames[1] is frames[0] and frames[3] is frames[2] and frames[2] is not frames[1], "stream() didn't skip video decodes"
+    assert controller.n_frames == 4 * len(controller.levels) + 4, "stream() latencies weren't recorded"
+
+    # And the controller adapts on its own under the real latency, a 0.1ms deadline can't be held
+    controller = QualityController(pipeline, target_fps = 10000)
+    for _ in range(n_frames):
+        controller(mouse, btn)
+    assert controller.level == n_frames // controller.recent.maxlen, "Controller didn't lower quality when over the deadline"
+
+    # Same when it's fed by stream()
+    controller = QualityController(pipeline, target_fps = 10000)
+    for _ in controller.stream([(mouse, btn)] * n_frames):
+        pass
+    assert controller.level == n_frames // controller.recent.maxlen, "Controller didn't lower quality from stream() latencies"
+    print("Quality controller on AVPipeline OK")
+
+if __name__ == "__main__":
+    test_quality_controller()
+    test_quality_controller_pipeline()
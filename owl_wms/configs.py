@@ -23,6 +23,8 @@ class TransformerConfig:
     n_frames : int = 120
 
     causal : bool = False
+    attn_backend : str = "sdpa"
+    attn_backend_kwargs : dict = None
 
 @dataclass
 class TrainingConfig:
@@ -11,4 +11,7 @@ def get_loader(data_id, batch_size, **data_kwargs):
         return s3_cod_latent.get_loader(batch_size, **data_kwargs)
     elif data_id == "cod_s3_audio":
         from . import s3_cod_latent_audio
-        return s3_cod_latent_audio.get_loader(batch_size, **data_kwargs)
\ No newline at end of file
+        return s3_cod_latent_audio.get_loader(batch_size, **data_kwargs)
+    elif data_id == "cod_packed":
+        from . import packed_latent
+        return packed_latent.get_loader(batch_size, **data_kwargs)
\ No newline at end of file
@@ -2,34 +2,20 @@ from torch.utils.data import DataLoader, IterableDataset
 import torch
 import torch.nn.functional as F
 
-import os
 import random
 
+from .manifest import get_episodes
+
 class CoDDataset(IterableDataset):
-    def __init__(self, window_length = 120, root = "/home/shahbuland/cod_data/raw"):
+    def __init__(self, window_length = 120, root = "/home/shahbuland/cod_data/raw", manifest_path = None):
         super().__init__()
 
         self.window = window_length
-        self.paths = []
-        for root_dir in os.listdir(root):
-            splits_dir = os.path.join(root, root_dir, "splits")
-            if not os.path.isdir(splits_dir):
-                continue
-                
-            # Get all files in splits dir
-            files = os.listdir(splits_dir)
-            # Filter to just the base files (without _mouse or _buttons)
-            base_files = [f for f in files if f.endswith("_rgb.pt")]
-            
-            for base_file in base_files:
-                base_path = os.path.join(splits_dir, base_file)
-                # Get just the numeric prefix from the filename
-                base_name = base_file.split('_')[0]
-                mouse_path = os.path.join(splits_dir, f"{base_name}_mouse.pt")
-                buttons_path = os.path.join(splits_dir, f"{base_name}_buttons.pt") 
-                
-                if os.path.exists(mouse_path) and os.path.exists(buttons_path):
-                    self.paths.append((base_path, mouse_path, buttons_path))
+        # Complete episodes with at least a window of frames, from the cached manifest (see manifest.py)
+        episodes, n_skipped = get_episodes(root, ["rgb", "mouse", "buttons"], min_length = window_length, manifest_path = manifest_path)
+        self.paths = [paths for paths, _ in episodes]
+        if n_skipped:
+            print(f"Skipped {n_skipped} episodes that are incomplete or shorter than {window_length} frames")
     
     def get_item(self):
         vid_path, mouse_path, btn_path = random.choice(self.paths)
@@ -0,0 +1,205 @@
+"""
+Cached listing of a local CoD corpus (<root>/<game>/splits/<episode>_<modality>.pt):
+which modalities every episode has and how many frames each holds. Built once and saved
+next to the data, after that only splits dirs whose mtime changed are listed again, and
+only new or modified files are opened to count frames. A file rewritten in place leaves the
+dir mtime alone and isn't noticed, verify_files (--verify_files) stats every cached file
+to catch those, at one metadata call per file.
+
+Build or refresh from the command line: python -m owl_wms.data.manifest --root <root>
+"""
+
+import json
+import os
+
+import torch
+
+MANIFEST_NAME = "manifest.json"
+VERSION = 1
+
+def _scan_dir(splits_dir, cached, list_dir = True):
+    """
+    :param cached: Previous {file : [size, mtime_ns, n_frames]} of this dir
+    :param list_dir: List the dir to pick up new files, else only check the cached ones again
+    :return: {file : [size, mtime_ns, n_frames]} for every .pt file in it
+    """
+    if list_dir:
+        with os.scandir(splits_dir) as it:
+            names = [entry.name for entry in it if entry.name.endswith(".pt") and entry.is_file()]
+    else:
+        names = list(cached)
+
+    files = {}
+    for name in names:
+        path = os.path.join(splits_dir, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        prev = cached.get(name)
+        if prev is not None and prev[:2] == [st.st_size, st.st_mtime_ns]:
+            files[name] = prev
+            continue
+        try:
+            n_frames = len(torch.load(path, map_location = 'cpu', mmap = True))
+        except Exception:
+            n_frames = 0 # Unreadable (i.e. still being written), counted again once it changes
+        files[name] = [st.st_size, st.st_mtime_ns, n_frames]
+    return files
+
+def build_manifest(root, manifest_path = None, save = True, verify_files = False):
+    """
+    Brings the manifest of root up to date, rescanning only splits dirs that changed.
+
+    :param manifest_path: Where the manifest is kept, defaults to <root>/manifest.json
+    :param save: Write it back if anything changed. A root that isn't writable just isn't cached.
+    :param verify_files: Also stat the files of unchanged dirs and recount the ones whose size or mtime changed
+    :return: {"version", "dirs" : {"<game>/splits" : {"mtime_ns", "files" : {file : [size, mtime_ns, n_frames]}}}}
+    """
+    manifest_path = manifest_path or os.path.join(root, MANIFEST_NAME)
+    manifest = {"version" : VERSION, "dirs" : {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            loaded = json.load(f)
+        if loaded.get("version") == VERSION:
+            manifest = loaded
+
+    dirs = {}
+    changed = False
+    for root_dir in sorted(os.listdir(root)):
+        rel = os.path.join(root_dir, "splits")
+        splits_dir = os.path.join(root, rel)
+        if not os.path.isdir(splits_dir):
+            continue
+
+        mtime_ns = os.stat(splits_dir).st_mtime_ns
+        prev = manifest["dirs"].get(rel)
+        if prev is not None and prev["mtime_ns"] == mtime_ns:
+            if not verify_files:
+                dirs[rel] = prev
+                continue
+            # Same set of files, but any of them may have been rewritten in place
+            files = _scan_dir(splits_dir, prev["files"], list_dir = False)
+            changed = changed or files != prev["files"]
+        else:
+            files = _scan_dir(splits_dir, prev["files"] if prev else {})
+            changed = True
+        dirs[rel] = {"mtime_ns" : mtime_ns, "files" : files}
+
+    changed = changed or dirs.keys() != manifest["dirs"].keys()
+    manifest["dirs"] = dirs
+    if save and changed:
+        try:
+            tmp_path = manifest_path + f".tmp{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f, separators = (",", ":"))
+            os.replace(tmp_path, manifest_path) # Readers never see a partial file
+        except OSError:
+            pass
+    return manifest
+
+def get_episodes(root, suffixes, min_length = 1, manifest_path = None, verify_files = False):
+    """
+    Episodes that have a file for every suffix and at least min_length frames in all of them.
+
+    :param suffixes: File suffixes to require, i.e. ["rgblatent", "mouse", "buttons"]
+    :param verify_files: See build_manifest
+    :return: (episodes, n_skipped) with episodes a list of ((path for each suffix), n_frames),
+        n_frames being the shortest of the modalities
+    """
+    manifest = build_manifest(root, manifest_path, verify_files = verify_files)
+    episodes = []
+    n_skipped = 0
+    for rel, entry in manifest["dirs"].items():
+        files = entry["files"]
+        for base_file in sorted(files):
+            if not base_file.endswith(f"_{suffixes[0]}.pt"):
+                continue
+            base_name = base_file.split('_')[0]
+            names = [f"{base_name}_{suffix}.pt" for suffix in suffixes]
+            if not all(name in files for name in names):
+                n_skipped += 1
+                continue
+            n_frames = min(files[name][2] for name in names)
+            if n_frames < min_length:
+                n_skipped += 1
+                continue
+            episodes.append((tuple(os.path.join(root, rel, name) for name in names), n_frames))
+    return episodes, n_skipped
+
+def test_manifest():
+    import tempfile
+    import time
+
+    root = tempfile.mkdtemp()
+    for game, lengths in [("a", [30, 10, 50]), ("b", [40])]:
+        splits = os.path.join(root, game, "splits")
+        os.makedirs(splits)
+        for i, n in enumerate(lengths):
+            torch.save(torch.randn(n, 4), os.path.join(splits, f"{i}_rgblatent.pt"))
+            torch.save(torch.randn(n + 1, 2), os.path.join(splits, f"{i}_mouse.pt"))
+            torch.save(torch.zeros(n, 11), os.path.join(splits, f"{i}_buttons.pt"))
+    os.remove(os.path.join(root, "a", "splits", "2_buttons.pt"))
+
+    episodes, n_skipped = get_episodes(root, ["rgblatent", "mouse", "buttons"], min_length = 20)
+    assert sorted(n for _, n in episodes) == [30, 40] and n_skipped == 2, (episodes, n_skipped)
+    assert os.path.exists(os.path.join(root, MANIFEST_NAME))
+
+    # Unchanged dirs aren't opened again
+    loads = [0]
+    load = torch.load
+    def counted_load(*args, **kwargs):
+        loads[0] += 1
+        return load(*args, **kwargs)
+    torch.load = counted_load
+    try:
+        assert get_episodes(root, ["rgblatent", "mouse", "buttons"], min_length = 20)[0] == episodes
+        assert loads[0] == 0, f"{loads[0]} files reloaded with nothing changed"
+
+        # A new file only loads that file
+        time.sleep(0.01)
+        torch.save(torch.zeros(50, 11), os.path.join(root, "a", "splits", "2_buttons.pt"))
+        episodes, n_skipped = get_episodes(root, ["rgblatent", "mouse", "buttons"], min_length = 20)
+        assert loads[0] == 1, f"{loads[0]} files loaded for one new file"
+        assert sorted(n for _, n in episodes) == [30, 40, 50] and n_skipped == 1
+
+        # Files rewritten in place leave the dir mtime alone, they're only recounted with verify_files,
+        # including one that was unreadable (half written) the last time around
+        splits = os.path.join(root, "b", "splits")
+        dir_mtime = os.stat(splits).st_mtime_ns
+        with open(os.path.join(splits, "0_buttons.pt"), "wb") as f:
+            f.write(b"partial")
+        os.utime(splits, ns = (dir_mtime, dir_mtime))
+        loads[0] = 0
+        assert get_episodes(root, ["rgblatent", "mouse", "buttons"], min_length = 20)[0] == episodes
+        assert loads[0] == 0, "Unchanged dir rescanned without verify_files"
+        episodes, n_skipped = get_episodes(root, ["rgblatent", "mouse", "buttons"], min_length = 20, verify_files = True)
+        assert loads[0] == 1 and sorted(n for _, n in episodes) == [30, 50] and n_skipped == 2, (loads, episodes)
+
+        time.sleep(0.01)
+        torch.save(torch.zeros(25, 11), os.path.join(splits, "0_buttons.pt"))
+        torch.save(torch.randn(60, 4), os.path.join(root, "a", "splits", "0_rgblatent.pt"))
+        os.utime(splits, ns = (dir_mtime, dir_mtime))
+        loads[0] = 0
+        episodes, n_skipped = get_episodes(root, ["rgblatent", "mouse", "buttons"], min_length = 20, verify_files = True)
+        assert loads[0] == 2, f"{loads[0]} files loaded for two rewritten files"
+        assert sorted(n for _, n in episodes) == [25, 30, 50] and n_skipped == 1, episodes
+    finally:
+        torch.load = load
+    print("Manifest OK")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", type=str, default=None)
+    parser.add_argument("--manifest_path", type=str, default=None)
+    parser.add_argument("--verify_files", action="store_true", help="Recount files rewritten in place in unchanged dirs")
+    args = parser.parse_args()
+
+    if args.root is None:
+        test_manifest()
+    else:
+        manifest = build_manifest(args.root, args.manifest_path, verify_files = args.verify_files)
+        n_files = sum(len(d["files"]) for d in manifest["dirs"].values())
+        print(f"{len(manifest['dirs'])} dirs, {n_files} files")
@@ -0,0 +1,303 @@
+"""
+Packed latent shards: every modality of every episode written back to back into a few large
+binary files, plus an index of where each episode starts. Windows are read straight out of
+a numpy memmap, so loading one touches only that window's pages and unpickles nothing.
+
+Layout of out_dir:
+    meta.json       modalities (dtype, per frame shape), shard file names
+    index.npy       int64 [n_episodes, 2 + n_modalities]: shard, length, byte offset of each modality
+    shard_XXXXX.bin raw tensor bytes
+
+Convert with: python -m owl_wms.data.packed_latent --root <cod latent root> --out_dir <dir>
+"""
+
+import json
+import os
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, IterableDataset
+
+# Suffix of each modality's file in the splits dirs (see local_cod_latent.py)
+SUFFIXES = {
+    "video" : "rgblatent",
+    "mouse" : "mouse",
+    "buttons" : "buttons",
+    "flow" : "flowlatent",
+    "audio" : "audiolatent"
+}
+REQUIRED = ["video", "mouse", "buttons"]
+ALIGN = 64
+
+def find_episodes(root, modalities):
+    """
+    Episodes under root/<game>/splits/ that have a file for every modality
+    :return: List of {modality : path}
+    """
+    episodes = []
+    for root_dir in sorted(os.listdir(root)):
+        splits_dir = os.path.join(root, root_dir, "splits")
+        if not os.path.isdir(splits_dir):
+            continue
+
+        files = set(os.listdir(splits_dir))
+        for base_file in sorted(files):
+            if not base_file.endswith(f"_{SUFFIXES['video']}.pt"):
+                continue
+            base_name = base_file.split('_')[0]
+            names = {m : f"{base_name}_{SUFFIXES[m]}.pt" for m in modalities}
+            if all(name in files for name in names.values()):
+                episodes.append({m : os.path.join(splits_dir, name) for m, name in names.items()})
+    return episodes
+
+def _storage_dtype(dtype):
+    # numpy dtype with the same bytes as a torch dtype (bfloat16 has no numpy equivalent)
+    try:
+        return torch.empty(0, dtype = dtype).numpy().dtype
+    except TypeError:
+        return np.dtype(f"int{torch.finfo(dtype).bits}")
+
+def pack_latents(root, out_dir, shard_bytes = 2 << 30, add_optical_flow = True, include_audio = False, min_length = 1):
+    """
+    Packs every complete episode under root into shards in out_dir.
+
+    :param shard_bytes: A new shard is started once the current one is past this size
+    :param min_length: Episodes shorter than this (in frames) are skipped
+    :return: Number of episodes packed
+    """
+    modalities = list(REQUIRED)
+    if add_optical_flow:
+        modalities.append("flow")
+    if include_audio:
+        modalities.append("audio")
+
+    os.makedirs(out_dir, exist_ok = True)
+    meta = {"modalities" : {}, "shards" : []}
+    rows = []
+    f, shard_size = None, 0
+
+    for paths in find_episodes(root, modalities):
+        tensors = {m : torch.load(paths[m], map_location = 'cpu', mmap = True) for m in modalities}
+        length = min(len(t) for t in tensors.values())
+        if length < min_length:
+            continue
+
+        if f is None or shard_size >= shard_bytes:
+            if f is not None:
+                f.close()
+            meta["shards"].append(f"shard_{len(meta['shards']):05d}.bin")
+            f = open(os.path.join(out_dir, meta["shards"][-1]), "wb")
+            shard_size = 0
+
+        row = [len(meta["shards"]) - 1, length]
+        for m in modalities:
+            t = tensors[m][:length].contiguous()
+            info = {"dtype" : str(t.dtype).replace("torch.", ""), "frame_shape" : list(t.shape[1:])}
+            assert meta["modalities"].setdefault(m, info) == info, f"{paths[m]} doesn't match the other episodes' {m}: {info}"
+
+            pad = -shard_size % ALIGN
+            f.write(b"\0" * pad)
+            shard_size += pad
+            row.append(shard_size)
+
+            data = t.reshape(-1).view(torch.uint8).numpy()
+            f.write(data.tobytes())
+            shard_size += data.nbytes
+        rows.append(row)
+
+    if f is not None:
+        f.close()
+
+    np.save(os.path.join(out_dir, "index.npy"), np.array(rows, dtype = np.int64).reshape(-1, 2 + len(modalities)))
+    with open(os.path.join(out_dir, "meta.json"), "w") as fp:
+        json.dump({**meta, "order" : modalities}, fp, indent = 2)
+    return len(rows)
+
+class PackedLatentShards:
+    """
+    Read side of a packed directory. Shards are memory mapped on first use, so every
+    DataLoader worker maps its own.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as fp:
+            meta = json.load(fp)
+        self.order = meta["order"]
+        self.shard_names = meta["shards"]
+        self.modalities = {}
+        for m, info in meta["modalities"].items():
+            dtype = getattr(torch, info["dtype"])
+            frame_shape = tuple(info["frame_shape"])
+            self.modalities[m] = (dtype, _storage_dtype(dtype), frame_shape, int(np.prod(frame_shape, dtype = np.int64)))
+
+        self.index = np.load(os.path.join(path, "index.npy"), allow_pickle = False)
+        self.lengths = self.index[:,1]
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def _shard(self, i):
+        if i not in self._shards:
+            self._shards[i] = np.memmap(os.path.join(self.path, self.shard_names[i]), dtype = np.uint8, mode = 'r')
+        return self._shards[i]
+
+    def read(self, episode, modality, start, length):
+        """
+        Frames [start, start + length) of one modality of an episode, as a tensor with its stored dtype
+        """
+        shard, n = self.index[episode,:2]
+        assert 0 <= start and start + length <= n, f"Window [{start}, {start + length}) out of episode of {n} frames"
+        dtype, storage_dtype, frame_shape, frame_numel = self.modalities[modality]
+        offset = int(self.index[episode, 2 + self.order.index(modality)])
+
+        itemsize = storage_dtype.itemsize
+        begin = offset + start * frame_numel * itemsize
+        raw = self._shard(int(shard))[begin:begin + length * frame_numel * itemsize]
+        x = torch.from_numpy(np.array(raw.view(storage_dtype))) # Copies just the window out of the page cache
+        if x.dtype != dtype:
+            x = x.view(dtype)
+        return x.view(length, *frame_shape)
+
+class PackedLatentDataset(IterableDataset):
+    """
+    Same samples as CoDLatentDataset (optionally with audio), read from packed shards.
+
+    :param root: Directory written by pack_latents
+    :param add_optical_flow: Concatenate flow latents to the video latents along the last dim
+    :param include_audio: Also return the audio latent window
+    """
+    def __init__(self, window_length = 120, root = "/home/shahbuland/cod_data/packed", add_optical_flow = True, include_audio = False):
+        super().__init__()
+
+        self.window = window_length
+        self.add_optical_flow = add_optical_flow
+        self.include_audio = include_audio
+        self.shards = PackedLatentShards(root)
+
+        for m in (["flow"] if add_optical_flow else []) + (["audio"] if include_audio else []):
+            assert m in self.shards.modalities, f"{root} was packed without {m}"
+
+        # Episodes too short for a window are never picked
+        self.episodes = np.nonzero(self.shards.lengths >= window_length)[0]
+        assert len(self.episodes) > 0, f"No episodes with at least {window_length} frames in {root}"
+
+    def get_item(self):
+        episode = int(random.choice(self.episodes))
+        window_start = random.randint(0, int(self.shards.lengths[episode]) - self.window)
+        read = lambda m: self.shards.read(episode, m, window_start, self.window)
+
+        vid_slice = read("video").float()
+        if self.add_optical_flow:
+            vid_slice = torch.cat([vid_slice, read("flow").float()], dim = -1)
+        mouse_slice = read("mouse")
+        buttons_slice = read("buttons")
+
+        if self.include_audio:
+            return vid_slice, mouse_slice, buttons_slice, read("audio")
+        return vid_slice, mouse_slice, buttons_slice # [n,c,h,w] [n,2], [n,n_buttons] respectively
+
+    def __iter__(self):
+        while True:
+            yield self.get_item()
+
+def collate_fn(x):
+    # x is list of triples (or quadruples with audio)
+    items = [torch.stack(t) for t in zip(*x)]
+    if len(items) == 4:
+        vids, mouses, buttons, audios = items
+        return vids, audios, mouses, buttons # Same order as the s3 audio loader
+    return tuple(items)
+
+def get_loader(batch_size, **data_kwargs):
+    dataset = PackedLatentDataset(**data_kwargs)
+    return DataLoader(dataset, batch_size = batch_size, collate_fn = collate_fn, num_workers = 1, prefetch_factor = 2)
+
+def _write_toy_corpus(root, n_episodes = 6, lengths = (40, 90)):
+    g = torch.Generator().manual_seed(0)
+    episodes = []
+    for i in range(n_episodes):
+        splits = os.path.join(root, f"game{i % 2}", "splits")
+        os.makedirs(splits, exist_ok = True)
+        n = int(torch.randint(*lengths, (1,), generator = g))
+        ep = {
+            "rgblatent" : torch.randn(n, 16, 4, 4, generator = g).bfloat16(),
+            "flowlatent" : torch.randn(n, 16, 4, 4, generator = g).bfloat16(),
+            "mouse" : torch.randn(n + 2, 2, generator = g), # Modalities can be off by a few frames
+            "buttons" : torch.rand(n, 11, generator = g) > 0.5,
+            "audiolatent" : torch.randn(n, 64, generator = g)
+        }
+        for suffix, t in ep.items():
+            torch.save(t, os.path.join(splits, f"{i:04d}_{suffix}.pt"))
+        episodes.append(ep)
+    os.remove(os.path.join(root, "game1", "splits", "0001_audiolatent.pt")) # Incomplete episode
+    return episodes
+
+def test_packed_latents():
+    import tempfile
+
+    tmp = tempfile.mkdtemp()
+    root, out = os.path.join(tmp, "raw"), os.path.join(tmp, "packed")
+    episodes = _write_toy_corpus(root)
+
+    n = pack_latents(root, out, shard_bytes = 20000, add_optical_flow = True, include_audio = True)
+    assert n == len(episodes) - 1, f"Packed {n} episodes"
+    shards = PackedLatentShards(out)
+    assert len(shards.shard_names) > 1, "Expected several shards"
+
+    # Every window reads back bit exact
+    paths = find_episodes(root, ["video", "mouse", "buttons", "flow", "audio"])
+    for e, p in enumerate(paths):
+        i = int(os.path.basename(p["video"]).split('_')[0])
+        length = int(shards.lengths[e])
+        for m in ["video", "mouse", "buttons", "flow", "audio"]:
+            ref = episodes[i][SUFFIXES[m]]
+            start = random.randint(0, length - 30)
+            out_window = shards.read(e, m, start, 30)
+            assert out_window.dtype == ref.dtype and torch.equal(out_window, ref[start:start+30]), f"{m} of episode {i} differs"
+
+    ds = PackedLatentDataset(window_length = 60, root = out, add_optical_flow = True, include_audio = True)
+    assert all(shards.lengths[e] >= 60 for e in ds.episodes)
+    vid, mouse, btn, audio = ds.get_item()
+    assert vid.shape == (60, 16, 4, 8) and vid.dtype == torch.float32
+    assert mouse.shape == (60, 2) and btn.shape == (60, 11) and audio.shape == (60, 64)
+    print(f"Packed latents OK ({n} episodes, {len(shards.shard_names)} shards)")
+
+def bench_packed_latents(n_items = 200):
+    """
+    Window loading from per episode .pt files (CoDLatentDataset) against packed shards
+    """
+    import tempfile
+    import time
+
+    from .local_cod_latent import CoDLatentDataset
+
+    tmp = tempfile.mkdtemp()
+    root, out = os.path.join(tmp, "raw"), os.path.join(tmp, "packed")
+    _write_toy_corpus(root, n_episodes = 16, lengths = (300, 600))
+    pack_latents(root, out)
+
+    for name, ds in [("per file .pt", CoDLatentDataset(60, root)), ("packed", PackedLatentDataset(60, out))]:
+        start = time.perf_counter()
+        for _ in range(n_items):
+            ds.get_item()
+        print(f"  {name:<14} {(time.perf_counter() - start) / n_items * 1000:.2f}ms/window")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", type=str, help="CoD latent root (<root>/<game>/splits/*.pt)")
+    parser.add_argument("--out_dir", type=str, help="Where to write the shards")
+    parser.add_argument("--shard_gb", type=float, default=2.0)
+    parser.add_argument("--no_flow", action="store_true")
+    parser.add_argument("--audio", action="store_true")
+    args = parser.parse_args()
+
+    if args.root is None:
+        test_packed_latents()
+        bench_packed_latents()
+    else:
+        n = pack_latents(args.root, args.out_dir, int(args.shard_gb * (1 << 30)), not args.no_flow, args.audio)
+        print(f"Packed {n} episodes into {args.out_dir}")
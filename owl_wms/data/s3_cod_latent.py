@@ -13,19 +13,8 @@ import tarfile
 import io
 import time
 
-class RandomizedQueue:
-    def __init__(self):
-        self.items = []
-
-    def add(self, item):
-        idx = random.randint(0, len(self.items))
-        self.items.insert(idx, item)
-
-    def pop(self):
-        if not self.items:
-            return None
-        idx = random.randint(0, len(self.items) - 1)
-        return self.items.pop(idx)
+from .shard_assignment import all_tar_keys, iter_tars
+from .shuffle_buffer import ShuffleBuffer
 
 TOTAL_SHARDS = 2
 NUM_SUBDIRS=1
@@ -33,23 +22,36 @@ NUM_TARS=9
 BUCKET_NAME="cod-data-latent-360x640to5x8"
 
 class S3CoDLatentDataset(IterableDataset):
-    def __init__(self, window_length=120, file_share_max=20, rank=0, world_size=1, bucket_name = BUCKET_NAME, include_keyframe = False):
+    def __init__(self, window_length=120, file_share_max=20, rank=0, world_size=1, bucket_name = BUCKET_NAME, include_keyframe = False, seed=0):
         super().__init__()
         
         self.window = window_length
         self.file_share_max = file_share_max
         self.rank = rank
         self.world_size = world_size
+        self.seed = seed
         self.include_keyframe = include_keyframe
         self.bucket_name = bucket_name
 
         # Queue parameters
         self.max_tars = 2
         self.max_data = 1000
+        self.max_data_bytes = 8 << 30
+
+        # Every tar in the bucket, split between ranks and workers once iteration starts
+        self.tar_keys = all_tar_keys(TOTAL_SHARDS, NUM_SUBDIRS, NUM_TARS)
+        self.started = False
+
+    def start(self):
+        # Runs inside each DataLoader worker, so the client, queues and threads aren't
+        # created in the main process and then copied into every worker
+        if self.started:
+            return
+        self.started = True
 
         # Initialize queues
-        self.tar_queue = RandomizedQueue()
-        self.data_queue = RandomizedQueue()
+        self.tar_queue = ShuffleBuffer(self.max_tars)
+        self.data_queue = ShuffleBuffer(self.max_data, self.max_data_bytes)
 
         # Setup S3 client
         self.s3_client = boto3.client(
@@ -60,34 +62,26 @@ class S3CoDLatentDataset(IterableDataset):
             region_name=os.environ['AWS_REGION'],
         )
 
+        # This worker's own tars, disjoint from every other (rank, worker) and reshuffled every epoch
+        tars = iter_tars(self.tar_keys, self.rank, self.world_size, self.seed)
+
         # Start background threads
-        self.tar_thread = threading.Thread(target=self.background_download_tars, daemon=True)
+        self.tar_thread = threading.Thread(target=self.background_download_tars, args=(tars,), daemon=True)
         self.data_thread = threading.Thread(target=self.background_load_data, daemon=True)
         self.tar_thread.start()
         self.data_thread.start()
 
-    def random_sample_prefix(self):
-        # For now just 2 shards (00, 01)
-        shard = random.randint(0, TOTAL_SHARDS-1)
-        # Each shard has 1000 subdirs
-        subdir = random.randint(0, NUM_SUBDIRS-1)
-        # Each subdir has multiple tars
-        tar_num = random.randint(0, NUM_TARS-1)
-        return f"{shard:02d}/{subdir:04d}/{tar_num:04d}.tar"
-
-    def background_download_tars(self):
+    def background_download_tars(self, tars):
         while True:
-            if len(self.tar_queue.items) < self.max_tars:
-                tar_path = self.random_sample_prefix()
-                try:
-                    # Download tar directly to memory
-                    response = self.s3_client.get_object(Bucket=self.bucket_name, Key=tar_path)
-                    tar_data = response['Body'].read()
-                    self.tar_queue.add(tar_data)
-                except Exception as e:
-                    print(f"Error downloading tar {tar_path}: {e}")
-            else:
-                time.sleep(1)
+            tar_path = next(tars)
+            try:
+                # Download tar directly to memory
+                response = self.s3_client.get_object(Bucket=self.bucket_name, Key=tar_path)
+                tar_data = response['Body'].read()
+            except Exception as e:
+                print(f"Error downloading tar {tar_path}: {e}")
+                continue
+            self.tar_queue.add(tar_data) # Blocks while max_tars are waiting
 
     def process_tensor_file(self, tar, base_name, suffix):
         try:
@@ -102,76 +96,68 @@ class S3CoDLatentDataset(IterableDataset):
 
     def background_load_data(self):
         while True:
-            if len(self.data_queue.items) < self.max_data:
-                tar_data = self.tar_queue.pop()
-                if tar_data is None:
-                    time.sleep(1)
-                    continue
-
-                try:
-                    tar_file = io.BytesIO(tar_data)
-                    with tarfile.open(fileobj=tar_file) as tar:
-                        members = tar.getmembers()
-                        base_names = set()
-                        
-                        # Get unique base names
-                        for member in members:
-                            if member.name.endswith('.latent.pt'):
-                                base_names.add(member.name.split('.')[0])
-
-                        for base_name in base_names:
-                            # Load all tensors for this base name
-                            latent = self.process_tensor_file(tar, base_name, "latent")
-                            mouse = self.process_tensor_file(tar, base_name, "mouse")
-                            button = self.process_tensor_file(tar, base_name, "buttons")
-
-                            if all(t is not None for t in [latent, mouse, button]):
-                                min_len = min(len(latent), len(mouse), len(button))
+            tar_data = self.tar_queue.pop() # Blocks until a tar is downloaded
+
+            try:
+                tar_file = io.BytesIO(tar_data)
+                with tarfile.open(fileobj=tar_file) as tar:
+                    members = tar.getmembers()
+                    base_names = set()
+                    
+                    # Get unique base names
+                    for member in members:
+                        if member.name.endswith('.latent.pt'):
+                            base_names.add(member.name.split('.')[0])
+
+                    for base_name in base_names:
+                        # Load all tensors for this base name
+                        latent = self.process_tensor_file(tar, base_name, "latent")
+                        mouse = self.process_tensor_file(tar, base_name, "mouse")
+                        button = self.process_tensor_file(tar, base_name, "buttons")
+
+                        if all(t is not None for t in [latent, mouse, button]):
+                            min_len = min(len(latent), len(mouse), len(button))
+                            
+                            # Sample multiple windows if requested
+                            for _ in range(self.file_share_max):
+                                max_start = min_len - self.window
+                                if max_start <= 0:
+                                    continue
+                                    
+                                window_start = random.randint(0, max_start)
                                 
-                                # Sample multiple windows if requested
-                                for _ in range(self.file_share_max):
-                                    if len(self.data_queue.items) >= self.max_data:
-                                        break
-                                        
-                                    max_start = min_len - self.window
-                                    if max_start <= 0:
-                                        continue
-                                        
-                                    window_start = random.randint(0, max_start)
+                                latent_slice = latent[window_start:window_start+self.window].float()
+                                mouse_slice = mouse[window_start:window_start+self.window]
+                                button_slice = button[window_start:window_start+self.window]
+
+                                if self.include_keyframe:
+                                    # Sample keyframe from nearby in video but not in window
+                                    buffer = 400
+                                    valid_range_start = max(0, window_start - buffer)
+                                    valid_range_end = min(len(latent), window_start + self.window + buffer)
+                                    
+                                    # Exclude the actual window frames
+                                    valid_frames = list(range(valid_range_start, window_start)) + \
+                                                 list(range(window_start + self.window, valid_range_end))
                                     
-                                    latent_slice = latent[window_start:window_start+self.window].float()
-                                    mouse_slice = mouse[window_start:window_start+self.window]
-                                    button_slice = button[window_start:window_start+self.window]
-
-                                    if self.include_keyframe:
-                                        # Sample keyframe from nearby in video but not in window
-                                        buffer = 400
-                                        valid_range_start = max(0, window_start - buffer)
-                                        valid_range_end = min(len(latent), window_start + self.window + buffer)
-                                        
-                                        # Exclude the actual window frames
-                                        valid_frames = list(range(valid_range_start, window_start)) + \
-                                                     list(range(window_start + self.window, valid_range_end))
-                                        
-                                        if valid_frames:
-                                            keyframe_idx = random.choice(valid_frames)
-                                            latent_keyframe = latent[keyframe_idx].float().unsqueeze(0)
-                                            self.data_queue.add((latent_slice, latent_keyframe, mouse_slice, button_slice))
-                                    else:
-                                        self.data_queue.add((latent_slice, mouse_slice, button_slice))
-
-                except Exception as e:
-                    print(f"Error processing tar: {e}")
-            else:
-                time.sleep(1)
+                                    if valid_frames:
+                                        keyframe_idx = random.choice(valid_frames)
+                                        latent_keyframe = latent[keyframe_idx].float().unsqueeze(0)
+                                        self.data_queue.add((latent_slice, latent_keyframe, mouse_slice, button_slice))
+                                else:
+                                    self.data_queue.add((latent_slice, mouse_slice, button_slice))
+
+            except Exception as e:
+                print(f"Error processing tar: {e}")
+
+    def queue_stats(self):
+        # Fill level and stall times of both queues, a starved data queue means downloads are the bottleneck
+        return {"tars" : self.tar_queue.stats(), "data" : self.data_queue.stats()}
 
     def __iter__(self):
+        self.start()
         while True:
-            item = self.data_queue.pop()
-            if item is not None:
-                yield item
-            else:
-                time.sleep(0.1)
+            yield self.data_queue.pop()
 
 def collate_fn(batch):
     # batch is list of triples or quads
@@ -194,7 +180,7 @@ def collate_fn(batch):
         buttons = torch.stack(buttons)      # [b,n,n_buttons]
         return latents, keyframes, mouses, buttons
 
-def get_loader(batch_size, **data_kwargs):
+def get_loader(batch_size, num_workers=0, **data_kwargs):
     if dist.is_initialized():
         rank = dist.get_rank()
         world_size = dist.get_world_size()
@@ -203,7 +189,7 @@ def get_loader(batch_size, **data_kwargs):
         world_size = 1
 
     ds = S3CoDLatentDataset(rank=rank, world_size=world_size, **data_kwargs)
-    return DataLoader(ds, batch_size=batch_size, collate_fn=collate_fn)
+    return DataLoader(ds, batch_size=batch_size, collate_fn=collate_fn, num_workers=num_workers)
 
 if __name__ == "__main__":
     import time
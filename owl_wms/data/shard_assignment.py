@@ -0,0 +1,96 @@
+"""
+Deterministic split of tar shards between every (rank, DataLoader worker) pair, so no two
+processes download the same tar and every tar is read once per epoch.
+"""
+
+import random
+
+import torch
+
+def all_tar_keys(total_shards, num_subdirs, num_tars):
+    """
+    Every key of a bucket laid out as <shard>/<subdir>/<tar>.tar
+    """
+    return [
+        f"{shard:02d}/{subdir:04d}/{tar_num:04d}.tar"
+        for shard in range(total_shards)
+        for subdir in range(num_subdirs)
+        for tar_num in range(num_tars)
+    ]
+
+def consumer_id(rank = 0, world_size = 1):
+    """
+    Index of this (rank, worker) among all of them, from torch's worker info
+    :return: (consumer, n_consumers)
+    """
+    info = torch.utils.data.get_worker_info()
+    worker_id, num_workers = (0, 1) if info is None else (info.id, info.num_workers)
+    return rank * num_workers + worker_id, world_size * num_workers
+
+def assign_tars(keys, consumer, n_consumers, epoch = 0, seed = 0):
+    """
+    Tars one consumer reads in an epoch. The keys are shuffled with a seed every consumer
+    agrees on and dealt out round robin, so consumers get disjoint sets that differ in size
+    by at most one and cover every key. With fewer keys than consumers, each gets one
+    key and some keys are shared.
+    """
+    order = sorted(keys)
+    random.Random(seed * 1000003 + epoch).shuffle(order)
+    if len(order) < n_consumers:
+        return [order[consumer % len(order)]]
+    return order[consumer::n_consumers]
+
+def iter_tars(keys, rank = 0, world_size = 1, seed = 0):
+    """
+    Endless stream of this process' tars, a fresh assignment every epoch.
+    Call from inside the worker (i.e. in __iter__) so the worker info is set.
+    """
+    consumer, n_consumers = consumer_id(rank, world_size)
+    epoch = 0
+    while True:
+        yield from assign_tars(keys, consumer, n_consumers, epoch, seed)
+        epoch += 1
+
+def test_assign_tars():
+    keys = all_tar_keys(2, 3, 9)
+    for n_consumers in [1, 4, 7, 54]:
+        for epoch in range(3):
+            parts = [assign_tars(keys, c, n_consumers, epoch) for c in range(n_consumers)]
+            flat = [k for p in parts for k in p]
+            assert sorted(flat) == sorted(keys), f"{n_consumers} consumers don't cover every key exactly once"
+            sizes = [len(p) for p in parts]
+            assert max(sizes) - min(sizes) <= 1, f"Unbalanced assignment {sizes}"
+        assert assign_tars(keys, 0, n_consumers, 0) == assign_tars(keys, 0, n_consumers, 0), "Not deterministic"
+    assert assign_tars(keys, 0, 4, 0) != assign_tars(keys, 0, 4, 1), "Same tars every epoch"
+
+    # More consumers than tars still gives everyone something to read
+    parts = [assign_tars(keys[:3], c, 8) for c in range(8)]
+    assert all(len(p) == 1 for p in parts) and {p[0] for p in parts} == set(keys[:3])
+    print("Tar assignment OK")
+
+def test_iter_tars_workers(num_workers = 3):
+    """
+    Every DataLoader worker on every rank streams its own tars
+    """
+    from torch.utils.data import DataLoader, IterableDataset
+
+    keys = all_tar_keys(1, 1, 12)
+    class Keys(IterableDataset):
+        def __init__(self, rank, world_size):
+            self.rank, self.world_size = rank, world_size
+
+        def __iter__(self):
+            tars = iter_tars(keys, self.rank, self.world_size)
+            for _ in range(len(keys) // (self.world_size * num_workers)):
+                yield next(tars)
+
+    seen = []
+    for rank in range(2):
+        loader = DataLoader(Keys(rank, 2), batch_size = None, num_workers = num_workers)
+        seen += list(loader)
+    assert sorted(seen) == sorted(keys), f"Ranks and workers overlap: {sorted(seen)}"
+    print("Tar assignment across workers OK")
+
+if __name__ == "__main__":
+    test_assign_tars()
+    test_iter_tars_workers()
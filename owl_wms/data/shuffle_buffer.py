@@ -0,0 +1,185 @@
+"""
+Thread safe shuffle buffer between a producer thread and its consumers.
+"""
+
+import random
+import threading
+import time
+
+import torch
+
+def item_nbytes(item):
+    """
+    Bytes held by an item: tensors, bytes or (nested) tuples/lists of them
+    """
+    if isinstance(item, torch.Tensor):
+        return item.nelement() * item.element_size()
+    if isinstance(item, (bytes, bytearray, memoryview)):
+        return len(item)
+    if isinstance(item, (tuple, list)):
+        return sum(item_nbytes(x) for x in item)
+    return 0
+
+class ShuffleBuffer:
+    """
+    Bounded buffer that hands out a uniformly random item on every pop.
+    add and pop are O(1): the popped slot is filled with the last item.
+    Both block on a condition variable, add while the buffer is full and pop while it's empty.
+
+    :param max_items: Most items held at once
+    :param max_bytes: Most bytes held at once (see item_nbytes), None for no limit.
+        An item bigger than this is still accepted when the buffer is empty.
+    :param size_fn: Bytes of an item, defaults to item_nbytes
+    """
+    def __init__(self, max_items = 1000, max_bytes = None, size_fn = item_nbytes):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.size_fn = size_fn
+
+        self.items = []
+        self.sizes = []
+        self.nbytes = 0
+        self.closed = False
+
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+        self.n_added = 0
+        self.n_popped = 0
+        self.producer_stall = 0. # Seconds spent waiting for space
+        self.consumer_stall = 0. # Seconds spent waiting for items
+
+    def __len__(self):
+        return len(self.items)
+
+    def _has_room(self, size):
+        if not self.items:
+            return True
+        if len(self.items) >= self.max_items:
+            return False
+        return self.max_bytes is None or self.nbytes + size <= self.max_bytes
+
+    def add(self, item, timeout = None):
+        """
+        :return: False if the buffer was closed or the timeout ran out, True once added
+        """
+        size = self.size_fn(item)
+        with self.not_full:
+            if not self._has_room(size) and not self.closed:
+                start = time.perf_counter()
+                self.not_full.wait_for(lambda: self.closed or self._has_room(size), timeout)
+                self.producer_stall += time.perf_counter() - start
+            if self.closed or not self._has_room(size):
+                return False
+
+            self.items.append(item)
+            self.sizes.append(size)
+            self.nbytes += size
+            self.n_added += 1
+            self.not_empty.notify()
+            return True
+
+    def pop(self, timeout = None):
+        """
+        :return: A random item, None if the buffer was closed and is empty or the timeout ran out
+        """
+        with self.not_empty:
+            if not self.items and not self.closed:
+                start = time.perf_counter()
+                self.not_empty.wait_for(lambda: self.closed or self.items, timeout)
+                self.consumer_stall += time.perf_counter() - start
+            if not self.items:
+                return None
+
+            idx = random.randrange(len(self.items))
+            self.items[idx], self.items[-1] = self.items[-1], self.items[idx]
+            self.sizes[idx], self.sizes[-1] = self.sizes[-1], self.sizes[idx]
+            item = self.items.pop()
+            self.nbytes -= self.sizes.pop()
+            self.n_popped += 1
+            self.not_full.notify()
+            return item
+
+    def close(self):
+        """
+        Wakes every waiting thread. Adds fail from now on, pops drain what's left.
+        """
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "items" : len(self.items),
+                "bytes" : self.nbytes,
+                "fill" : max(len(self.items) / self.max_items, self.nbytes / self.max_bytes if self.max_bytes else 0.),
+                "added" : self.n_added,
+                "popped" : self.n_popped,
+                "producer_stall_s" : self.producer_stall,
+                "consumer_stall_s" : self.consumer_stall
+            }
+
+def test_shuffle_buffer():
+    buffer = ShuffleBuffer(max_items = 4, max_bytes = 3 * 400)
+    tensor = lambda i: torch.full((100,), float(i)) # 400 bytes
+
+    # The byte limit binds before the item limit
+    assert all(buffer.add(tensor(i), timeout = 0) for i in range(3))
+    assert not buffer.add(tensor(3), timeout = 0.01) and buffer.stats()["producer_stall_s"] > 0
+    assert buffer.stats()["fill"] == 1.0
+    assert sorted(buffer.pop()[0].item() for _ in range(3)) == [0., 1., 2.]
+    assert buffer.pop(timeout = 0.01) is None and buffer.stats()["consumer_stall_s"] > 0
+
+    # Producer and consumers in threads: every item comes out once, in shuffled order
+    buffer = ShuffleBuffer(max_items = 16)
+    n = 2000
+    out = []
+    def produce():
+        for i in range(n):
+            buffer.add(i)
+        buffer.close()
+    def consume():
+        while (item := buffer.pop()) is not None:
+            out.append(item)
+    threads = [threading.Thread(target = produce)] + [threading.Thread(target = consume) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout = 10)
+    assert sorted(out) == list(range(n)), "Items lost or duplicated"
+    assert out != list(range(n)), "Not shuffled"
+    assert not buffer.add(0), "Add after close succeeded"
+    print(buffer.stats())
+    print("Shuffle buffer OK")
+
+def bench_shuffle_buffer(n_ops = 100000):
+    """
+    add + pop on a full buffer, against the list insert/pop at random indices it replaces
+    """
+    for n_items in [1000, 100000]:
+        _bench_shuffle_buffer(n_items, n_ops)
+
+def _bench_shuffle_buffer(n_items, n_ops):
+    items = list(range(n_items))
+    start = time.perf_counter()
+    for i in range(n_ops):
+        items.insert(random.randint(0, len(items)), i)
+        items.pop(random.randint(0, len(items) - 1))
+    list_us = (time.perf_counter() - start) / n_ops * 1.0e6
+
+    buffer = ShuffleBuffer(max_items = n_items + 1)
+    for i in range(n_items):
+        buffer.add(i)
+    start = time.perf_counter()
+    for i in range(n_ops):
+        buffer.add(i)
+        buffer.pop()
+    buffer_us = (time.perf_counter() - start) / n_ops * 1.0e6
+    print(f"  random insert/pop list {list_us:.2f}us, shuffle buffer {buffer_us:.2f}us per add + pop ({n_items} items)")
+
+if __name__ == "__main__":
+    test_shuffle_buffer()
+    bench_shuffle_buffer()
@@ -27,12 +27,14 @@ class GameRFTCore(nn.Module):
         self.proj_out = FinalLayer(config.sample_size, config.d_model, config.channels)
 
         self.pos_enc = LearnedPosEnc(config.tokens_per_frame * config.n_frames, config.d_model)
+        self.config = config
 
-    def forward(self, x, t, mouse, btn):
+    def forward(self, x, t, mouse, btn, kv_cache = None):
         # x is [b,n,c,h,w]
         # t is [b,n]
         # mouse is [b,n,2]
         # btn is [b,n,n_buttons]
+        # kv_cache holds earlier frames of the window (causal models only), x are the frames after them
 
         ctrl_cond = self.control_embed(mouse, btn)
         t_cond = self.t_embed(t)
@@ -43,8 +45,12 @@ class GameRFTCore(nn.Module):
         x = eo.rearrange(x, 'b n c h w -> b (n h w) c')
 
         x = self.proj_in(x)
-        x = self.pos_enc(x)
-        x = self.transformer(x, cond)
+        if kv_cache is not None:
+            # Positions continue from the cached frames
+            x = self.pos_enc(x, min(len(kv_cache), self.pos_enc.n_seq - x.shape[1]))
+        else:
+            x = self.pos_enc(x)
+        x = self.transformer(x, cond, kv_cache)
         x = self.proj_out(x, cond) # -> [b,n*hw,c]
         x = eo.rearrange(x, 'b (n h w) c -> b n c h w', n=n,h=h,w=w)
 
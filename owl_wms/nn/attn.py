@@ -9,26 +9,13 @@ import einops as eo
 
 from .modulation import AdaLN, Gate
 from .rope import FlatVideoRoPE
-
-torch.backends.cuda.enable_flash_sdp(enabled = True)
+from .masks import get_block_causal_mask
+from .attn_backends import get_attn_fn
+from .kv_cache import prefix_attention
 
 from einops._torch_specific import allow_ops_in_compiled_graph
 allow_ops_in_compiled_graph()
 
-def create_block_causal_mask(tokens, tokens_per_frame):
-    frames = tokens // tokens_per_frame
-    
-    # Create base causal mask, nothing is masked
-    mask = torch.zeros(tokens, tokens)
-    
-    # Allow attention within each frame
-    for i in range(frames):
-        start = i * tokens_per_frame
-        end = (i + 1) * tokens_per_frame
-        mask[start:end, end:] = True # It can't see anything after its end
-        
-    return mask
-
 class Attn(nn.Module):
     def __init__(self, config : 'TransformerConfig'):
         super().__init__()
@@ -45,37 +32,33 @@ class Attn(nn.Module):
 
         self.tokens_per_frame = config.tokens_per_frame
         self.causal = config.causal
+        self.attn_fn = get_attn_fn(config.attn_backend, **(config.attn_backend_kwargs or {}))
 
     def forward(self, x, kv_cache = None):
         q,k,v = eo.rearrange(self.qkv(x), 'b n (three h d) -> three b h n d', three = 3, h = self.n_heads)
         q,k = self.qk_norm(q,k)
 
-        if not self.causal or (kv_cache is not None and len(kv_cache) > 0):
-            mask = None
-        else:
-            mask = create_block_causal_mask(x.shape[1], self.tokens_per_frame).to(x.device)
-            mask = mask.to(device=x.device,dtype=x.dtype)
-            mask = mask.unsqueeze(0).repeat(x.shape[0], 1, 1)
-            mask = mask.unsqueeze(1)
+        tokens_per_frame = self.tokens_per_frame if self.causal else None # None -> no mask
 
         if kv_cache is not None:
-            old_k, old_v = kv_cache.get(self.layer_ind)
-
-            len_k = old_k.shape[2]
-
-            new_k = torch.cat([old_k, k], dim = 2).contiguous()
-            new_v = torch.cat([old_v, v], dim = 2).contiguous()
-            
-            q,new_k = self.rope(q,new_k)
-            if kv_cache.should_update:
-                kv_cache.update(new_k, new_v, self.layer_ind)
-
-            # Add rope here if we do use it
-            x = F.scaled_dot_product_attention(q, new_k, new_v, attn_mask = mask)
+            # Cached keys are already rotated, only rotate the new tokens at their absolute position
+            offset = kv_cache.get_offset(self.layer_ind)
+            q = self.rope.rotate(q, offset)
+            k = self.rope.rotate(k, offset)
+
+            # Cache + new tokens, committed to the cache if updates are on
+            prefix, new_k, new_v = kv_cache.extend_split(k, v, self.layer_ind)
+            if prefix is not None:
+                # Forked cache, the shared history is read in place (new tokens see the whole cache)
+                x = prefix_attention(q, *prefix, new_k, new_v)
+            else:
+                if new_k.shape[2] > k.shape[2]:
+                    tokens_per_frame = None # New tokens see the whole cache
+                x = self.attn_fn(q, new_k, new_v, tokens_per_frame)
             x = x[:,:,-q.shape[2]:] # Skip cached outputs (not relevant now)
         else:
             q,k = self.rope(q,k)
-            x = F.scaled_dot_product_attention(q,k,v, attn_mask = mask)
+            x = self.attn_fn(q, k, v, tokens_per_frame)
 
         x = eo.rearrange(x, 'b h n d -> b n (h d)')
         x = self.out(x)
@@ -195,7 +178,7 @@ def test_attn_mask():
     tokens_per_frame = 8
 
     # Block causal mask
-    mask = create_block_causal_mask(total_tokens, tokens_per_frame)
+    mask = get_block_causal_mask(total_tokens, tokens_per_frame)[0,0]
     import matplotlib.pyplot as plt
 
     plt.figure(figsize=(10,10))
@@ -247,5 +230,139 @@ def test_kv_cache():
     print("Max difference between outputs:", torch.max(torch.abs(out1 - out2)).item())
     print("Cache test complete")
 
+@torch.no_grad()
+def test_kv_cache_parity():
+    """
+    Frame by frame decoding with a KV cache should match a single causal forward
+    """
+    from .kv_cache import KVCache
+    from ..configs import TransformerConfig
+
+    config = TransformerConfig(
+        n_layers=2,
+        n_heads=4,
+        d_model=64,
+        tokens_per_frame=8,
+        n_frames=6,
+        causal=True
+    )
+    m = config.tokens_per_frame
+    n = config.n_frames
+
+    model = DiT(config).eval()
+    x = torch.randn(2, n*m, config.d_model)
+    cond = torch.randn(2, n, config.d_model)
+
+    ref = model(x, cond)
+
+    cache = KVCache(config).to('cpu', torch.float32)
+    cache.reset(2)
+    cache.enable_cache_updates()
+
+    # Prefill half the frames, then add the rest one at a time
+    outs = [model(x[:,:3*m], cond[:,:3], cache)]
+    for i in range(3, n):
+        outs.append(model(x[:,i*m:(i+1)*m], cond[:,i:i+1], cache))
+    out = torch.cat(outs, dim = 1)
+
+    err = (out - ref).abs().max().item()
+    assert err < 1.0e-4, f"Cached output differs from uncached by {err}"
+
+    # Rolling cache past the RoPE table: a single layer only depends on the frames in the cache
+    config.n_layers = 1
+    model = DiT(config).eval()
+    cache = KVCache(config).to('cpu', torch.float32)
+    cache.reset(2)
+    cache.enable_cache_updates()
+
+    total = 3 * n
+    x = torch.randn(2, total*m, config.d_model)
+    cond = torch.randn(2, total, config.d_model)
+    for i in range(total):
+        # Uncommitted (denoising step) and committing passes should see the same window
+        cache.disable_cache_updates()
+        staged = model(x[:,i*m:(i+1)*m], cond[:,i:i+1], cache)
+        cache.enable_cache_updates()
+        out = model(x[:,i*m:(i+1)*m], cond[:,i:i+1], cache)
+        assert (staged - out).abs().max().item() < 1.0e-4, "Staged and committed outputs differ"
+
+    window_ref = model(x[:,-n*m:], cond[:,-n:])[:,-m:]
+    err = (out - window_ref).abs().max().item()
+    assert err < 1.0e-4, f"Rolling cache output differs from windowed forward by {err}"
+    print("KV cache parity OK")
+
+@torch.no_grad()
+def test_kv_cache_fork():
+    """
+    Branches from fork() and from snapshot()/restore() should match running each branch on its own
+    """
+    from .kv_cache import KVCache, QuantizedKVCache
+    from ..configs import TransformerConfig
+
+    config = TransformerConfig(
+        n_layers=2,
+        n_heads=4,
+        d_model=64,
+        tokens_per_frame=8,
+        n_frames=4,
+        causal=True
+    )
+    m = config.tokens_per_frame
+    n_branches = 3
+    n_steps = 6 # Past the window so the shared prefix gets evicted
+
+    model = DiT(config).eval()
+    history = torch.randn(1, 3*m, config.d_model)
+    history_cond = torch.randn(1, 3, config.d_model)
+    x = torch.randn(n_branches, n_steps*m, config.d_model)
+    cond = torch.randn(n_branches, n_steps, config.d_model)
+
+    for cache_cls in [KVCache, QuantizedKVCache]:
+        cache = cache_cls(config).to('cpu', torch.float32)
+        cache.reset(1)
+        cache.enable_cache_updates()
+        model(history, history_cond, cache)
+
+        def rollout(x, cond):
+            outs = []
+            for i in range(n_steps):
+                cache.disable_cache_updates()
+                model(x[:,i*m:(i+1)*m], cond[:,i:i+1], cache)
+                cache.enable_cache_updates()
+                outs.append(model(x[:,i*m:(i+1)*m], cond[:,i:i+1], cache))
+            return torch.cat(outs, dim = 1)
+
+        # Each branch on its own, going back to the history in between
+        snap = cache.snapshot()
+        ref = []
+        for j in range(n_branches):
+            cache.restore(snap)
+            ref.append(rollout(x[j:j+1], cond[j:j+1]))
+        ref = torch.cat(ref)
+
+        cache.restore(snap)
+        assert len(cache) == 3*m, "Restore didn't bring back the history"
+
+        unforked_bytes = cache.memory_bytes()
+        cache.fork(n_branches)
+        # One prefix for all branches and a frame of storage per branch, not n_branches full caches
+        assert cache.memory_bytes() < n_branches * unforked_bytes / 2, f"{cache_cls.__name__}: fork allocated a full cache per branch"
+        out = rollout(x, cond)
+
+        err = (out - ref).abs().max().item()
+        assert err < 1.0e-4, f"{cache_cls.__name__}: forked rollout differs from separate branches by {err}"
+
+    # Shared prefix over several batch elements against attending to it copied per branch
+    from .kv_cache import prefix_attention
+    b, n = 2, 3
+    q, k, v = (torch.randn(b*n, 4, 8, 16) for _ in range(3))
+    prefix_k, prefix_v = torch.randn(b, 4, 24, 16), torch.randn(b, 4, 24, 16)
+    ref = F.scaled_dot_product_attention(
+        q, torch.cat([prefix_k.repeat_interleave(n, 0), k], dim = 2), torch.cat([prefix_v.repeat_interleave(n, 0), v], dim = 2)
+    )
+    err = (prefix_attention(q, prefix_k, prefix_v, k, v) - ref).abs().max().item()
+    assert err < 1.0e-5, f"prefix_attention differs from attention over the expanded prefix by {err}"
+    print("KV cache fork OK")
+
 if __name__ == "__main__":
     test_attn_mask()
@@ -0,0 +1,256 @@
+"""
+Attention kernels that can be swapped in for Attn/MMAttn.
+
+Every kernel takes q,k,v as [b,h,n,d]. When tokens_per_frame is given the
+kernel applies the block causal layout from masks.py (frames, then
+context_tokens trailing context tokens), otherwise attention is full.
+
+Pick one with TransformerConfig.attn_backend (and attn_backend_kwargs).
+"""
+
+from functools import lru_cache, partial
+
+import torch
+import torch.nn.functional as F
+from torch.nn.attention import sdpa_kernel, SDPBackend
+
+from .masks import get_block_causal_mask
+
+try:
+    from torch.nn.attention.flex_attention import flex_attention, create_block_mask
+except ImportError:
+    flex_attention = None
+    create_block_mask = None
+
+def sdpa(q, k, v, tokens_per_frame = None, context_tokens = 0):
+    """
+    Dense attention with an explicit mask, PyTorch picks the kernel
+    """
+    mask = None
+    if tokens_per_frame is not None:
+        mask = get_block_causal_mask(q.shape[2] - context_tokens, tokens_per_frame, context_tokens, device = q.device)
+    return F.scaled_dot_product_attention(q, k, v, attn_mask = mask)
+
+def sdpa_math(q, k, v, tokens_per_frame = None, context_tokens = 0):
+    with sdpa_kernel(SDPBackend.MATH):
+        return sdpa(q, k, v, tokens_per_frame, context_tokens)
+
+def sdpa_efficient(q, k, v, tokens_per_frame = None, context_tokens = 0):
+    # Math is kept as a fallback for devices without the memory-efficient kernel (i.e. CPU)
+    with sdpa_kernel([SDPBackend.EFFICIENT_ATTENTION, SDPBackend.MATH]):
+        return sdpa(q, k, v, tokens_per_frame, context_tokens)
+
+def query_chunked(q, k, v, tokens_per_frame = None, context_tokens = 0, chunk_size = 256):
+    """
+    Dense attention over chunk_size queries at a time, bounds the size of the score matrix.
+    """
+    mask = None
+    if tokens_per_frame is not None:
+        mask = get_block_causal_mask(q.shape[2] - context_tokens, tokens_per_frame, context_tokens, device = q.device)
+
+    out = []
+    for start in range(0, q.shape[2], chunk_size):
+        end = start + chunk_size
+        chunk_mask = mask[:,:,start:end] if mask is not None else None
+        out.append(F.scaled_dot_product_attention(q[:,:,start:end], k, v, attn_mask = chunk_mask))
+    return torch.cat(out, dim = 2)
+
+@lru_cache(maxsize = 32)
+def _get_flex_block_mask(tokens, tokens_per_frame, context_tokens, device):
+    def mask_mod(b, h, q_idx, kv_idx):
+        q_ctx = q_idx >= tokens
+        kv_ctx = kv_idx >= tokens
+        same_or_past = (q_idx // tokens_per_frame) >= (kv_idx // tokens_per_frame)
+        return kv_ctx | (~q_ctx & same_or_past)
+
+    total_tokens = tokens + context_tokens
+    return create_block_mask(mask_mod, B = None, H = None, Q_LEN = total_tokens, KV_LEN = total_tokens, device = device)
+
+_compiled_flex_attention = None
+
+def _flex_block_causal(q, k, v, tokens_per_frame, context_tokens):
+    global _compiled_flex_attention
+    if _compiled_flex_attention is None:
+        _compiled_flex_attention = torch.compile(flex_attention, dynamic = False)
+
+    block_mask = _get_flex_block_mask(q.shape[2] - context_tokens, tokens_per_frame, context_tokens, str(q.device))
+    return _compiled_flex_attention(q, k, v, block_mask = block_mask)
+
+def _chunked_block_causal(q, k, v, tokens_per_frame, context_tokens):
+    # Each query frame only attends to the key prefix it can see, fully masked tiles are never computed.
+    # Context keys are moved to the front so "context + frames up to i" is a contiguous prefix.
+    tokens = q.shape[2] - context_tokens
+    m = tokens_per_frame
+
+    if context_tokens > 0:
+        k_ctx, v_ctx = k[:,:,tokens:], v[:,:,tokens:]
+        k = torch.cat([k_ctx, k[:,:,:tokens]], dim = 2)
+        v = torch.cat([v_ctx, v[:,:,:tokens]], dim = 2)
+
+    out = []
+    for start in range(0, tokens, m):
+        end = start + m
+        out.append(F.scaled_dot_product_attention(
+            q[:,:,start:end],
+            k[:,:,:context_tokens + end],
+            v[:,:,:context_tokens + end]
+        ))
+
+    if context_tokens > 0:
+        # Context only sees context
+        out.append(F.scaled_dot_product_attention(q[:,:,tokens:], k_ctx, v_ctx))
+
+    return torch.cat(out, dim = 2)
+
+def block_sparse(q, k, v, tokens_per_frame = None, context_tokens = 0):
+    """
+    Block causal attention that skips fully masked (query frame, key frame) tiles.
+    Uses FlexAttention on GPU when available, otherwise a frame-chunked SDPA loop.
+    """
+    if tokens_per_frame is None:
+        return F.scaled_dot_product_attention(q, k, v)
+
+    if flex_attention is not None and q.is_cuda:
+        return _flex_block_causal(q, k, v, tokens_per_frame, context_tokens)
+    return _chunked_block_causal(q, k, v, tokens_per_frame, context_tokens)
+
+def sliding_window(q, k, v, tokens_per_frame = None, context_tokens = 0, window_frames = 16):
+    """
+    Block causal attention where each frame only sees the last window_frames frames.
+    Without a frame layout (non-causal models, cached decoding) attention is full,
+    in the cached case the window is set by the KV cache length instead.
+    """
+    if tokens_per_frame is None:
+        return F.scaled_dot_product_attention(q, k, v)
+
+    mask = get_block_causal_mask(
+        q.shape[2] - context_tokens, tokens_per_frame, context_tokens,
+        device = q.device, window_frames = window_frames
+    )
+    return F.scaled_dot_product_attention(q, k, v, attn_mask = mask)
+
+ATTN_BACKENDS = {
+    "sdpa" : sdpa,
+    "sdpa_math" : sdpa_math,
+    "sdpa_efficient" : sdpa_efficient,
+    "chunked" : query_chunked,
+    "block_sparse" : block_sparse,
+    "sliding_window" : sliding_window
+}
+
+def get_attn_fn(backend_id, **backend_kwargs):
+    if backend_id not in ATTN_BACKENDS:
+        raise ValueError(f"Unknown attention backend {backend_id}, options are {list(ATTN_BACKENDS)}")
+
+    fn = ATTN_BACKENDS[backend_id]
+    if backend_kwargs:
+        fn = partial(fn, **backend_kwargs)
+    return fn
+
+@torch.no_grad()
+def test_block_sparse_parity():
+    for n_frames, tpf, ctx in [(6, 16, 0), (60, 17, 0), (4, 16, 16)]:
+        q,k,v = torch.randn(3, 2, 4, n_frames * tpf + ctx, 32).unbind(0)
+
+        dense = sdpa(q, k, v, tpf, ctx)
+        sparse = _chunked_block_causal(q, k, v, tpf, ctx)
+        err = (dense - sparse).abs().max().item()
+        assert err < 1.0e-5, f"Chunked mismatch {err} for {n_frames}x{tpf}+{ctx}"
+
+        if flex_attention is not None and torch.cuda.is_available():
+            q,k,v = q.cuda(), k.cuda(), v.cuda()
+            err = (sdpa(q, k, v, tpf, ctx) - _flex_block_causal(q, k, v, tpf, ctx)).abs().max().item()
+            assert err < 1.0e-3, f"Flex mismatch {err} for {n_frames}x{tpf}+{ctx}"
+    print("Block sparse parity OK")
+
+@torch.no_grad()
+def test_exact_backends():
+    # Every backend except sliding_window should match dense attention exactly
+    q,k,v = torch.randn(3, 2, 4, 8 * 16 + 16, 32).unbind(0)
+    for tpf in [None, 16]:
+        ref = sdpa(q, k, v, tpf, 16)
+        for backend_id, fn in ATTN_BACKENDS.items():
+            if backend_id == "sliding_window":
+                continue
+            err = (fn(q, k, v, tpf, 16) - ref).abs().max().item()
+            assert err < 1.0e-5, f"{backend_id} mismatch {err}"
+
+    # With a window covering every frame the sliding window is just block causal
+    err = (sliding_window(q, k, v, 16, 16, window_frames = 8) - sdpa(q, k, v, 16, 16)).abs().max().item()
+    assert err < 1.0e-5, f"sliding_window mismatch {err}"
+    print("Backend parity OK")
+
+def _peak_cpu_mb(fn):
+    # Peak RSS growth while running fn, uses VmHWM which we can reset through clear_refs (Linux only)
+    import re
+
+    def hwm_kb():
+        with open('/proc/self/status') as f:
+            return int(re.search(r'VmHWM:\s+(\d+)', f.read()).group(1))
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        base = hwm_kb()
+    except OSError:
+        fn()
+        return float('nan')
+
+    fn()
+    return (hwm_kb() - base) / 1024
+
+@torch.no_grad()
+def bench_backends(config_glob = "configs/*.yml", batch_size = 1, max_heads = 4, n_iters = 5):
+    """
+    Runs every backend with the block causal layout over each model config.
+    Shapes use the real tokens_per_frame/n_frames/head_dim with heads capped at max_heads
+    so this stays CPU sized. Reports mean latency and peak memory.
+    """
+    import glob
+    import time
+
+    from ..configs import Config
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    dtype = torch.bfloat16 if device == 'cuda' else torch.float32
+
+    def sync():
+        if device == 'cuda':
+            torch.cuda.synchronize()
+
+    for path in sorted(glob.glob(config_glob)):
+        cfg = Config.from_yaml(path).model
+        n_heads = min(cfg.n_heads, max_heads)
+        d_head = cfg.d_model // cfg.n_heads
+        tpf = cfg.tokens_per_frame
+        n_tokens = tpf * cfg.n_frames
+
+        q,k,v = torch.randn(3, batch_size, n_heads, n_tokens, d_head, device = device, dtype = dtype).unbind(0)
+        print(f"{path}: [{batch_size},{n_heads},{n_tokens},{d_head}] ({cfg.n_frames} frames x {tpf} tokens), {device}")
+
+        for backend_id, fn in ATTN_BACKENDS.items():
+            run = lambda: fn(q, k, v, tpf)
+            run() # warmup (mask cache, compile)
+            sync()
+
+            start = time.perf_counter()
+            for _ in range(n_iters):
+                run()
+            sync()
+            latency = (time.perf_counter() - start) / n_iters
+
+            if device == 'cuda':
+                torch.cuda.reset_peak_memory_stats()
+                base = torch.cuda.memory_allocated()
+                run()
+                sync()
+                peak = (torch.cuda.max_memory_allocated() - base) / 2**20
+            else:
+                peak = _peak_cpu_mb(run)
+
+            print(f"  {backend_id:<16} {latency*1000:8.2f}ms  {peak:8.1f}MiB peak")
+
+if __name__ == "__main__":
+    test_block_sparse_parity()
+    test_exact_backends()
+    bench_backends()
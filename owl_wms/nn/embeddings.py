@@ -20,9 +20,12 @@ class LearnedPosEnc(nn.Module):
         self.n_seq = n_seq
         self.p = nn.Parameter(torch.randn(n_seq,dim)*0.02)
 
-    def forward(self, x):
+    def forward(self, x, offset = None):
         b,n,d = x.shape
-        if n < self.n_seq:
+        if offset is not None:
+            # Explicit positions (i.e. tokens following a KV cache)
+            p = eo.repeat(self.p[offset:offset+n], 'n d -> b n d', b=b)
+        elif n < self.n_seq:
             # Only add positional embeddings for the last n tokens
             p = eo.repeat(self.p[-n:], 'n d -> b n d', b=b)
         else:
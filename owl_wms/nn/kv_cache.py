@@ -3,23 +3,88 @@ from torch import nn
 
 from ..configs import TransformerConfig
 
+def prefix_attention(q, prefix_k, prefix_v, k, v):
+    """
+    Attention of q [b*n,h,m,d] over a prefix [b,h,p,d] shared by the n branches of each batch element
+    (see KVCache.fork) followed by per branch keys/values [b*n,h,t,d], without expanding the prefix.
+    No mask, every query sees every key.
+    """
+    B,h,m,d = q.shape
+    b,_,p,_ = prefix_k.shape
+    n = B // b
+
+    def fold(x):
+        # [b*n,h,m,x] -> [b,h,n*m,x], so a plain batched matmul shares the prefix between branches
+        return x.view(b, n, h, m, -1).transpose(1, 2).reshape(b, h, n * m, -1)
+    def unfold(x):
+        return x.view(b, h, n, m, -1).transpose(1, 2).reshape(B, h, m, -1)
+
+    q = q * d ** -0.5
+    scores = torch.cat([unfold(fold(q) @ prefix_k.transpose(-1, -2)), q @ k.transpose(-1, -2)], dim = -1)
+    probs = scores.float().softmax(dim = -1).to(q.dtype)
+    return unfold(fold(probs[...,:p]) @ prefix_v) + probs[...,p:] @ v
+
 class KVCache:
-    def __init__(self, config : TransformerConfig):
+    """
+    Preallocated KV cache. Each layer's storage is [2, batch, heads, max_length + slack, head_dim]
+    with slack_frames frames of slack, allocated once in reset. The valid tokens are always one
+    contiguous region [start, start + length), so every read is a view. New tokens are written
+    right after it and the oldest are evicted by moving start. Once the region reaches the end of
+    the storage it is copied back to the front, which happens once every slack_frames frames.
+
+    New tokens attend to at most max_length tokens (cache + themselves), same as
+    the number of frames the model was trained on.
+
+    Rollouts can be branched: snapshot()/restore() save and go back to a state without
+    copying anything up front (storage is copied on the next write), fork(n) splits every
+    batch element into n branches that share the cached history as a read-only prefix.
+    Each branch only stores what it pushed since the fork, in storage that starts at one
+    frame and doubles as needed. Attention reads the prefix in place through
+    extend_split() and prefix_attention().
+
+    :param slack_frames: Frames of storage past max_length, trading memory for fewer compactions.
+        At least one so a frame can be staged on a full cache without growing the storage.
+    """
+    # Storage captured by snapshots and per layer prefix state (lists with one entry per layer)
+    _storage_attrs = ('cache',)
+    _prefix_attrs = ('prefixes',)
+
+    def __init__(self, config : TransformerConfig, slack_frames = 4):
+        assert slack_frames >= 1, "slack_frames must be at least 1"
         self.shape = None
         self.config = config
 
         self.cache = None
         self.device = 'cuda'
         self.dtype = torch.bfloat16
-        
+
         self.should_update = False
 
         self.max_length = config.tokens_per_frame * config.n_frames
+        self.storage_length = self.max_length + slack_frames * config.tokens_per_frame
         self.noise_caches = 0.0
 
+        # Valid region per layer (python ints so reading them never syncs)
+        self.starts = None
+        self.lengths = None
+
+        # Absolute position (in tokens) of the next token for each layer, used for RoPE.
+        # Keys are stored already rotated so this never goes back down on truncation.
+        self.offsets = None
+
+        # Per layer [2,b,h,n,d] tokens older than the storage (shared history after fork), or None.
+        # Storage batch is b * n_branches, branches of an element are consecutive.
+        self.prefixes = None
+        self.n_branches = 1
+
+        self._storage_key = None
+
+        # Storage is also referenced by a snapshot and must be copied before writing to it
+        self._shared = False
+
     def enable_cache_updates(self):
         self.should_update = True
-    
+
     def disable_cache_updates(self):
         self.should_update = False
 
@@ -29,55 +94,604 @@ class KVCache:
         return self
 
     def reset(self, batch_size = 1):
+        storage_key = (batch_size, torch.device(self.device), self.dtype, self.storage_length)
+        if self.cache is None or self._storage_key != storage_key or self._shared:
+            self._allocate(batch_size)
+            self._storage_key = storage_key
+            self._shared = False
+
         self.shape = (batch_size, self.config.n_heads, 0, self.config.d_model//self.config.n_heads)
-        dummy = torch.empty(*self.shape, device = self.device, dtype = self.dtype)
-        self.cache = [(torch.empty_like(dummy), torch.empty_like(dummy)) for _ in range(self.config.n_layers)]
+        self.starts = [0] * self.config.n_layers
+        self.lengths = [0] * self.config.n_layers
+        self.offsets = [0] * self.config.n_layers
+        for attr in self._prefix_attrs:
+            setattr(self, attr, [None] * self.config.n_layers)
+        self.n_branches = 1
+
+    def _storage_shape(self, batch_size, capacity):
+        return (2, batch_size, self.config.n_heads, capacity, self.config.d_model//self.config.n_heads)
+
+    def _allocate(self, batch_size, capacity = None):
+        shape = self._storage_shape(batch_size, capacity or self.storage_length)
+        self.cache = [torch.empty(*shape, device = self.device, dtype = self.dtype) for _ in range(self.config.n_layers)]
+
+    def _clone_storage(self):
+        self.cache = [t.clone() for t in self.cache]
+
+    def _ensure_writable(self):
+        # Copy-on-write for storage shared with a snapshot
+        if self._shared:
+            self._clone_storage()
+            self._shared = False
+
+    def memory_bytes(self):
+        """
+        Bytes held by the cache storage and shared prefixes
+        """
+        assert self.cache is not None, "Must reset cache before using"
+        return sum(t.numel() * t.element_size() for t in self.cache + self.prefixes if t is not None)
+
+    def get_offset(self, layer_ind):
+        assert self.offsets is not None, "Must reset cache before using"
+        return self.offsets[layer_ind]
+
+    def _prefix_len(self, layer_ind):
+        prefix = self.prefixes[layer_ind]
+        return 0 if prefix is None else prefix.shape[3]
+
+    def _total_len(self, layer_ind):
+        return self._prefix_len(layer_ind) + self.lengths[layer_ind]
+
+    def _drop_prefix(self, layer_ind, amt):
+        # Evict the oldest amt tokens of the prefix
+        if amt >= self._prefix_len(layer_ind):
+            self.prefixes[layer_ind] = None
+        elif amt > 0:
+            self.prefixes[layer_ind] = self.prefixes[layer_ind][:,:,:,amt:]
+
+    def _capacity(self, layer_ind):
+        return self.cache[layer_ind].shape[3]
+
+    def _move(self, buf, start, length, capacity, scale = 1):
+        # Tokens [start, start+length) of buf (token dim 3, scale tokens per entry) moved to
+        # the front of a buffer of capacity tokens, buf itself if it's the same size
+        s, e = start // scale, (start + length) // scale
+        if capacity == buf.shape[3] * scale:
+            src = buf[:,:,:,s:e]
+            if s < e - s:
+                src = src.clone() # Overlaps the destination
+            buf[:,:,:,:e-s].copy_(src)
+            return buf
+        new = buf.new_empty(*buf.shape[:3], capacity // scale, *buf.shape[4:])
+        new[:,:,:,:e-s].copy_(buf[:,:,:,s:e])
+        return new
+
+    def _resize(self, layer_ind, capacity):
+        # Move the valid region to the front of storage with the given capacity
+        self.cache[layer_ind] = self._move(self.cache[layer_ind], self.starts[layer_ind], self.lengths[layer_ind], capacity)
+        self.starts[layer_ind] = 0
+
+    def _reserve(self, layer_ind, n):
+        # Make room for n tokens right after the valid region. Storage smaller than storage_length
+        # (branches after a fork) doubles when it's over half full, otherwise the region is compacted.
+        capacity = self._capacity(layer_ind)
+        length = self.lengths[layer_ind]
+        if self.starts[layer_ind] + length + n <= capacity:
+            return
+        if capacity < self.storage_length and length + n > capacity // 2:
+            capacity = min(self.storage_length, max(2 * capacity, length + n))
+        # Only staging more than the slack on a full cache needs more, the storage grows to fit
+        self._resize(layer_ind, max(capacity, length + n))
+
+    def _write_slice(self, layer_ind, k, v, pos):
+        # Write k,v [b,h,n,d] to storage slots [pos, pos+n)
+        n = k.shape[2]
+        self.cache[layer_ind][0,:,:,pos:pos+n].copy_(k)
+        self.cache[layer_ind][1,:,:,pos:pos+n].copy_(v)
+
+    def _read_slice(self, layer_ind, start, end):
+        # Storage slots [start, end) as [2,b,h,n,d]. Storage is already in the right
+        # format so this is a view, subclasses may return a copy instead.
+        return self.cache[layer_ind][:,:,:,start:end]
+
+    def _read_split(self, layer_ind, length, extra = 0):
+        """
+        Last length valid tokens of a layer followed by extra tokens staged after them, as
+        (shared prefix [2,b,h,p,d] or None, storage [2,b*n_branches,h,length+extra-p,d]).
+        Both are views, nothing is copied.
+        """
+        end = self.starts[layer_ind] + self.lengths[layer_ind] + extra
+        n_stored = min(length, self.lengths[layer_ind])
+        tail = self._read_slice(layer_ind, end - n_stored - extra, end)
+        n_prefix = length - n_stored
+        prefix = self.prefixes[layer_ind][:,:,:,-n_prefix:] if n_prefix > 0 else None
+        return prefix, tail
+
+    def _read(self, layer_ind, length, extra = 0):
+        # Same as _read_split with the prefix broadcast over the branches, copies if there's a prefix
+        prefix, tail = self._read_split(layer_ind, length, extra)
+        if prefix is None:
+            return tail
+        return torch.cat([prefix.repeat_interleave(self.n_branches, dim = 1), tail], dim = 3)
 
     @torch.no_grad()
     def get(self, layer_ind):
         assert self.cache is not None, "Must reset cache before using"
-        k,v = self.cache[layer_ind]
+        kv = self._read(layer_ind, self._total_len(layer_ind))
+        k,v = kv[0], kv[1]
         if self.noise_caches > 0.0:
             k = k + torch.randn_like(k) * self.noise_caches
             v = v + torch.randn_like(v) * self.noise_caches
         return k,v
-    
+
     @torch.no_grad()
     def push(self, new_k, new_v, layer_ind):
         assert self.cache is not None, "Must reset cache before using"
-        k,v = self.cache[layer_ind] # each [b,h,n,d]
-        k = torch.cat([k,new_k],dim=2)
-        v = torch.cat([v,new_v],dim=2)
-        self.cache[layer_ind] = (k,v)
-    
+        self._ensure_writable()
+        n = new_k.shape[2]
+        self.offsets[layer_ind] += n
+
+        if n >= self.max_length:
+            # Only the most recent max_length tokens survive
+            self._drop_prefix(layer_ind, self._prefix_len(layer_ind))
+            self.starts[layer_ind] = 0
+            self.lengths[layer_ind] = 0
+            self._reserve(layer_ind, self.max_length)
+            self._write_slice(layer_ind, new_k[:,:,-self.max_length:], new_v[:,:,-self.max_length:], 0)
+            self.lengths[layer_ind] = self.max_length
+            return
+
+        # Evict what the new tokens push out before making room for them (prefix first),
+        # so a push always fits in the slack
+        excess = self._total_len(layer_ind) + n - self.max_length
+        if excess > 0:
+            from_prefix = min(excess, self._prefix_len(layer_ind))
+            self._drop_prefix(layer_ind, from_prefix)
+            self.starts[layer_ind] += excess - from_prefix
+            self.lengths[layer_ind] -= excess - from_prefix
+
+        self._reserve(layer_ind, n)
+        self._write_slice(layer_ind, new_k, new_v, self.starts[layer_ind] + self.lengths[layer_ind])
+        self.lengths[layer_ind] += n
+
+    @torch.no_grad()
+    def extend(self, new_k, new_v, layer_ind):
+        """
+        Keys/values new tokens should attend to: the most recent cached tokens followed by new_k/new_v,
+        at most max_length in total. new_k/new_v are committed to the cache if updates are enabled.
+        After a fork this copies the shared prefix for every branch, see extend_split.
+        """
+        prefix, k, v = self.extend_split(new_k, new_v, layer_ind)
+        if prefix is None:
+            return k, v
+        prefix_k, prefix_v = (t.repeat_interleave(self.n_branches, dim = 0) for t in prefix)
+        return torch.cat([prefix_k, k], dim = 2), torch.cat([prefix_v, v], dim = 2)
+
+    @torch.no_grad()
+    def extend_split(self, new_k, new_v, layer_ind):
+        """
+        Same as extend, with the keys/values split into the prefix shared by the branches of a fork
+        and the per branch part. Neither is copied, attend to both with prefix_attention.
+
+        :return: ((prefix_k, prefix_v) [b,h,p,d] each or None, k [b*n_branches,h,n,d], v)
+        """
+        assert self.cache is not None, "Must reset cache before using"
+        n = new_k.shape[2]
+        length = self._total_len(layer_ind)
+
+        if length == 0:
+            if self.should_update:
+                self.push(new_k, new_v, layer_ind)
+            return None, new_k, new_v
+
+        assert n < self.max_length, "Can't extend a non-empty cache by more than max_length tokens"
+
+        if self.noise_caches > 0.0:
+            old_k, old_v = self.get(layer_ind)
+            keep = min(length, self.max_length - n)
+            if self.should_update:
+                self.push(new_k, new_v, layer_ind)
+            return None, torch.cat([old_k[:,:,-keep:], new_k], dim = 2), torch.cat([old_v[:,:,-keep:], new_v], dim = 2)
+
+        if self.should_update:
+            self.push(new_k, new_v, layer_ind)
+            prefix, kv = self._read_split(layer_ind, self._total_len(layer_ind))
+        else:
+            # Stage the new tokens after the valid region without committing them
+            self._ensure_writable()
+            self._reserve(layer_ind, n)
+            self._write_slice(layer_ind, new_k, new_v, self.starts[layer_ind] + self.lengths[layer_ind])
+            prefix, kv = self._read_split(layer_ind, min(length, self.max_length - n), extra = n)
+        return None if prefix is None else (prefix[0], prefix[1]), kv[0], kv[1]
+
     @torch.no_grad()
     def update(self, new_k, new_v, layer_ind):
+        """
+        Replace the cache for a layer with new_k/new_v (old cache + new tokens)
+        """
         assert self.cache is not None, "Must reset cache before using"
+        offset = self.offsets[layer_ind] + new_k.shape[2] - self._total_len(layer_ind)
 
-        def tuple_truncate(k, v):
-            k = k[:,:,-self.max_length:]
-            v = v[:,:,-self.max_length:]
-            return k, v
+        self._drop_prefix(layer_ind, self._prefix_len(layer_ind))
+        self.starts[layer_ind] = 0
+        self.lengths[layer_ind] = 0
+        self.push(new_k, new_v, layer_ind)
+        self.offsets[layer_ind] = offset
 
-        self.cache[layer_ind] = tuple_truncate(new_k,new_v)
-    
     @torch.no_grad()
     def truncate(self, truncate_amt):
         """
         Truncate frames from the KV cache
         """
         truncate_amt = truncate_amt * self.config.tokens_per_frame
-        def tuple_truncate(k, v):
-            k = k[:,:,truncate_amt:]
-            v = v[:,:,truncate_amt:]
-            return k, v
+        for i in range(self.config.n_layers):
+            amt = min(truncate_amt, self._total_len(i))
+            from_prefix = min(amt, self._prefix_len(i))
+            self._drop_prefix(i, from_prefix)
+            amt -= from_prefix
+
+            self.starts[i] += amt
+            self.lengths[i] -= amt
+
+    def snapshot(self):
+        """
+        Capture the current state so it can be brought back with restore().
+        Nothing is copied here, the storage gets copied on the next write instead.
+        """
+        assert self.cache is not None, "Must reset cache before using"
+        self._shared = True
+        return {
+            'storage' : {attr : list(getattr(self, attr)) for attr in self._storage_attrs},
+            'storage_key' : self._storage_key,
+            'shape' : self.shape,
+            'starts' : list(self.starts),
+            'lengths' : list(self.lengths),
+            'offsets' : list(self.offsets),
+            'prefixes' : {attr : list(getattr(self, attr)) for attr in self._prefix_attrs},
+            'n_branches' : self.n_branches
+        }
+
+    def restore(self, snapshot):
+        """
+        Go back to a state from snapshot(). The snapshot stays valid and can be restored again.
+        """
+        for attr, value in snapshot['storage'].items():
+            setattr(self, attr, list(value))
+        self._storage_key = snapshot['storage_key']
+        self.shape = snapshot['shape']
+        self.starts = list(snapshot['starts'])
+        self.lengths = list(snapshot['lengths'])
+        self.offsets = list(snapshot['offsets'])
+        for attr, value in snapshot['prefixes'].items():
+            setattr(self, attr, list(value))
+        self.n_branches = snapshot['n_branches']
+        self._shared = True
+
+    @torch.no_grad()
+    def fork(self, n):
+        """
+        Split every batch element into n branches (element i becomes i*n ... i*n+n-1, like repeat_interleave).
+        Cached tokens become a prefix that all branches of an element read from, only tokens
+        pushed after the fork are stored per branch, in storage that starts at one frame and grows
+        as they push. Inputs to the model need to be expanded the same way.
+        """
+        assert self.cache is not None, "Must reset cache before using"
+        batch_size = self.shape[0]
 
+        # Copied out once at the unforked batch size, so the old storage can be freed
+        prefixes = {attr : [] for attr in self._prefix_attrs}
         for i in range(self.config.n_layers):
-            self.cache[i] = tuple_truncate(*self.cache[i])
+            fork_prefix = self._fork_prefix(i) if self._total_len(i) > 0 else {}
+            for attr in self._prefix_attrs:
+                prefixes[attr].append(fork_prefix.get(attr))
+
+        capacity = self.config.tokens_per_frame
+        self._allocate(batch_size * n, capacity)
+        self._storage_key = (batch_size * n, torch.device(self.device), self.dtype, capacity)
+        self._shared = False
+        self.n_branches = n
+
+        self.shape = (batch_size * n,) + self.shape[1:]
+        self.starts = [0] * self.config.n_layers
+        self.lengths = [0] * self.config.n_layers
+        for attr, value in prefixes.items():
+            setattr(self, attr, value)
+
+    def _fork_prefix(self, layer_ind):
+        # Everything a layer holds as the prefix after a fork, {prefix attr : tensor}
+        return {'prefixes' : self._read(layer_ind, self._total_len(layer_ind)).clone()}
 
     def __len__(self):
         assert self.cache is not None, "Must reset cache before using"
-        return self.cache[0][0].shape[2]
+        return self._total_len(0)
 
     def shape(self):
         return self.shape
+
+class QuantizedKVCache(KVCache):
+    """
+    KVCache that stores keys/values as int8 with one float32 scale per (head, block of block_size tokens).
+    Reads dequantize into a scratch buffer so attention sees regular keys/values. The shared
+    prefix of a fork stays quantized and is dequantized at the unforked batch size.
+
+    :param block_size: Tokens sharing a scale, defaults to tokens_per_frame (must divide it)
+    :param quantize_layers: Layers to quantize, the rest keep full precision storage. Defaults to all layers.
+    :param slack_frames: See KVCache
+    """
+    _storage_attrs = ('cache', 'scales')
+    _prefix_attrs = ('prefixes', 'prefix_scales')
+
+    def __init__(self, config : TransformerConfig, block_size = None, quantize_layers = None, slack_frames = 4):
+        super().__init__(config, slack_frames)
+
+        self.block_size = block_size or config.tokens_per_frame
+        assert config.tokens_per_frame % self.block_size == 0, "block_size must divide tokens_per_frame"
+
+        if quantize_layers is None:
+            quantize_layers = range(config.n_layers)
+        self.quantize_layers = set(quantize_layers)
+
+        self.scales = None
+        self.prefix_scales = None
+        self.scratch = None
+        self.prefix_scratch = None
+
+    def _allocate(self, batch_size, capacity = None):
+        shape = self._storage_shape(batch_size, capacity or self.storage_length)
+        self.cache = []
+        self.scales = []
+        for i in range(self.config.n_layers):
+            if i in self.quantize_layers:
+                self.cache.append(torch.empty(*shape, device = self.device, dtype = torch.int8))
+                self.scales.append(torch.empty(*shape[:3], shape[3] // self.block_size, device = self.device, dtype = torch.float32))
+            else:
+                self.cache.append(torch.empty(*shape, device = self.device, dtype = self.dtype))
+                self.scales.append(None)
+        self.scratch = None
+
+    def _clone_storage(self):
+        self.cache = [t.clone() for t in self.cache]
+        self.scales = [None if t is None else t.clone() for t in self.scales]
+
+    def memory_bytes(self):
+        assert self.cache is not None, "Must reset cache before using"
+        total = 0
+        for t in self.cache + self.scales + self.prefixes + self.prefix_scales:
+            if t is not None:
+                total += t.numel() * t.element_size()
+        return total
+
+    def _resize(self, layer_ind, capacity):
+        if self.scales[layer_ind] is not None:
+            self._check_aligned(self.starts[layer_ind], self.lengths[layer_ind])
+            self.scales[layer_ind] = self._move(self.scales[layer_ind], self.starts[layer_ind], self.lengths[layer_ind], capacity, self.block_size)
+        super()._resize(layer_ind, capacity)
+
+    def _check_aligned(self, start, end):
+        assert start % self.block_size == 0 and end % self.block_size == 0, \
+            "Quantized cache reads/writes must be aligned to block_size"
+
+    def _write_slice(self, layer_ind, k, v, pos):
+        if layer_ind not in self.quantize_layers:
+            return super()._write_slice(layer_ind, k, v, pos)
+
+        n = k.shape[2]
+        self._check_aligned(pos, pos + n)
+        q, scale = self._quantize(k, v)
+        self.cache[layer_ind][:,:,:,pos:pos+n].copy_(q)
+        self.scales[layer_ind][:,:,:,pos//self.block_size:(pos+n)//self.block_size].copy_(scale)
+
+    def _quantize(self, k, v):
+        # [b,h,n,d] each -> int8 [2,b,h,n,d] and scales [2,b,h,n//block_size]
+        b,h,n,d = k.shape
+        bs = self.block_size
+        kv = torch.stack([k, v]).float().view(2, b, h, n // bs, bs, d)
+        scale = kv.abs().amax(dim = (-2,-1)).clamp(min = 1.0e-8) / 127
+        q = (kv / scale[...,None,None]).round_().clamp_(-127, 127).to(torch.int8)
+        return q.view(2, b, h, n, d), scale
+
+    def _dequantize(self, q, scale, out):
+        two,b,h,n,d = q.shape
+        bs = self.block_size
+        out.view(two, b, h, n // bs, bs, d).copy_(q.view(two, b, h, n // bs, bs, d) * scale[...,None,None])
+        return out
+
+    def _scratch(self, attr, batch_size, n):
+        # [2,b,h,n,d] shared by every layer's reads, grows with the longest read
+        scratch = getattr(self, attr)
+        if scratch is None or scratch.shape[1] != batch_size or scratch.shape[3] < n:
+            n_alloc = min(self.max_length, max(n, 2 * scratch.shape[3] if scratch is not None else n))
+            scratch = torch.empty(*self._storage_shape(batch_size, n_alloc), device = self.device, dtype = self.dtype)
+            setattr(self, attr, scratch)
+        return scratch[:,:,:,:n]
+
+    def _drop_prefix(self, layer_ind, amt):
+        scales = self.prefix_scales[layer_ind]
+        if scales is not None:
+            self._check_aligned(amt, 0)
+            self.prefix_scales[layer_ind] = None if amt >= self._prefix_len(layer_ind) else scales[:,:,:,amt // self.block_size:]
+        super()._drop_prefix(layer_ind, amt)
+
+    def _read_split(self, layer_ind, length, extra = 0):
+        prefix, tail = super()._read_split(layer_ind, length, extra)
+        if prefix is None or layer_ind not in self.quantize_layers:
+            return prefix, tail
+
+        n = prefix.shape[3]
+        self._check_aligned(n, 0)
+        scale = self.prefix_scales[layer_ind][:,:,:,-(n // self.block_size):]
+        return self._dequantize(prefix, scale, self._scratch('prefix_scratch', prefix.shape[1], n)), tail
+
+    def _fork_prefix(self, layer_ind):
+        if layer_ind not in self.quantize_layers:
+            return super()._fork_prefix(layer_ind)
+
+        # Raw int8 values and scales, the prefix of an earlier fork broadcast over its branches
+        fork_prefix = {}
+        bs = self.block_size
+        for attr, prefix_attr, scale in [('cache', 'prefixes', 1), ('scales', 'prefix_scales', bs)]:
+            start, n = self.starts[layer_ind] // scale, self.lengths[layer_ind] // scale
+            x = getattr(self, attr)[layer_ind][:,:,:,start:start+n]
+            prefix = getattr(self, prefix_attr)[layer_ind]
+            if prefix is not None:
+                x = torch.cat([prefix.repeat_interleave(self.n_branches, dim = 1), x], dim = 3)
+            fork_prefix[prefix_attr] = x.clone()
+        return fork_prefix
+
+    def _read_slice(self, layer_ind, start, end):
+        if layer_ind not in self.quantize_layers:
+            return super()._read_slice(layer_ind, start, end)
+
+        self._check_aligned(start, end)
+        q = self.cache[layer_ind][:,:,:,start:end]
+        scale = self.scales[layer_ind][:,:,:,start//self.block_size:end//self.block_size]
+        return self._dequantize(q, scale, self._scratch('scratch', q.shape[1], end - start))
+
+@torch.no_grad()
+def bench_kv_cache(n_layers = 25, n_heads = 4, d_head = 64, tokens_per_frame = 17, n_frames = 60, n_steps = 20, n_gen = 150, slack_frames = (1, 4, 16)):
+    """
+    Per generated frame: n_steps uncommitted lookups plus one committing pass for every layer,
+    with a cache that is already full (steady state of a rolling rollout).
+    Compares KVCache against the previous cat-and-slice cache. n_gen frames cover many
+    compactions (one every slack_frames frames), so their cost is included in the average.
+    Memory is reported next to it, the cat cache holding exactly max_length tokens.
+    Runs once for every value of slack_frames.
+    Reports time and number/bytes of allocations per frame.
+    """
+    import time
+    from types import SimpleNamespace
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    dtype = torch.bfloat16 if device == 'cuda' else torch.float32
+    config = SimpleNamespace(
+        n_layers = n_layers, n_heads = n_heads, d_model = n_heads * d_head,
+        tokens_per_frame = tokens_per_frame, n_frames = n_frames
+    )
+    max_length = tokens_per_frame * n_frames
+    new = torch.randn(1, n_heads, tokens_per_frame, d_head, device = device, dtype = dtype)
+
+    def cat_frame(cache):
+        # What Attn + KVCache did before: cat cache and new tokens, slice to commit
+        for _ in range(n_steps):
+            for l in range(n_layers):
+                k,v = cache[l]
+                torch.cat([k, new], dim = 2), torch.cat([v, new], dim = 2)
+        for l in range(n_layers):
+            k,v = cache[l]
+            k,v = torch.cat([k, new], dim = 2), torch.cat([v, new], dim = 2)
+            cache[l] = (k[:,:,-max_length:], v[:,:,-max_length:])
+
+    def kv_cache_frame(cache):
+        cache.disable_cache_updates()
+        for _ in range(n_steps):
+            for l in range(n_layers):
+                cache.extend(new, new, l)
+        cache.enable_cache_updates()
+        for l in range(n_layers):
+            cache.extend(new, new, l)
+
+    full = torch.randn(1, n_heads, max_length, d_head, device = device, dtype = dtype)
+    cat_cache = [(full.clone(), full.clone()) for _ in range(n_layers)]
+    runs = [("cat", cat_frame, cat_cache, 2 * n_layers * full.numel() * full.element_size())]
+    for slack in slack_frames:
+        kv_cache = KVCache(config, slack).to(device, dtype)
+        kv_cache.reset(1)
+        kv_cache.enable_cache_updates()
+        for l in range(n_layers):
+            kv_cache.push(full, full, l)
+        runs.append((f"cache, slack {slack}", kv_cache_frame, kv_cache, kv_cache.memory_bytes()))
+
+    def count_allocs(fn):
+        if device == 'cuda':
+            torch.cuda.synchronize()
+            before = torch.cuda.memory_stats()
+            fn()
+            torch.cuda.synchronize()
+            after = torch.cuda.memory_stats()
+            n = after['allocation.all.allocated'] - before['allocation.all.allocated']
+            size = after['allocated_bytes.all.allocated'] - before['allocated_bytes.all.allocated']
+            return n, size
+
+        from torch.profiler import profile, ProfilerActivity
+        with profile(activities = [ProfilerActivity.CPU], profile_memory = True) as prof:
+            fn()
+        allocs = [e.self_cpu_memory_usage for e in prof.events() if e.self_cpu_memory_usage > 0]
+        return len(allocs), sum(allocs)
+
+    for name, fn, cache, mem_bytes in runs:
+        fn(cache)
+        n_allocs, n_bytes = count_allocs(lambda: fn(cache))
+
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(n_gen):
+            fn(cache)
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        per_frame = (time.perf_counter() - start) / n_gen
+
+        print(f"{name:<15} {per_frame*1000:8.2f}ms/frame  {n_allocs:6d} allocs/frame  {n_bytes/2**20:8.1f}MiB allocated/frame  {mem_bytes/2**20:6.1f}MiB held")
+
+@torch.no_grad()
+def report_quantized_kv_cache(config_path = "configs/av.yml", n_frames = 12, block_size = None, quantize_layers = None, seed = 0):
+    """
+    Memory of an int8 cache for config_path (batch 1) against a bf16 cache holding exactly
+    max_length tokens (the cache before slack was added), then a fixed rollout on a small
+    causal DiT comparing the quantized cache against the bf16 one: relative error of the
+    dequantized keys/values and of the model output for every frame.
+    """
+    from ..configs import Config, TransformerConfig
+    from .attn import DiT
+
+    cfg = Config.from_yaml(config_path).model
+    bf16_cache = KVCache(cfg).to('meta', torch.bfloat16)
+    bf16_cache.reset(1)
+    q_cache = QuantizedKVCache(cfg, block_size, quantize_layers).to('meta', torch.bfloat16)
+    q_cache.reset(1)
+    ref_mb = cfg.n_layers * 2 * bf16_cache.max_length * cfg.d_model * 2 / 2**20
+    bf16_mb = bf16_cache.memory_bytes() / 2**20
+    q_mb = q_cache.memory_bytes() / 2**20
+    print(
+        f"{config_path}: bf16 {ref_mb:.1f}MiB at max_length ({bf16_mb:.1f}MiB with slack), "
+        f"int8 {q_mb:.1f}MiB with slack and scales per session ({ref_mb / q_mb:.2f}x smaller)"
+    )
+
+    torch.manual_seed(seed)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    config = TransformerConfig(
+        n_layers = 4, n_heads = 4, d_model = 128,
+        tokens_per_frame = cfg.tokens_per_frame, n_frames = n_frames // 2, causal = True
+    )
+    m = config.tokens_per_frame
+    model = DiT(config).to(device, torch.bfloat16).eval()
+    x = torch.randn(1, n_frames * m, config.d_model, device = device, dtype = torch.bfloat16)
+    cond = torch.randn(1, n_frames, config.d_model, device = device, dtype = torch.bfloat16)
+
+    caches = []
+    for cache in [KVCache(config), QuantizedKVCache(config, block_size, quantize_layers)]:
+        cache.to(device, torch.bfloat16)
+        cache.reset(1)
+        cache.enable_cache_updates()
+        caches.append(cache)
+
+    def rel_err(a, b):
+        return ((a.float() - b.float()).norm() / b.float().norm()).item()
+
+    kv_errs, out_errs = [], []
+    for i in range(n_frames):
+        x_i, cond_i = x[:,i*m:(i+1)*m], cond[:,i:i+1]
+        ref_out, q_out = [model(x_i, cond_i, cache) for cache in caches]
+        out_errs.append(rel_err(q_out, ref_out))
+        kv_errs.append(max(
+            max(rel_err(a, b) for a,b in zip(caches[1].get(l), caches[0].get(l)))
+            for l in range(config.n_layers)
+        ))
+
+    print(f"Rollout of {n_frames} frames ({n_frames // 2} frame window), block_size {caches[1].block_size}")
+    print(f"  K/V relative error: mean {sum(kv_errs)/len(kv_errs):.4f}, max {max(kv_errs):.4f}")
+    print(f"  Output relative error: mean {sum(out_errs)/len(out_errs):.4f}, max {max(out_errs):.4f}, last frame {out_errs[-1]:.4f}")
+
+if __name__ == "__main__":
+    bench_kv_cache()
+    report_quantized_kv_cache()
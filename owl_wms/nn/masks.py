@@ -0,0 +1,121 @@
+"""
+Attention masks shared by every attention layer.
+
+Masks only depend on sequence layout, so we build them once per
+(tokens, tokens_per_frame, context_tokens, device, dtype) and hand the
+same tensor to every layer and every sampling step.
+"""
+
+from functools import lru_cache
+
+import torch
+
+@lru_cache(maxsize = 32)
+def get_block_causal_mask(tokens, tokens_per_frame, context_tokens = 0, device = 'cpu', dtype = torch.bool, window_frames = None):
+    """
+    Block causal mask for [n_frames * tokens_per_frame] tokens, optionally followed
+    by context tokens from another modality.
+
+    Frame tokens see their own frame, every previous frame and all context tokens.
+    Context tokens only see each other.
+
+    :param tokens: Number of frame tokens (n_frames * tokens_per_frame)
+    :param tokens_per_frame: Tokens in a single frame
+    :param context_tokens: Number of trailing context tokens
+    :param window_frames: If given, frames only see the last window_frames frames (including their own)
+    :param dtype: torch.bool gives True where attention is allowed (SDPA convention),
+        floating dtypes give an additive mask (0 or -inf)
+    :return: [1,1,tokens+context_tokens,tokens+context_tokens] mask, broadcastable over [b,h]
+
+    The returned tensor is shared between callers and must not be modified in place.
+    """
+    total_tokens = tokens + context_tokens
+
+    # Frame index of every token, context tokens get their own index past the last frame
+    frame_idx = torch.arange(total_tokens, device = device) // tokens_per_frame
+    frame_idx[tokens:] = tokens // tokens_per_frame
+
+    is_ctx = torch.arange(total_tokens, device = device) >= tokens
+
+    # Queries see keys from the same or earlier frames (context counts as "earliest" for frames)
+    attend = frame_idx[:,None] >= frame_idx[None,:]
+    if window_frames is not None:
+        attend = attend & (frame_idx[:,None] - frame_idx[None,:] < window_frames)
+    attend = attend | is_ctx[None,:]        # frames see all context
+    attend = attend & ~(is_ctx[:,None] & ~is_ctx[None,:]) # context doesn't see frames
+
+    if dtype != torch.bool:
+        mask = torch.zeros(total_tokens, total_tokens, device = device, dtype = dtype)
+        attend = mask.masked_fill(~attend, float('-inf'))
+
+    return attend[None,None]
+
+def clear_mask_cache():
+    get_block_causal_mask.cache_clear()
+
+def _loop_block_causal_mask(tokens, context_tokens, tokens_per_frame):
+    # Reference: the per-frame loop version masks used to be built with (True = masked)
+    frames = tokens // tokens_per_frame
+    total_tokens = tokens + context_tokens
+    mask = torch.zeros(total_tokens, total_tokens)
+    for i in range(frames):
+        start = i * tokens_per_frame
+        end = (i + 1) * tokens_per_frame
+        mask[start:end, end:tokens] = True
+    mask[tokens:, :tokens] = True
+    return mask
+
+def test_mask_parity():
+    for n_frames, tpf, ctx in [(10, 16, 0), (60, 17, 0), (8, 16, 16)]:
+        ref = _loop_block_causal_mask(n_frames * tpf, ctx, tpf).bool()
+        mask = get_block_causal_mask(n_frames * tpf, tpf, ctx)[0,0]
+        assert torch.equal(mask, ~ref), f"Mismatch for {n_frames}x{tpf}+{ctx}"
+
+        float_mask = get_block_causal_mask(n_frames * tpf, tpf, ctx, dtype = torch.float32)[0,0]
+        assert torch.equal(float_mask == 0, mask)
+    print("Mask parity OK")
+
+@torch.no_grad()
+def bench_mask(n_frames = 60, tokens_per_frame = 17, batch_size = 2, n_calls = 100):
+    """
+    Compares the old per-forward mask rebuild (loop + batch repeat) against the cached provider.
+    """
+    import time
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    dtype = torch.bfloat16
+    tokens = n_frames * tokens_per_frame
+
+    def sync():
+        if device == 'cuda':
+            torch.cuda.synchronize()
+
+    def old_mask():
+        mask = _loop_block_causal_mask(tokens, 0, tokens_per_frame).to(device=device,dtype=dtype)
+        return mask.unsqueeze(0).repeat(batch_size, 1, 1).unsqueeze(1)
+
+    clear_mask_cache()
+
+    sync()
+    start = time.perf_counter()
+    for _ in range(n_calls):
+        old = old_mask()
+    sync()
+    old_time = (time.perf_counter() - start) / n_calls
+
+    start = time.perf_counter()
+    for _ in range(n_calls):
+        new = get_block_causal_mask(tokens, tokens_per_frame, device = device)
+    sync()
+    new_time = (time.perf_counter() - start) / n_calls
+
+    old_bytes = old.numel() * old.element_size()
+    new_bytes = new.numel() * new.element_size()
+
+    print(f"Tokens: {tokens} ({n_frames} frames x {tokens_per_frame}), batch {batch_size}, {device}")
+    print(f"Loop + repeat: {old_time*1000:.3f}ms/forward, {old_bytes/2**20:.2f}MiB")
+    print(f"Cached bool:   {new_time*1000:.3f}ms/forward, {new_bytes/2**20:.2f}MiB")
+
+if __name__ == "__main__":
+    test_mask_parity()
+    bench_mask()
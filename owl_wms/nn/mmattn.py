@@ -9,8 +9,9 @@ import einops as eo
 
 from .modulation import AdaLN, Gate
 from .rope import FlatVideoRoPE
-
-torch.backends.cuda.enable_flash_sdp(enabled = True)
+from .masks import get_block_causal_mask
+from .attn_backends import get_attn_fn
+from .kv_cache import prefix_attention
 
 from einops._torch_specific import allow_ops_in_compiled_graph
 allow_ops_in_compiled_graph()
@@ -20,27 +21,6 @@ This code makes the assumption that there are some
 tokens from another modality that must always be attended to
 """
 
-def create_block_causal_mask_with_mm(tokens, context_tokens, tokens_per_frame):
-    frames = tokens // tokens_per_frame
-    
-    # Create base causal mask, nothing is masked
-    total_tokens = tokens + context_tokens
-    mask = torch.zeros(total_tokens, total_tokens)
-    
-    # Allow attention within each frame
-    for i in range(frames):
-        start = i * tokens_per_frame
-        end = (i + 1) * tokens_per_frame
-        mask[start:end, end:tokens] = True # Can't see future frames
-    
-    # Context tokens can only attend to themselves
-    mask[tokens:, :tokens] = True # Mask out attention to regular tokens
-    
-    # Regular tokens can still attend to all context tokens (no masking needed)
-    # The zeros in mask[:, tokens:] allow tokens to attend to all context
-    
-    return mask
-
 class MMAttn(nn.Module):
     """
     MMDiT style attention
@@ -63,6 +43,7 @@ class MMAttn(nn.Module):
         self.causal = config.causal
 
         self.rope = FlatVideoRoPE(config)
+        self.attn_fn = get_attn_fn(config.attn_backend, **(config.attn_backend_kwargs or {}))
 
     def split(self, qkv):
         return eo.rearrange(qkv, 'b n (three h d) -> three b h n d', three = 3, h = self.n_heads)
@@ -79,35 +60,33 @@ class MMAttn(nn.Module):
         q1,k1 = self.qk_norm_1(q1,k1)
         q2,k2 = self.qk_norm_2(q2,k2)
 
-        if not self.causal or (kv_cache is not None and len(kv_cache) > 0):
-            mask = None
-        else:
-            mask = create_block_causal_mask_with_mm(x_1.shape[1], x_2.shape[1], self.config.tokens_per_frame)
-            mask = mask.to(device=x_1.device,dtype=x_1.dtype)
-            mask = mask.unsqueeze(0).repeat(x_1.shape[0],1,1)
-            mask = mask.unsqueeze(1) # head dim
+        tokens_per_frame = self.config.tokens_per_frame if self.causal else None # None -> no mask
 
         if kv_cache is not None:
-            if len(kv_cache) > 0:
-                old_k, old_v = kv_cache.get(self.layer_ind)
-                
-                new_k = torch.cat([old_k, k1], dim=2).contiguous()
-                new_v = torch.cat([old_v, v1], dim=2).contiguous()
-            else:
-                new_k = k1.contiguous()
-                new_v = v1.contiguous()
+            # Cached keys are already rotated, only rotate the new tokens at their absolute position
+            offset = kv_cache.get_offset(self.layer_ind)
+            q1 = self.rope.rotate(q1, offset)
+            k1 = self.rope.rotate(k1, offset)
 
-            if kv_cache.should_update:
-                kv_cache.update(new_k, new_v, self.layer_ind)
-
-            q1, new_k = self.rope(q1, new_k)
+            # Cache + new tokens, committed to the cache if updates are on
+            prefix, new_k, new_v = kv_cache.extend_split(k1, v1, self.layer_ind)
+            if prefix is not None or new_k.shape[2] > k1.shape[2]:
+                tokens_per_frame = None # New tokens see the whole cache
 
             k = torch.cat([new_k, k2], dim=-2)
             v = torch.cat([new_v, v2], dim=-2)
-            q = torch.cat([q1, q2], dim=-2)
 
-            x = F.scaled_dot_product_attention(q, k, v, attn_mask = mask)
-            x = x[:,:,-q.shape[2]:] # Only keep latest outputs
+            attn_fn = self.attn_fn
+            if prefix is not None:
+                # Forked cache, the shared history is read in place
+                attn_fn = lambda q, k, v, *mask_args: prefix_attention(q, *prefix, k, v)
+
+            if self.causal and tokens_per_frame is None:
+                # No mask for the new frames, but context tokens still only see context
+                x = torch.cat([attn_fn(q1, k, v), self.attn_fn(q2, k2, v2)], dim=-2)
+            else:
+                q = torch.cat([q1, q2], dim=-2)
+                x = attn_fn(q, k, v, tokens_per_frame, x_2.shape[1])
             x = self.merge(x)
         else:
             q1, k1 = self.rope(q1,k1)
@@ -116,7 +95,7 @@ class MMAttn(nn.Module):
             k = torch.cat([k1,k2],dim=-2) 
             v = torch.cat([v1,v2],dim=-2)
 
-            x = F.scaled_dot_product_attention(q,k,v, attn_mask = mask)
+            x = self.attn_fn(q, k, v, tokens_per_frame, x_2.shape[1])
             x = self.merge(x)
 
         x_1, x_2 = x[:,:n1], x[:,n1:]
@@ -277,7 +256,7 @@ def test_mask():
     n_tok_per_frame = 16
     n_context = 16
 
-    mask = create_block_causal_mask_with_mm(n_frames*n_tok_per_frame, n_context, n_tok_per_frame)
+    mask = get_block_causal_mask(n_frames*n_tok_per_frame, n_tok_per_frame, n_context)[0,0]
 
     plt.figure(figsize=(10,10))
     plt.imshow(mask.float().cpu().numpy(), cmap='gray')
@@ -50,6 +50,10 @@ class VideoRoPE(nn.Module):
 class FlatVideoRoPE(nn.Module):
     """
     Half-flat of RoPE that treats [n_frames, tokens_per_frame] as [n_frames, tokens_per_frame] image
+
+    cos/sin tables are precomputed once for n_frames * tokens_per_frame positions
+    and sliced by token offset at call time. Without a KV cache frame positions are spread
+    over the frames of k, like the axial freqs they replace, so shorter inputs use their own tables.
     """
     def __init__(self, config):
         super().__init__()
@@ -62,36 +66,103 @@ class FlatVideoRoPE(nn.Module):
         )
 
         self.m = config.tokens_per_frame
-
-    def pad_q(self, q, k):
-        # Pad Q when it's needed for kv caching
-        q_len = q.shape[2]
-        k_len = k.shape[2]
+        self.n_frames = config.n_frames
+
+        # Plain attribute (not a buffer) so dtype casts on the model don't touch it
+        self.axis_freqs = self.pos_emb.freqs.detach().double().clone()
+
+        cos, sin = self.get_tables(0, self.n_frames * self.m)
+        self.register_buffer('cos', cos.float(), persistent = False)
+        self.register_buffer('sin', sin.float(), persistent = False)
+
+        self._extra_key = None
+        self._extra_tables = None
+
+    @torch.no_grad()
+    def get_tables(self, offset, n, n_frames = None):
+        """
+        Compute cos/sin for token positions [offset, offset+n) in float64.
+        Frame positions follow the same line as the pixel linspace over n_frames (config.n_frames
+        by default), so positions past the table continue it and relative angles stay consistent.
+        """
+        n_frames = n_frames or self.n_frames
+        pos = torch.arange(offset, offset + n, dtype = torch.float64)
+        frame_pos = -1. + 2. * (pos // self.m) / max(n_frames - 1, 1)
+        tok_pos = -1. + 2. * (pos % self.m) / max(self.m - 1, 1)
+
+        angles = torch.cat([
+            frame_pos[:,None] * self.axis_freqs[None],
+            tok_pos[:,None] * self.axis_freqs[None]
+        ], dim = -1) # [n,rot_dim//2]
+        return angles.cos(), angles.sin()
+
+    def get_cos_sin(self, offset, n, device, dtype, n_frames = None):
+        n_frames = n_frames or self.n_frames
+        if n_frames == self.n_frames and offset + n <= self.cos.shape[0]:
+            return self.cos[offset:offset+n].to(dtype), self.sin[offset:offset+n].to(dtype)
+
+        # Past the table (rolling KV cache) or a shorter input, compute once and reuse across layers calls / denoising steps
+        key = (offset, n, n_frames, device, dtype)
+        if self._extra_key != key:
+            cos, sin = self.get_tables(offset, n, n_frames)
+            self._extra_tables = (cos.to(device=device,dtype=dtype), sin.to(device=device,dtype=dtype))
+            self._extra_key = key
+        return self._extra_tables
+
+    def rotate(self, x, offset = 0, n_frames = None):
+        """
+        Rotate x [b,h,n_tokens,d] as if its first token sits at position offset (in tokens),
+        with frame positions spread over n_frames frames (config.n_frames by default)
+        """
+        cos, sin = self.get_cos_sin(offset, x.shape[2], x.device, x.dtype, n_frames)
+        rot_dim = 2 * cos.shape[-1]
+
+        x_rot, x_pass = x[...,:rot_dim], x[...,rot_dim:]
+        x1, x2 = eo.rearrange(x_rot, '... (d r) -> r ... d', r = 2)
+        x_rot = torch.stack([x1 * cos - x2 * sin, x2 * cos + x1 * sin], dim = -1)
+        x_rot = eo.rearrange(x_rot, '... d r -> ... (d r)')
+
+        return torch.cat([x_rot, x_pass], dim = -1)
 
     def forward(self, q, k):
         # q|k is [b,h,n_frames*tokens_per_frame,d]
-        n = k.shape[2]//self.m
-        m = self.m
-
-        truncate = n
-        if q.shape[2] < n * m:
-            truncate = q.shape[2]//m # How many frames is q?
-
-        q = eo.rearrange(q, 'b h (n m) d -> b h n m d', n=q.shape[2]//m,m=m)
-        k = eo.rearrange(k, 'b h (n m) d -> b h n m d', n=n,m=m)
-
-        with torch.no_grad():
-            freqs = self.pos_emb.get_axial_freqs(n,m)
-        q = apply_rotary_emb(freqs[-truncate:].detach(), q)
-        k = apply_rotary_emb(freqs.detach(), k)
+        # q may be shorter than k (kv caching), it is aligned to the end of k
+        n_frames = k.shape[2] // self.m
+        q = self.rotate(q, k.shape[2] - q.shape[2], n_frames)
+        k = self.rotate(k, 0, n_frames)
+        return q,k
 
+def test_flat_rope_parity():
+    from types import SimpleNamespace
+
+    config = SimpleNamespace(d_model = 384, n_heads = 6, tokens_per_frame = 17, n_frames = 60)
+    rope = FlatVideoRoPE(config)
+    n, m = config.n_frames, config.tokens_per_frame
+
+    def reference(q, k):
+        # Previous implementation, rebuilds axial freqs every call
+        truncate = q.shape[2]//m
+        n = k.shape[2]//m
+        q = eo.rearrange(q, 'b h (n m) d -> b h n m d', m=m)
+        k = eo.rearrange(k, 'b h (n m) d -> b h n m d', m=m)
+        freqs = rope.pos_emb.get_axial_freqs(n,m)
+        q = apply_rotary_emb(freqs[-truncate:], q)
+        k = apply_rotary_emb(freqs, k)
         q = eo.rearrange(q, 'b h n m d -> b h (n m) d')
         k = eo.rearrange(k, 'b h n m d -> b h (n m) d')
-
-        if truncate is not None:
-            q = q[:,:,-truncate*m:]
-
         return q,k
 
-
-
+    q = torch.randn(2, 6, n*m, 64)
+    k = torch.randn(2, 6, n*m, 64)
+    # Full windows, and shorter ones (i.e. training on fewer frames) scaled by their own length
+    for k_frames, q_frames in [(n, n), (n, 1), (20, 20), (20, 1)]:
+        k_in = k[:,:,-k_frames*m:]
+        q_ref, k_ref = reference(q[:,:,-q_frames*m:], k_in)
+        q_new, k_new = rope(q[:,:,-q_frames*m:], k_in)
+        # The tables are built in float64, the reference's float32 angles are off by up to ~1e-4
+        assert (q_ref - q_new).abs().max() < 5.0e-4, (k_frames, q_frames)
+        assert (k_ref - k_new).abs().max() < 5.0e-4, (k_frames, q_frames)
+    print("FlatVideoRoPE parity OK")
+
+if __name__ == "__main__":
+    test_flat_rope_parity()
@@ -9,6 +9,9 @@ def get_sampler_cls(sampler_id):
         return CFGSampler
     elif sampler_id == "window":
         return WindowCFGSampler
+    elif sampler_id == "pyramid":
+        from .pyramid import PyramidSampler
+        return PyramidSampler
     elif sampler_id == "av_window":
         from .av_window import AVWindowSampler
         return AVWindowSampler
\ No newline at end of file
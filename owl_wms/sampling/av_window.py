@@ -5,6 +5,11 @@ import torch.nn.functional as F
 from tqdm import tqdm
 
 from ..utils import batch_permute_to_length
+from .solvers import get_solver
+from .schedules import get_timesteps
+from .guidance import CFGGuidance
+from .window import RollingWindow, alloc_output
+from ..utils.profiling import StageTimer
 
 def zlerp(x, alpha):
     z = torch.randn_like(x)
@@ -21,14 +26,31 @@ class AVWindowSampler:
     :param num_frames: Number of new frames to sample
     :param noise_prev: Noise previous frame
     :param only_return_generated: Whether to only return the generated frames
+    :param solver: ODE solver for each frame (see solvers.py), video and audio are integrated together
+    :param solver_kwargs: Extra arguments for the solver
+    :param schedule: Noise level schedule for each frame (see schedules.py)
+    :param schedule_kwargs: Extra arguments for the schedule
+    :param guidance_interval: (t_min, t_max), only apply CFG at noise levels inside it
+    :param skip_cfg_steps: Steps (of each frame) to run without CFG
+    :param output_device: Where the returned frames are kept (i.e. 'cpu' for long rollouts), defaults to the input's device
+    :param pin_memory: Pin CPU output buffers so frames are copied out without blocking
+    :param timer: StageTimer recording every stage of a frame (see utils/profiling.py), off if None
     """
-    def __init__(self, n_steps = 20, cfg_scale = 1.3, window_length = 60, num_frames = 60, noise_prev = 0.2, only_return_generated = False):
+    def __init__(self, n_steps = 20, cfg_scale = 1.3, window_length = 60, num_frames = 60, noise_prev = 0.2, only_return_generated = False, solver = "euler", solver_kwargs = None, schedule = "linear", schedule_kwargs = None, guidance_interval = None, skip_cfg_steps = None, output_device = None, pin_memory = True, timer = None):
         self.n_steps = n_steps
         self.cfg_scale = cfg_scale
         self.window_length = window_length
         self.num_frames = num_frames
         self.noise_prev = noise_prev
         self.only_return_generated = only_return_generated
+        self.solver = get_solver(solver, **(solver_kwargs or {}))
+        self.schedule = schedule
+        self.schedule_kwargs = schedule_kwargs or {}
+        self.guidance_interval = guidance_interval
+        self.skip_cfg_steps = skip_cfg_steps
+        self.output_device = output_device
+        self.pin_memory = pin_memory
+        self.timer = timer or StageTimer(enabled = False)
 
     @torch.no_grad()
     def __call__(self, model, dummy_batch, audio, mouse, btn, decode_fn = None, audio_decode_fn = None, image_scale = 1, audio_scale = 1):
@@ -39,78 +61,34 @@ class AVWindowSampler:
 
         # output will be [b,n+self.num_frames,c,h,w]
         
-        sampling_steps = self.n_steps
         num_frames = self.num_frames
+        n = dummy_batch.shape[1]
 
-        dt = 1. / sampling_steps
-
-        clean_history = dummy_batch.clone()
-        clean_audio_history = audio.clone()
+        # Finished frames are written straight to the outputs, only the windows live on device
+        if self.only_return_generated:
+            x = alloc_output(dummy_batch, num_frames, self.output_device, self.pin_memory)
+            out_audio = alloc_output(audio, num_frames, self.output_device, self.pin_memory)
+            offset = 0
+        else:
+            x = alloc_output(dummy_batch, n + num_frames, self.output_device, self.pin_memory)
+            out_audio = alloc_output(audio, n + num_frames, self.output_device, self.pin_memory)
+            x[:,:n] = dummy_batch
+            out_audio[:,:n] = audio
+            offset = n
         
         extended_mouse, extended_btn = batch_permute_to_length(mouse, btn, num_frames + self.window_length)
 
-        def step_history():
-            # Video history
-            new_history = clean_history.clone()[:,-self.window_length:] 
-            b,n,c,h,w = new_history.shape
-            new_history[:,:-1] = zlerp(new_history[:,1:],self.noise_prev)
-            new_history[:,-1] = torch.randn_like(new_history[:,0])
+        frames = self.stream(model, dummy_batch, audio, extended_mouse, extended_btn, num_frames)
+        for frame_idx, (new_frame, new_audio) in enumerate(tqdm(frames, total = num_frames)):
+            out = slice(offset + frame_idx, offset + frame_idx + 1)
+            x[:,out].copy_(new_frame, non_blocking = x.is_pinned())
+            out_audio[:,out].copy_(new_audio, non_blocking = out_audio.is_pinned())
 
-            # Audio history 
-            new_audio = clean_audio_history.clone()[:,-self.window_length:]
-            new_audio[:,:-1] = zlerp(new_audio[:,1:],self.noise_prev)
-            new_audio[:,-1] = torch.randn_like(new_audio[:,0])
+        if x.is_pinned() or out_audio.is_pinned():
+            torch.cuda.current_stream().synchronize()
 
-            return new_history, new_audio
-
-        for frame_idx in tqdm(range(num_frames)):
-            local_history, local_audio = step_history()
-            ts_history = torch.ones(local_history.shape[0], local_history.shape[1], device=local_history.device,dtype=local_history.dtype)
-            ts_history[:,:-1] = self.noise_prev
-
-            mouse = extended_mouse[:,frame_idx:frame_idx+self.window_length]
-            btn = extended_btn[:,frame_idx:frame_idx+self.window_length]
-
-            mouse_batch = torch.cat([mouse, torch.zeros_like(mouse)], dim=0) 
-            btn_batch = torch.cat([btn, torch.zeros_like(btn)], dim=0)
-            for _ in range(sampling_steps):
-                # CFG Branches
-                x = local_history.clone()
-                a = local_audio.clone()
-                ts = ts_history.clone()
-
-                x_batch = torch.cat([x, x], dim=0)
-                a_batch = torch.cat([a, a], dim=0)
-                ts_batch = torch.cat([ts, ts], dim=0)
-                
-                pred_video_batch, pred_audio_batch = model(x_batch, a_batch, ts_batch, mouse_batch, btn_batch)
-                
-                # Split predictions back into conditional and unconditional
-                cond_pred_video, uncond_pred_video = pred_video_batch.chunk(2)
-                cond_pred_audio, uncond_pred_audio = pred_audio_batch.chunk(2)
-
-                pred_video = uncond_pred_video + self.cfg_scale * (cond_pred_video - uncond_pred_video)
-                pred_audio = uncond_pred_audio + self.cfg_scale * (cond_pred_audio - uncond_pred_audio)
-                
-                x = x - pred_video*dt
-                a = a - pred_audio*dt
-                ts = ts - dt
-
-                local_history[:,-1] = x[:,-1]
-                local_audio[:,-1] = a[:,-1]
-                ts_history[:,-1] = ts[:,-1]
-            
-            # Frame is entirely cleaned now
-            new_frame = local_history[:,-1:]
-            new_audio = local_audio[:,-1:]
-            clean_history = torch.cat([clean_history, new_frame], dim=1)
-            clean_audio_history = torch.cat([clean_audio_history, new_audio], dim=1)
-
-        x = clean_history
-        audio = clean_audio_history
+        audio = out_audio
         if self.only_return_generated:
-            x = x[:,-num_frames:]
-            audio = audio[:,-num_frames:]
             extended_mouse = extended_mouse[:,-num_frames:]
             extended_btn = extended_btn[:,-num_frames:]
 
@@ -124,6 +102,87 @@ class AVWindowSampler:
     
         return x, audio, extended_mouse, extended_btn
 
+    @torch.no_grad()
+    def stream(self, model, dummy_batch, audio, mouse, btn, num_frames = None, decode_fn = None, audio_decode_fn = None, image_scale = 1, audio_scale = 1):
+        """
+        Generator version of __call__, yields (video, audio) for every new frame as soon as it's denoised:
+        [b,1,c,h,w] and [b,1,c] latents, each decoded if its decode function is given.
+
+        Controls for the next frame can be sent in between frames,
+        frame, audio_frame = frames.send((mouse, btn)) with mouse [b,2] and btn [b,n_button] (or [b,1,...]).
+        Frames nothing was sent for use mouse/btn extended to the rollout length, like __call__.
+
+        :param num_frames: Frames to generate, defaults to self.num_frames
+        """
+        num_frames = self.num_frames if num_frames is None else num_frames
+        window = RollingWindow(dummy_batch, self.window_length)
+        audio_window = RollingWindow(audio, self.window_length)
+
+        # Own copy since sent controls are written into it
+        mouse, btn = (c.clone() for c in batch_permute_to_length(mouse, btn, num_frames + self.window_length))
+
+        timesteps = get_timesteps(self.schedule, self.n_steps, **self.schedule_kwargs)
+        guidance = CFGGuidance(self.cfg_scale, self.guidance_interval, self.skip_cfg_steps)
+        guidance.prepare(mouse, btn, timesteps)
+
+        def step_history():
+            # Video history
+            clean_history = window.view()
+            new_history = torch.empty_like(clean_history)
+            new_history[:,:-1] = zlerp(clean_history[:,1:],self.noise_prev)
+            new_history[:,-1] = torch.randn_like(new_history[:,0])
+
+            # Audio history 
+            clean_audio = audio_window.view()
+            new_audio = torch.empty_like(clean_audio)
+            new_audio[:,:-1] = zlerp(clean_audio[:,1:],self.noise_prev)
+            new_audio[:,-1] = torch.randn_like(new_audio[:,0])
+
+            return new_history, new_audio
+
+        timer = self.timer
+        for frame_idx in range(num_frames):
+            with timer.frame():
+                with timer.stage("noise_context"):
+                    local_history, local_audio = step_history()
+                    ts_history = torch.ones(local_history.shape[0], local_history.shape[1], device=local_history.device,dtype=local_history.dtype)
+                    ts_history[:,:-1] = self.noise_prev
+
+                frames = slice(frame_idx, frame_idx + self.window_length)
+
+                def fn(xa_last, t):
+                    x = local_history.clone()
+                    a = local_audio.clone()
+                    ts = ts_history.clone()
+                    x[:,-1:], a[:,-1:] = xa_last
+                    ts[:,-1] = t
+
+                    with timer.stage("diffusion_step"):
+                        pred_video, pred_audio = guidance(model, (x, a), ts, t, frames)
+                    return pred_video[:,-1:], pred_audio[:,-1:]
+
+                new_frame, new_audio = self.solver.solve(
+                    fn, (local_history[:,-1:].clone(), local_audio[:,-1:].clone()), timesteps
+                )
+
+                # Frame is entirely cleaned now
+                window.append(new_frame)
+                audio_window.append(new_audio)
+
+                if decode_fn is not None:
+                    with timer.stage("decode_video"):
+                        new_frame = decode_fn(new_frame * image_scale)
+                if audio_decode_fn is not None:
+                    with timer.stage("decode_audio"):
+                        new_audio = audio_decode_fn(new_audio * audio_scale)
+
+            sent = yield new_frame, new_audio
+            if sent is not None:
+                with timer.stage("control_ingest"):
+                    # The next frame is the last one of its window
+                    next_mouse, next_btn = (c if c.ndim == 2 else c[:,-1] for c in sent)
+                    guidance.set_controls(frame_idx + self.window_length, next_mouse, next_btn)
+
 def test_window_cfg_sampler():
     sampler = WindowCFGSampler()
     model = lambda x, ts, mouse, btn: x
@@ -2,32 +2,33 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 
+from .solvers import get_solver
+from .schedules import get_timesteps
+from .guidance import CFGGuidance
+
 class CFGSampler:
-    def __init__(self, n_steps = 20, cfg_scale = 1.3):
+    def __init__(self, n_steps = 20, cfg_scale = 1.3, solver = "euler", solver_kwargs = None, schedule = "linear", schedule_kwargs = None, guidance_interval = None, skip_cfg_steps = None):
         self.n_steps = n_steps
         self.cfg_scale = cfg_scale
+        self.guidance_interval = guidance_interval
+        self.skip_cfg_steps = skip_cfg_steps
+        self.solver = get_solver(solver, **(solver_kwargs or {}))
+        self.schedule = schedule
+        self.schedule_kwargs = schedule_kwargs or {}
 
     @torch.no_grad()
     def __call__(self, model, dummy_batch, mouse, btn, decode_fn = None, scale = 1):
-        sampling_steps = self.n_steps
-        cfg_scale = self.cfg_scale
-        
         x = torch.randn_like(dummy_batch)
-        ts = torch.ones(x.shape[0], x.shape[1], device=x.device,dtype=x.dtype)
-        dt = 1. / sampling_steps
 
-        for _ in range(sampling_steps):
-            # Get conditional prediction
-            cond_pred = model(x, ts, mouse, btn)
-            
-            # Get unconditional prediction by zeroing out conditioning
-            uncond_pred = model(x, ts, torch.zeros_like(mouse), torch.zeros_like(btn))
-            
-            # Combine predictions using cfg_scale
-            pred = uncond_pred + cfg_scale * (cond_pred - uncond_pred)
-            
-            x = x - pred*dt
-            ts = ts - dt
+        timesteps = get_timesteps(self.schedule, self.n_steps, **self.schedule_kwargs)
+        guidance = CFGGuidance(self.cfg_scale, self.guidance_interval, self.skip_cfg_steps)
+        guidance.prepare(mouse, btn, timesteps)
+
+        def fn(x, t):
+            ts = torch.full((x.shape[0], x.shape[1]), t, device=x.device, dtype=x.dtype)
+            return guidance(model, (x,), ts, t)
+
+        x = self.solver.solve(fn, x, timesteps)
 
         if decode_fn is not None:
             x = x * scale 
@@ -37,31 +38,25 @@ class CFGSampler:
 class InpaintCFGSampler(CFGSampler):
     @torch.no_grad()
     def __call__(self, model, dummy_batch, mouse, btn, decode_fn = None, scale = 1):
-        sampling_steps = self.n_steps
-        cfg_scale = self.cfg_scale
-        
         x = torch.randn_like(dummy_batch)
 
         ts = torch.ones(x.shape[0], x.shape[1], device=x.device, dtype=x.dtype)
-        dt = 1. / sampling_steps
         
         # Calculate midpoint
         mid = x.shape[1] // 2
         x[:,:mid] = dummy_batch[:,:mid]
+
+        timesteps = get_timesteps(self.schedule, self.n_steps, **self.schedule_kwargs)
+        guidance = CFGGuidance(self.cfg_scale, self.guidance_interval, self.skip_cfg_steps)
+        guidance.prepare(mouse, btn, timesteps)
         
-        for _ in range(sampling_steps):
-            # Get conditional prediction
-            cond_pred = model(x, ts, mouse, btn)
-            
-            # Get unconditional prediction by zeroing out conditioning
-            uncond_pred = model(x, ts, torch.zeros_like(mouse), torch.zeros_like(btn))
-            
-            # Combine predictions using cfg_scale
-            pred = uncond_pred + cfg_scale * (cond_pred - uncond_pred)
-            
-            # Only update second half
-            x[:, mid:] = x[:, mid:] - pred[:, mid:]*dt
-            ts[:, mid:] = ts[:, mid:] - dt
+        # Only the second half is integrated, the first half stays clean
+        def fn(x_gen, t):
+            ts[:, mid:] = t
+            x_full = torch.cat([x[:,:mid], x_gen], dim=1)
+            return guidance(model, (x_full,), ts, t)[:, mid:]
+
+        x[:, mid:] = self.solver.solve(fn, x[:, mid:], timesteps)
 
         if decode_fn is not None:
             x = x * scale
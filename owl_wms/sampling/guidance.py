@@ -0,0 +1,165 @@
+"""
+Classifier-free guidance shared by every sampler.
+
+The conditional and unconditional (zeroed controls) branches run as one batched
+forward. The batched controls are built once per rollout in prepare().
+"""
+
+import torch
+
+class CFGGuidance:
+    """
+    :param cfg_scale: Guidance scale, 1 disables guidance
+    :param guidance_interval: (t_min, t_max), only guide at noise levels inside it
+    :param skip_steps: Step indices (into the sampling schedule) to run without guidance
+    """
+    def __init__(self, cfg_scale = 1.3, guidance_interval = None, skip_steps = None):
+        self.cfg_scale = cfg_scale
+        self.guidance_interval = guidance_interval
+        self.skip_steps = set(skip_steps or [])
+
+        self.controls = None
+        self.batched_controls = None
+        self.skip_ranges = []
+
+    def prepare(self, mouse, btn, timesteps = None):
+        """
+        Build the [cond, null] control batch for a rollout.
+
+        :param mouse: [b,n,2]
+        :param btn: [b,n,n_buttons]
+        :param timesteps: Schedule used for the rollout, needed to resolve skip_steps
+        """
+        self.controls = (mouse, btn)
+        self.batched_controls = (
+            torch.cat([mouse, torch.zeros_like(mouse)], dim=0),
+            torch.cat([btn, torch.zeros_like(btn)], dim=0)
+        )
+
+        # Every evaluation in (t_next, t] of a skipped step is unguided (solvers may evaluate mid-step)
+        self.skip_ranges = []
+        if timesteps is not None:
+            for i in self.skip_steps:
+                if i < len(timesteps) - 1:
+                    self.skip_ranges.append((timesteps[i+1], timesteps[i]))
+
+    def set_controls(self, idx, mouse, btn):
+        """
+        Overwrite the conditional controls of frame idx in place (i.e. live input while streaming)
+
+        :param mouse: [b,2]
+        :param btn: [b,n_buttons]
+        """
+        assert self.batched_controls is not None, "Call prepare() before setting controls"
+        b = mouse.shape[0]
+        for controls, batched, new in zip(self.controls, self.batched_controls, (mouse, btn)):
+            controls[:,idx] = new
+            batched[:b,idx] = new
+
+    def is_guided(self, t):
+        if self.cfg_scale == 1.0:
+            return False
+        if self.guidance_interval is not None:
+            t_min, t_max = self.guidance_interval
+            if not t_min <= t <= t_max:
+                return False
+        return not any(lo < t <= hi for lo, hi in self.skip_ranges)
+
+    def __call__(self, model, inputs, ts, t, frames = slice(None), kv_cache = None):
+        """
+        Guided prediction of model(*inputs, ts, mouse, btn).
+
+        :param inputs: Tuple of model inputs before ts (i.e. (x,) or (x, audio)), batch b
+        :param ts: [b,n] noise levels
+        :param t: Noise level of the step, decides if guidance is applied
+        :param frames: Slice of the controls (along frames) to use
+        :param kv_cache: Passed to the model. Its batch is fixed at 2b so unguided steps
+            still run both branches and keep the conditional one.
+        :return: Prediction (or tuple of predictions) for batch b
+        """
+        assert self.batched_controls is not None, "Call prepare() before sampling"
+        kwargs = {} if kv_cache is None else {"kv_cache" : kv_cache}
+        guided = self.is_guided(t)
+
+        if not guided and kv_cache is None:
+            mouse, btn = (c[:,frames] for c in self.controls)
+            return model(*inputs, ts, mouse, btn, **kwargs)
+
+        mouse, btn = (c[:,frames] for c in self.batched_controls)
+        preds = model(
+            *(torch.cat([x, x], dim=0) for x in inputs),
+            torch.cat([ts, ts], dim=0),
+            mouse, btn, **kwargs
+        )
+
+        def combine(pred):
+            cond_pred, uncond_pred = pred.chunk(2)
+            if not guided:
+                return cond_pred
+            return uncond_pred + self.cfg_scale * (cond_pred - uncond_pred)
+
+        if isinstance(preds, (tuple, list)):
+            return tuple(combine(p) for p in preds)
+        return combine(preds)
+
+@torch.no_grad()
+def bench_cfg(n_steps = 20, n_iters = 3):
+    """
+    Per step cost of the old two-forward CFG against the batched helper, with and without skipped steps
+    """
+    import time
+
+    from ..configs import TransformerConfig
+    from ..models.gamerft import GameRFTCore
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    config = TransformerConfig(
+        n_layers = 4, n_heads = 4, d_model = 256,
+        channels = 16, sample_size = 4, tokens_per_frame = 16,
+        n_buttons = 11, n_frames = 16
+    )
+    model = GameRFTCore(config).to(device).eval()
+
+    b, n = 2, config.n_frames
+    x = torch.randn(b, n, config.channels, 4, 4, device = device)
+    mouse = torch.randn(b, n, 2, device = device)
+    btn = (torch.rand(b, n, 11, device = device) > 0.5).float()
+    ts = torch.ones(b, n, device = device)
+
+    def sync():
+        if device == 'cuda':
+            torch.cuda.synchronize()
+
+    def two_forwards():
+        for _ in range(n_steps):
+            cond_pred = model(x, ts, mouse, btn)
+            uncond_pred = model(x, ts, torch.zeros_like(mouse), torch.zeros_like(btn))
+            uncond_pred + 1.3 * (cond_pred - uncond_pred)
+
+    def helper(skip_steps = None):
+        def run():
+            guidance = CFGGuidance(1.3, skip_steps = skip_steps)
+            timesteps = [1. - i / n_steps for i in range(n_steps + 1)]
+            guidance.prepare(mouse, btn, timesteps)
+            for t in timesteps[:-1]:
+                guidance(model, (x,), ts, t)
+        return run
+
+    runs = [
+        ("two forwards", two_forwards),
+        ("batched", helper()),
+        ("batched, skip last half", helper(range(n_steps // 2, n_steps)))
+    ]
+    print(f"[{b},{n} frames x {config.tokens_per_frame} tokens], {n_steps} steps, {device}")
+    for name, fn in runs:
+        fn()
+        sync()
+        start = time.perf_counter()
+        for _ in range(n_iters):
+            fn()
+        sync()
+        per_step = (time.perf_counter() - start) / n_iters / n_steps
+        print(f"  {name:<26} {per_step*1000:8.2f}ms/step")
+
+if __name__ == "__main__":
+    bench_cfg()
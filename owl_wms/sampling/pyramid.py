@@ -0,0 +1,216 @@
+import torch
+
+from ..utils import batch_permute_to_length
+from .schedules import get_timesteps
+from .guidance import CFGGuidance
+from .window import WindowCFGSampler, RollingWindow, zlerp
+
+class PyramidSampler(WindowCFGSampler):
+    """
+    Diffusion forcing sampler that denoises several frames at once. The last n_parallel frames
+    of the window sit at staggered noise levels and every forward advances all of them by one step.
+    By default a new frame enters every ~n_steps / n_parallel forwards, so once the pyramid is full
+    a frame finishes every ~n_steps / n_parallel forwards (every forward when n_parallel = n_steps)
+    instead of every n_steps like WindowCFGSampler. Every frame still gets n_steps steps.
+
+    Frames at different noise levels share every forward, so this sampler only steps with euler.
+    With n_parallel = 1 it is WindowCFGSampler with the euler solver.
+
+    :param n_steps: Number of diffusion steps for each frame
+    :param n_parallel: Frames being denoised at once (K), must be < window_length
+    :param stagger: Forwards between a frame entering the pyramid and the next one. Either a list,
+        cycled through (K gaps summing to n_steps keep the pyramid K deep), or fn(frame_idx) -> gap.
+        Defaults to n_steps split as evenly as possible into K gaps. A frame never enters while K are pending.
+    :param cfg_scale: CFG scale, the guidance interval is checked against the noisiest frame
+    :param window_length: Number of frames in the window, context and frames being denoised
+    :param num_frames: Number of new frames to sample
+    :param noise_prev: Noise level of the context frames
+    :param only_return_generated: Whether to only return the generated frames
+    :param schedule: Noise level schedule each frame goes through (see schedules.py)
+    :param schedule_kwargs: Extra arguments for the schedule
+    :param guidance_interval: (t_min, t_max), only apply CFG while the noisiest frame is inside it
+    :param skip_cfg_steps: Steps to run without CFG, also checked against the noisiest frame
+    :param output_device: Where the returned frames are kept (i.e. 'cpu' for long rollouts), defaults to the input's device
+    :param pin_memory: Pin CPU output buffers so frames are copied out without blocking
+    :param timer: StageTimer recording the forwards and finished frames (see utils/profiling.py), off if None
+    """
+    def __init__(self, n_steps = 20, n_parallel = 4, stagger = None, cfg_scale = 1.3, window_length = 60, num_frames = 60, noise_prev = 0.2, only_return_generated = False, schedule = "linear", schedule_kwargs = None, guidance_interval = None, skip_cfg_steps = None, output_device = None, pin_memory = True, timer = None):
+        super().__init__(
+            n_steps = n_steps, cfg_scale = cfg_scale, window_length = window_length, num_frames = num_frames,
+            noise_prev = noise_prev, only_return_generated = only_return_generated, schedule = schedule,
+            schedule_kwargs = schedule_kwargs, guidance_interval = guidance_interval, skip_cfg_steps = skip_cfg_steps,
+            output_device = output_device, pin_memory = pin_memory, timer = timer
+        )
+        assert 1 <= n_parallel <= n_steps, "n_parallel must be in [1, n_steps]"
+        assert n_parallel < window_length, "n_parallel must be smaller than window_length"
+        self.n_parallel = n_parallel
+
+        if stagger is None:
+            stagger = [n_steps // n_parallel + int(i < n_steps % n_parallel) for i in range(n_parallel)]
+        if not callable(stagger):
+            assert len(stagger) > 0 and all(g >= 1 for g in stagger), "stagger gaps must be >= 1"
+            gaps = list(stagger)
+            stagger = lambda i: gaps[i % len(gaps)]
+        self.stagger = stagger
+
+    @torch.no_grad()
+    def stream(self, model, dummy_batch, mouse, btn, num_frames = None, decode_fn = None, scale = 1):
+        """
+        Yields every frame as soon as it's finished, see WindowCFGSampler.stream.
+        Controls sent in apply to the next frame that enters the pyramid, which
+        finishes n_parallel frames later.
+        """
+        num_frames = self.num_frames if num_frames is None else num_frames
+        W = self.window_length
+        window = RollingWindow(dummy_batch, W)
+
+        # Own copy since sent controls are written into it
+        mouse, btn = (c.clone() for c in batch_permute_to_length(mouse, btn, num_frames + W))
+
+        timesteps = get_timesteps(self.schedule, self.n_steps, **self.schedule_kwargs)
+        guidance = CFGGuidance(self.cfg_scale, self.guidance_interval, self.skip_cfg_steps)
+        guidance.prepare(mouse, btn, timesteps)
+
+        pending = dummy_batch[:,:0] # Frames being denoised, oldest first
+        steps = [] # Index into timesteps of every pending frame
+        context = None
+        n_started, n_finished = 0, 0
+        changed = True
+
+        while n_finished < num_frames:
+            start_new = n_started < num_frames and len(steps) < self.n_parallel and (
+                not steps or steps[-1] >= self.stagger(n_started - 1)
+            )
+            if start_new or changed:
+                # Context is renoised whenever the window changes, like WindowCFGSampler does every frame
+                with self.timer.stage("noise_context"):
+                    clean_history = window.view()
+                    n_ctx = min(clean_history.shape[1], W - len(steps) - int(start_new))
+                    context = zlerp(clean_history[:,clean_history.shape[1]-n_ctx:], self.noise_prev)
+                if start_new:
+                    pending = torch.cat([pending, torch.randn_like(dummy_batch[:,:1])], dim = 1)
+                    steps.append(0)
+                    n_started += 1
+                changed = False
+
+            k = len(steps)
+            x = torch.cat([context, pending], dim = 1)
+            ts = torch.full(x.shape[:2], self.noise_prev, device = x.device, dtype = x.dtype)
+            ts[:,-k:] = torch.tensor([timesteps[s] for s in steps], device = x.device, dtype = x.dtype)
+
+            # Window ends at the newest frame, frame i's controls are at i + W - 1
+            frames = slice(n_started - 1 + W - x.shape[1], n_started - 1 + W)
+            with self.timer.stage("diffusion_step"):
+                v = guidance(model, (x,), ts, timesteps[steps[-1]], frames)[:,-k:]
+
+            # Euler step, every frame has its own dt
+            dt = torch.tensor([timesteps[s+1] - timesteps[s] for s in steps], device = x.device, dtype = x.dtype)
+            pending = pending + v * dt.view(1, k, *([1] * (x.ndim - 2)))
+            steps = [s + 1 for s in steps]
+
+            if steps[0] == self.n_steps:
+                new_frame = pending[:,:1].clone()
+                pending = pending[:,1:]
+                steps = steps[1:]
+                window.append(new_frame)
+                n_finished += 1
+                changed = True
+
+                sent = yield new_frame if decode_fn is None else decode_fn(new_frame * scale)
+                if sent is not None:
+                    next_mouse, next_btn = (c if c.ndim == 2 else c[:,-1] for c in sent)
+                    guidance.set_controls(n_started + W - 1, next_mouse, next_btn)
+
+@torch.no_grad()
+def test_pyramid_sampler():
+    """
+    n_parallel = 1 should match WindowCFGSampler, more parallel frames should take fewer forwards
+    """
+    from ..configs import TransformerConfig
+    from ..models.gamerft import GameRFTCore
+
+    config = TransformerConfig(
+        n_layers = 3, n_heads = 4, d_model = 128,
+        channels = 16, sample_size = 2, tokens_per_frame = 4,
+        n_buttons = 11, n_frames = 16
+    )
+    model = GameRFTCore(config).eval()
+    n_calls = [0]
+    def counted(*args, **kwargs):
+        n_calls[0] += 1
+        return model(*args, **kwargs)
+
+    history = torch.randn(2, 16, config.channels, 2, 2)
+    mouse = torch.randn(2, 16, 2)
+    btn = (torch.rand(2, 16, 11) > 0.5).float()
+    kwargs = dict(n_steps = 8, window_length = 16, num_frames = 6, only_return_generated = True)
+
+    torch.manual_seed(0)
+    expected = WindowCFGSampler(**kwargs)(model, history, mouse, btn)[0]
+    torch.manual_seed(0)
+    out = PyramidSampler(n_parallel = 1, **kwargs)(model, history, mouse, btn)[0]
+    err = (out - expected).abs().max().item()
+    assert err < 1.0e-5, f"n_parallel=1 differs from WindowCFGSampler by {err}"
+
+    for n_parallel in [1, 2, 4, 8]:
+        n_calls[0] = 0
+        out = PyramidSampler(n_parallel = n_parallel, **kwargs)(counted, history, mouse, btn)[0]
+        assert out.shape == expected.shape and torch.isfinite(out).all()
+        print(f"n_parallel={n_parallel}: {n_calls[0] / kwargs['num_frames']:.2f} forwards/frame")
+
+    # K that doesn't divide n_steps, and a non-uniform stagger given as a list or a function
+    n_calls[0] = 0
+    out = PyramidSampler(n_parallel = 3, **kwargs)(counted, history, mouse, btn)[0]
+    assert torch.isfinite(out).all() and n_calls[0] < 8 * kwargs["num_frames"] / 2, n_calls[0]
+    outs = []
+    for stagger in [[1, 1, 6], lambda i: [1, 1, 6][i % 3]]:
+        n_calls[0] = 0
+        torch.manual_seed(1)
+        outs.append(PyramidSampler(n_parallel = 3, stagger = stagger, **kwargs)(counted, history, mouse, btn)[0])
+        # Frames enter at forwards 0, 1, 2, 8, 9, 10 and each takes 8 steps
+        assert n_calls[0] == 18, f"{n_calls[0]} forwards for stagger [1, 1, 6]"
+    assert torch.equal(outs[0], outs[1]), "List and function stagger differ"
+
+    # skip_cfg_steps goes through to the guidance
+    torch.manual_seed(0)
+    unguided = PyramidSampler(n_parallel = 2, cfg_scale = 1.0, **kwargs)(model, history, mouse, btn)[0]
+    torch.manual_seed(0)
+    skipped = PyramidSampler(n_parallel = 2, skip_cfg_steps = range(8), **kwargs)(model, history, mouse, btn)[0]
+    assert (skipped - unguided).abs().max() < 1.0e-5, "skip_cfg_steps ignored"
+    print("Pyramid sampler OK")
+
+@torch.no_grad()
+def bench_pyramid(n_steps = 8, num_frames = 32):
+    """
+    Frames per second of the pyramid sampler for different n_parallel on a small GameRFTCore
+    """
+    import time
+
+    from ..configs import TransformerConfig
+    from ..models.gamerft import GameRFTCore
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    config = TransformerConfig(
+        n_layers = 4, n_heads = 4, d_model = 256,
+        channels = 16, sample_size = 4, tokens_per_frame = 16,
+        n_buttons = 11, n_frames = 16
+    )
+    model = GameRFTCore(config).to(device).eval()
+    history = torch.randn(1, 16, config.channels, 4, 4, device = device)
+    mouse = torch.randn(1, 16, 2, device = device)
+    btn = (torch.rand(1, 16, 11, device = device) > 0.5).float()
+
+    print(f"{n_steps} steps, window 16, {num_frames} frames, {device}")
+    for n_parallel in [1, 2, 4, 8]:
+        sampler = PyramidSampler(n_steps = n_steps, n_parallel = n_parallel, window_length = 16, num_frames = num_frames)
+        start = time.perf_counter()
+        for _ in sampler.stream(model, history, mouse, btn):
+            pass
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        fps = num_frames / (time.perf_counter() - start)
+        print(f"  n_parallel={n_parallel}: {fps:6.1f} frames/s")
+
+if __name__ == "__main__":
+    test_pyramid_sampler()
+    bench_pyramid()
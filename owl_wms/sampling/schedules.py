@@ -0,0 +1,158 @@
+"""
+Noise level schedules for sampling, shared by every sampler.
+
+A schedule is a list of n_steps + 1 noise levels going from 1 (noise) to 0 (data).
+Solvers take one step between each consecutive pair.
+
+Pick one with sampler_kwargs (schedule, schedule_kwargs).
+"""
+
+import math
+from statistics import NormalDist
+
+def linear(n_steps):
+    """
+    Uniform steps, same as dt = 1/n_steps
+    """
+    return [1. - i / n_steps for i in range(n_steps + 1)]
+
+def shifted(n_steps, shift = 3.0):
+    """
+    Linear steps warped by t -> shift*t / (1 + (shift-1)*t) (SD3 style),
+    shift > 1 spends more steps at high noise
+    """
+    return [shift * t / (1. + (shift - 1.) * t) for t in linear(n_steps)]
+
+def logit_normal(n_steps, mean = 0.0, std = 1.0):
+    """
+    Quantiles of the logit-normal distribution training draws noise levels from
+    (sigmoid(mean + std * randn)), so every step covers the same probability mass
+    """
+    normal = NormalDist(mean, std)
+    ts = [1.]
+    for i in range(1, n_steps):
+        ts.append(1. / (1. + math.exp(-normal.inv_cdf(1. - i / n_steps))))
+    ts.append(0.)
+    return ts
+
+def cosine(n_steps):
+    """
+    Same log-SNR spacing as the cosine schedule: (1-t)/t = cot(pi/2 * s) for uniform s
+    """
+    ts = []
+    for i in range(n_steps + 1):
+        s = 1. - i / n_steps
+        sin, cos = math.sin(math.pi / 2 * s), math.cos(math.pi / 2 * s)
+        ts.append(sin / (sin + cos))
+    ts[0], ts[-1] = 1., 0.
+    return ts
+
+def custom(n_steps = None, sigmas = None):
+    """
+    User given noise levels, must be decreasing in [0,1]. A final 0 is added if missing.
+    n_steps is ignored (it's len(sigmas) - 1).
+    """
+    assert sigmas is not None and len(sigmas) > 0, "custom schedule needs sigmas"
+    ts = [float(t) for t in sigmas]
+    if ts[-1] != 0.:
+        ts.append(0.)
+    assert all(0. <= t <= 1. for t in ts), "sigmas must be in [0,1]"
+    assert all(a > b for a, b in zip(ts[:-1], ts[1:])), "sigmas must be decreasing"
+    return ts
+
+SCHEDULES = {
+    "linear" : linear,
+    "shifted" : shifted,
+    "logit_normal" : logit_normal,
+    "cosine" : cosine,
+    "custom" : custom
+}
+
+def get_timesteps(schedule = "linear", n_steps = 20, **schedule_kwargs):
+    """
+    :return: List of n_steps + 1 python floats from 1 to 0
+    """
+    if schedule not in SCHEDULES:
+        raise ValueError(f"Unknown schedule {schedule}, options are {list(SCHEDULES)}")
+    return SCHEDULES[schedule](n_steps, **schedule_kwargs)
+
+def sweep_steps(run_fn, schedules = None, tolerance = 1.0e-2, max_steps = 32, ref_steps = 100):
+    """
+    Fewest steps each schedule needs to stay within tolerance of a many-step reference.
+
+    :param run_fn: run_fn(schedule, schedule_kwargs, n_steps) -> output tensor. Must use fixed seeds
+        so only the schedule changes between calls.
+    :param schedules: List of (schedule, schedule_kwargs), defaults to every built in schedule
+    :param tolerance: Max relative L2 error against the reference
+    :param ref_steps: Steps of the linear reference
+    :return: {schedule name: (n_steps, error)}, n_steps is None if max_steps isn't enough
+    """
+    if schedules is None:
+        schedules = [(schedule, {}) for schedule in SCHEDULES if schedule != "custom"]
+
+    ref = run_fn("linear", {}, ref_steps).float()
+    results = {}
+    print(f"Fewest steps within {tolerance} relative error of {ref_steps} linear steps")
+    for schedule, schedule_kwargs in schedules:
+        name = schedule + "".join(f" {k}={v}" for k, v in schedule_kwargs.items())
+        results[name] = (None, None)
+        for n_steps in range(1, max_steps + 1):
+            out = run_fn(schedule, schedule_kwargs, n_steps).float()
+            err = ((out - ref).norm() / ref.norm()).item()
+            if err <= tolerance:
+                results[name] = (n_steps, err)
+                break
+
+        n_steps, err = results[name]
+        if n_steps is None:
+            print(f"  {name:<28} > {max_steps} steps")
+        else:
+            print(f"  {name:<28} {n_steps:4d} steps  ({err:.4f})")
+    return results
+
+def test_schedules():
+    for schedule in SCHEDULES:
+        kwargs = {"sigmas" : [1.0, 0.7, 0.3]} if schedule == "custom" else {}
+        ts = get_timesteps(schedule, 8, **kwargs)
+        assert ts[0] == 1. and ts[-1] == 0., f"{schedule} doesn't go from 1 to 0"
+        assert all(a > b for a, b in zip(ts[:-1], ts[1:])), f"{schedule} isn't decreasing"
+        if schedule != "custom":
+            assert len(ts) == 9, f"{schedule} has the wrong number of steps"
+    print("Schedules OK")
+
+def sweep_schedules(tolerance = 1.0e-2, solver = "euler"):
+    """
+    Runs the sweep on CFGSampler with a small randomly initialized GameRFTCore
+    """
+    import torch
+
+    from ..configs import TransformerConfig
+    from ..models.gamerft import GameRFTCore
+    from .cfg import CFGSampler
+
+    config = TransformerConfig(
+        n_layers = 3, n_heads = 4, d_model = 128,
+        channels = 16, sample_size = 2, tokens_per_frame = 4,
+        n_buttons = 11, n_frames = 8
+    )
+    torch.manual_seed(0)
+    model = GameRFTCore(config).eval()
+    dummy = torch.randn(2, 8, config.channels, 2, 2)
+    mouse = torch.randn(2, 8, 2)
+    btn = (torch.rand(2, 8, 11) > 0.5).float()
+
+    @torch.no_grad()
+    def run_fn(schedule, schedule_kwargs, n_steps):
+        sampler = CFGSampler(n_steps = n_steps, solver = solver, schedule = schedule, schedule_kwargs = schedule_kwargs)
+        torch.manual_seed(1)
+        return sampler(model, dummy, mouse, btn)[0]
+
+    return sweep_steps(
+        run_fn, tolerance = tolerance,
+        schedules = [("linear", {}), ("shifted", {"shift" : 3.0}), ("shifted", {"shift" : 0.5}),
+            ("logit_normal", {}), ("cosine", {})]
+    )
+
+if __name__ == "__main__":
+    test_schedules()
+    sweep_schedules()
@@ -2,49 +2,48 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 
+from .solvers import get_solver
+from .schedules import get_timesteps
+
 class SimpleSampler:
-    def __init__(self, n_steps=64):
+    def __init__(self, n_steps=64, solver="euler", solver_kwargs=None, schedule="linear", schedule_kwargs=None):
         self.n_steps = n_steps
+        self.solver = get_solver(solver, **(solver_kwargs or {}))
+        self.schedule = schedule
+        self.schedule_kwargs = schedule_kwargs or {}
 
     @torch.no_grad()
     def __call__(self, model, dummy_batch, mouse, btn, decode_fn = None, scale = 1):
-        sampling_steps = self.n_steps
         x = torch.randn_like(dummy_batch)
-        ts = torch.ones(x.shape[0], device=x.device,dtype=x.dtype)
-        dt = 1. / sampling_steps
 
-        for _ in range(sampling_steps):
-            pred = model(x, ts, mouse, btn)
-            x = x - pred*dt
-            ts = ts - dt
+        def fn(x, t):
+            ts = torch.full((x.shape[0],), t, device=x.device, dtype=x.dtype)
+            return model(x, ts, mouse, btn)
+
+        x = self.solver.solve(fn, x, get_timesteps(self.schedule, self.n_steps, **self.schedule_kwargs))
 
         if decode_fn is not None:
             x = x * scale
             x = decode_fn(x)
         return x, mouse, btn
 
-class InpaintSimpleSampler:
-    def __init__(self, n_steps=64):
-        self.n_steps = n_steps
-
+class InpaintSimpleSampler(SimpleSampler):
     @torch.no_grad()
     def __call__(self, model, dummy_batch, mouse, btn, decode_fn = None, scale = 1):
-        sampling_steps = self.n_steps
-
         x = torch.randn_like(dummy_batch)
         ts = torch.ones(x.shape[0], x.shape[1], device=x.device, dtype=x.dtype)
-        dt = 1. / sampling_steps
         
         # Calculate midpoint
         mid = x.shape[1] // 2
         x[:,:mid] = dummy_batch[:,:mid]
         
-        for _ in range(sampling_steps):
-            pred = model(x, ts, mouse, btn)
-            
-            # Only update second half
-            x[:, mid:] = x[:, mid:] - pred[:, mid:]*dt
-            ts[:, mid:] = ts[:, mid:] - dt
+        # Only the second half is integrated, the first half stays clean
+        def fn(x_gen, t):
+            ts[:, mid:] = t
+            pred = model(torch.cat([x[:,:mid], x_gen], dim=1), ts, mouse, btn)
+            return pred[:, mid:]
+
+        x[:, mid:] = self.solver.solve(fn, x[:, mid:], get_timesteps(self.schedule, self.n_steps, **self.schedule_kwargs))
 
         if decode_fn is not None:
             x = x * scale
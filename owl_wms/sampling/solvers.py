@@ -0,0 +1,242 @@
+"""
+ODE solvers for rectified flow sampling, shared by every sampler.
+
+The model predicts the velocity v = z - x0 at noise level t (1 = noise, 0 = data),
+so sampling integrates dx/dt = v from t = 1 down to t = 0.
+
+Solvers are driven through solve(fn, x, timesteps) where fn(x, t) returns the velocity
+for state x at (python float) noise level t. x can be a tensor or a tuple of tensors
+(i.e. video and audio latents) that are integrated together.
+
+Pick one with sampler_kwargs (solver, solver_kwargs).
+"""
+
+import numpy as np
+import torch
+
+from .schedules import get_timesteps
+
+def _lincomb(terms):
+    # sum(w * x) over (w, x) pairs, x being tensors or matching tuples of tensors
+    first = terms[0][1]
+    if isinstance(first, (tuple, list)):
+        return tuple(_lincomb([(w, x[i]) for w, x in terms]) for i in range(len(first)))
+    out = first * terms[0][0]
+    for w, x in terms[1:]:
+        out = out + x * w
+    return out
+
+class Solver:
+    """
+    Base solver, subclasses implement step(). Multistep solvers keep history between
+    steps of one solve() call.
+    """
+    # Model evaluations per step
+    evals_per_step = 1
+
+    def reset(self):
+        pass
+
+    def step(self, fn, x, t, t_next):
+        raise NotImplementedError
+
+    def solve(self, fn, x, timesteps):
+        """
+        Integrate x from timesteps[0] to timesteps[-1]
+        """
+        self.reset()
+        for t, t_next in zip(timesteps[:-1], timesteps[1:]):
+            x = self.step(fn, x, float(t), float(t_next))
+        return x
+
+class Euler(Solver):
+    def step(self, fn, x, t, t_next):
+        return _lincomb([(1., x), (t_next - t, fn(x, t))])
+
+class Heun(Solver):
+    """
+    Second order predictor-corrector. The step to t = 0 is a plain Euler step,
+    like EDM, since it gains nothing from the correction.
+    """
+    evals_per_step = 2
+
+    def step(self, fn, x, t, t_next):
+        dt = t_next - t
+        v = fn(x, t)
+        x_euler = _lincomb([(1., x), (dt, v)])
+        if t_next <= 0.:
+            return x_euler
+        v_next = fn(x_euler, t_next)
+        return _lincomb([(1., x), (dt / 2, v), (dt / 2, v_next)])
+
+class Midpoint(Solver):
+    evals_per_step = 2
+
+    def step(self, fn, x, t, t_next):
+        dt = t_next - t
+        x_mid = _lincomb([(1., x), (dt / 2, fn(x, t))])
+        return _lincomb([(1., x), (dt, fn(x_mid, t + dt / 2))])
+
+class AdamsBashforth(Solver):
+    """
+    Explicit multistep: integrates the polynomial through the last `order` velocities,
+    handles non-uniform steps. Warms up with lower orders.
+    """
+    def __init__(self, order = 2):
+        assert 1 <= order <= 4, "order must be in [1,4]"
+        self.order = order
+        self.reset()
+
+    def reset(self):
+        self.history = [] # (t, v), most recent last
+
+    def step(self, fn, x, t, t_next):
+        self.history.append((t, fn(x, t)))
+        self.history = self.history[-self.order:]
+
+        ts = np.array([h[0] for h in self.history], dtype = np.float64)
+        weights = []
+        for i in range(len(ts)):
+            # Lagrange basis for node i, integrated over [t, t_next]
+            others = np.delete(ts, i)
+            basis = np.poly1d(np.poly(others)) / np.prod(ts[i] - others)
+            integral = np.polyint(basis)
+            weights.append(float(integral(t_next) - integral(t)))
+
+        return _lincomb([(1., x)] + [(w, h[1]) for w, h in zip(weights, self.history)])
+
+class DPMSolverPP(Solver):
+    """
+    DPM-Solver++(2M) in data prediction form. For rectified flow alpha_t = 1 - t,
+    sigma_t = t and the data prediction is x0 = x - t * v.
+    First order on the first step (t = 1, where lambda is -inf) and the last (t_next = 0).
+    """
+    def __init__(self, order = 2):
+        assert order in [1, 2], "order must be 1 or 2"
+        self.order = order
+        self.reset()
+
+    def reset(self):
+        self.prev = None # (lambda, x0) of the previous step
+
+    @staticmethod
+    def _lambda(t):
+        if t >= 1.:
+            return -np.inf
+        if t <= 0.:
+            return np.inf
+        return float(np.log((1. - t) / t))
+
+    def step(self, fn, x, t, t_next):
+        x0 = _lincomb([(1., x), (-t, fn(x, t))])
+        lam, lam_next = self._lambda(t), self._lambda(t_next)
+
+        d = x0
+        if self.order == 2 and self.prev is not None and np.isfinite(self.prev[0]) and np.isfinite(lam_next):
+            r = (lam - self.prev[0]) / (lam_next - lam)
+            d = _lincomb([(1. + 1. / (2 * r), x0), (-1. / (2 * r), self.prev[1])])
+        self.prev = (lam, x0)
+
+        if t_next <= 0.:
+            return d
+        # exp(-h) = (alpha_t * sigma_next) / (sigma_t * alpha_next), 0 at t = 1
+        exp_neg_h = ((1. - t) * t_next) / (t * (1. - t_next))
+        return _lincomb([(t_next / t, x), ((1. - t_next) * (1. - exp_neg_h), d)])
+
+SOLVERS = {
+    "euler" : Euler,
+    "heun" : Heun,
+    "midpoint" : Midpoint,
+    "adams_bashforth" : AdamsBashforth,
+    "dpmpp" : DPMSolverPP
+}
+
+def get_solver(solver_id = "euler", **solver_kwargs):
+    if solver_id not in SOLVERS:
+        raise ValueError(f"Unknown solver {solver_id}, options are {list(SOLVERS)}")
+    return SOLVERS[solver_id](**solver_kwargs)
+
+def solver_error_harness(run_fn, budgets = (4, 8, 16), solvers = None, ref_steps = 100):
+    """
+    Error of every solver against a ref_steps Euler reference, at a given number of model evaluations.
+
+    :param run_fn: run_fn(solver_id, solver_kwargs, n_steps) -> output tensor. Must use fixed seeds
+        so only the solver changes between calls.
+    :param budgets: Model evaluations per sample (per frame for window samplers)
+    :param solvers: List of (solver_id, solver_kwargs), defaults to every solver with default kwargs
+    :return: {(solver name, budget): relative L2 error}
+    """
+    if solvers is None:
+        solvers = [(solver_id, {}) for solver_id in SOLVERS]
+
+    ref = run_fn("euler", {}, ref_steps).float()
+    results = {}
+    print(f"Relative error vs {ref_steps} step Euler")
+    print(f"{'solver':<22}" + "".join(f"{b:>10d}" for b in budgets) + "  (velocity evals)")
+    for solver_id, solver_kwargs in solvers:
+        name = solver_id + "".join(f" {k}={v}" for k, v in solver_kwargs.items())
+        evals_per_step = SOLVERS[solver_id].evals_per_step
+        for budget in budgets:
+            n_steps = max(budget // evals_per_step, 1)
+            out = run_fn(solver_id, solver_kwargs, n_steps).float()
+            results[(name, budget)] = ((out - ref).norm() / ref.norm()).item()
+        print(f"{name:<22}" + "".join(f"{results[(name, b)]:10.4f}" for b in budgets))
+    return results
+
+def test_solvers_converge():
+    # Every solver should get closer to the exact solution as steps increase on a known flow.
+    # Data ~ N(mu, s^2) so the optimal velocity is available in closed form.
+    mu, s = 2.0, 0.5
+
+    def velocity(x, t):
+        # E[z - x0 | x_t], x_t = (1-t) x0 + t z
+        var = (1 - t) ** 2 * s ** 2 + t ** 2
+        x0_mean = mu + (1 - t) * s ** 2 * (x - (1 - t) * mu) / var
+        z_mean = (x - (1 - t) * x0_mean) / max(t, 1e-8)
+        return z_mean - x0_mean
+
+    z = torch.randn(4096, dtype = torch.float64)
+    exact = mu + s * z # The flow maps z to its quantile in the data distribution
+
+    for solver_id in SOLVERS:
+        errs = []
+        for n_steps in [4, 16, 64]:
+            out = get_solver(solver_id).solve(velocity, z.clone(), get_timesteps("linear", n_steps))
+            errs.append((out - exact).abs().max().item())
+        assert errs[-1] < errs[0] and errs[-1] < 5.0e-2, f"{solver_id} doesn't converge: {errs}"
+    print("Solvers converge OK")
+
+@torch.no_grad()
+def bench_solvers(budgets = (4, 8, 16), ref_steps = 100):
+    """
+    Runs the harness on CFGSampler with a small randomly initialized GameRFTCore
+    """
+    from ..configs import TransformerConfig
+    from ..models.gamerft import GameRFTCore
+    from .cfg import CFGSampler
+
+    config = TransformerConfig(
+        n_layers = 3, n_heads = 4, d_model = 128,
+        channels = 16, sample_size = 2, tokens_per_frame = 4,
+        n_buttons = 11, n_frames = 8
+    )
+    torch.manual_seed(0)
+    model = GameRFTCore(config).eval()
+    dummy = torch.randn(2, 8, config.channels, 2, 2)
+    mouse = torch.randn(2, 8, 2)
+    btn = (torch.rand(2, 8, 11) > 0.5).float()
+
+    def run_fn(solver_id, solver_kwargs, n_steps):
+        sampler = CFGSampler(n_steps = n_steps, solver = solver_id, solver_kwargs = solver_kwargs)
+        torch.manual_seed(1)
+        return sampler(model, dummy, mouse, btn)[0]
+
+    return solver_error_harness(
+        run_fn, budgets, ref_steps = ref_steps,
+        solvers = [("euler", {}), ("heun", {}), ("midpoint", {}), ("adams_bashforth", {"order" : 2}),
+            ("adams_bashforth", {"order" : 3}), ("dpmpp", {})]
+    )
+
+if __name__ == "__main__":
+    test_solvers_converge()
+    bench_solvers()
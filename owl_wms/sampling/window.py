@@ -5,11 +5,55 @@ import torch.nn.functional as F
 from tqdm import tqdm
 
 from ..utils import batch_permute_to_length
+from ..nn.kv_cache import KVCache
+from .solvers import get_solver
+from .schedules import get_timesteps
+from .guidance import CFGGuidance
+from ..utils.profiling import StageTimer
 
 def zlerp(x, alpha):
     z = torch.randn_like(x)
     return x * (1. - alpha) + z * alpha
 
+class RollingWindow:
+    """
+    Last window_length frames of a rollout, kept on device in a [b, 2*window_length, ...] buffer.
+    Frames are appended in place and the buffer is compacted once every window_length frames,
+    so the cost per frame is constant no matter how long the rollout gets.
+    """
+    def __init__(self, history, window_length):
+        b, n = history.shape[:2]
+        self.window_length = window_length
+        self.buffer = history.new_empty(b, 2 * window_length, *history.shape[2:])
+
+        n_keep = min(n, window_length)
+        self.buffer[:,:n_keep] = history[:,-n_keep:]
+        self.start, self.end = 0, n_keep
+
+    def view(self):
+        return self.buffer[:,self.start:self.end]
+
+    def append(self, frame):
+        # frame is [b,1,...]
+        if self.end == self.buffer.shape[1]:
+            # Move the frames that stay in the window to the front (source and destination don't overlap)
+            n_keep = self.window_length - 1
+            self.buffer[:,:n_keep] = self.buffer[:,self.end-n_keep:self.end]
+            self.start, self.end = 0, n_keep
+
+        self.buffer[:,self.end:self.end+1] = frame
+        self.end += 1
+        self.start = max(self.start, self.end - self.window_length)
+
+def alloc_output(like, n_frames, device = None, pin_memory = True):
+    """
+    [b, n_frames, ...] buffer for a rollout, on device (defaults to like's device).
+    CPU buffers are pinned when CUDA is available so frames can be copied out asynchronously.
+    """
+    device = like.device if device is None else torch.device(device)
+    pin = pin_memory and device.type == 'cpu' and like.is_cuda
+    return torch.empty(like.shape[0], n_frames, *like.shape[2:], dtype = like.dtype, device = device, pin_memory = pin)
+
 class WindowCFGSampler:
     """
     Window CFG Sampler samples new frames one by one, by inpainting the final frame.
@@ -21,14 +65,35 @@ class WindowCFGSampler:
     :param num_frames: Number of new frames to sample
     :param noise_prev: Noise previous frame
     :param only_return_generated: Whether to only return the generated frames
+    :param use_kv_cache: For causal models, run the noised context once per frame to fill a KV cache
+        and only run the new frame for every diffusion step. Matches the uncached sampler when
+        window_length is the model's n_frames (learned positions line up).
+    :param solver: ODE solver for each frame (see solvers.py)
+    :param solver_kwargs: Extra arguments for the solver
+    :param schedule: Noise level schedule for each frame (see schedules.py)
+    :param schedule_kwargs: Extra arguments for the schedule
+    :param guidance_interval: (t_min, t_max), only apply CFG at noise levels inside it
+    :param skip_cfg_steps: Steps (of each frame) to run without CFG
+    :param output_device: Where the returned frames are kept (i.e. 'cpu' for long rollouts), defaults to the input's device
+    :param pin_memory: Pin CPU output buffers so frames are copied out without blocking
+    :param timer: StageTimer recording every stage of a frame (see utils/profiling.py), off if None
     """
-    def __init__(self, n_steps = 20, cfg_scale = 1.3, window_length = 60, num_frames = 60, noise_prev = 0.2, only_return_generated = False):
+    def __init__(self, n_steps = 20, cfg_scale = 1.3, window_length = 60, num_frames = 60, noise_prev = 0.2, only_return_generated = False, use_kv_cache = False, solver = "euler", solver_kwargs = None, schedule = "linear", schedule_kwargs = None, guidance_interval = None, skip_cfg_steps = None, output_device = None, pin_memory = True, timer = None):
         self.n_steps = n_steps
         self.cfg_scale = cfg_scale
         self.window_length = window_length
         self.num_frames = num_frames
         self.noise_prev = noise_prev
         self.only_return_generated = only_return_generated
+        self.use_kv_cache = use_kv_cache
+        self.solver = get_solver(solver, **(solver_kwargs or {}))
+        self.schedule = schedule
+        self.schedule_kwargs = schedule_kwargs or {}
+        self.guidance_interval = guidance_interval
+        self.skip_cfg_steps = skip_cfg_steps
+        self.output_device = output_device
+        self.pin_memory = pin_memory
+        self.timer = timer or StageTimer(enabled = False)
 
     @torch.no_grad()
     def __call__(self, model, dummy_batch, mouse, btn, decode_fn = None, scale = 1):
@@ -38,60 +103,28 @@ class WindowCFGSampler:
 
         # output will be [b,n+self.num_frames,c,h,w]
         
-        sampling_steps = self.n_steps
         num_frames = self.num_frames
+        n = dummy_batch.shape[1]
 
-        dt = 1. / sampling_steps
-
-        clean_history = dummy_batch.clone()
+        # Finished frames are written straight to the output, only the window lives on device
+        if self.only_return_generated:
+            x = alloc_output(dummy_batch, num_frames, self.output_device, self.pin_memory)
+            offset = 0
+        else:
+            x = alloc_output(dummy_batch, n + num_frames, self.output_device, self.pin_memory)
+            x[:,:n] = dummy_batch
+            offset = n
         
         extended_mouse, extended_btn = batch_permute_to_length(mouse, btn, num_frames + self.window_length)
 
-        def step_history():
-            new_history = clean_history.clone()[:,-self.window_length:] # last 60 frames
-            b,n,c,h,w = new_history.shape
+        frames = self.stream(model, dummy_batch, extended_mouse, extended_btn, num_frames)
+        for frame_idx, new_frame in enumerate(tqdm(frames, total = num_frames)):
+            x[:,offset+frame_idx:offset+frame_idx+1].copy_(new_frame, non_blocking = x.is_pinned())
 
-            new_history[:,:-1] = zlerp(new_history[:,1:],self.noise_prev) # pop off first frame and noise context
-            new_history[:,-1] = torch.randn_like(new_history[:,0]) # Add noise to last
-            return new_history
+        if x.is_pinned():
+            torch.cuda.current_stream().synchronize()
 
-        for frame_idx in tqdm(range(num_frames)):
-            local_history = step_history()
-            ts_history = torch.ones(local_history.shape[0], local_history.shape[1], device=local_history.device,dtype=local_history.dtype)
-            ts_history[:,:-1] = self.noise_prev
-
-            mouse = extended_mouse[:,frame_idx:frame_idx+self.window_length]
-            btn = extended_btn[:,frame_idx:frame_idx+self.window_length]
-
-            mouse_batch = torch.cat([mouse, torch.zeros_like(mouse)], dim=0) 
-            btn_batch = torch.cat([btn, torch.zeros_like(btn)], dim=0)
-            for _ in range(sampling_steps):
-                # CFG Branches
-                x = local_history.clone()
-                ts = ts_history.clone()
-
-                x_batch = torch.cat([x, x], dim=0)
-                ts_batch = torch.cat([ts, ts], dim=0)
-                
-                pred_batch = model(x_batch, ts_batch, mouse_batch, btn_batch)
-                
-                # Split predictions back into conditional and unconditional
-                cond_pred, uncond_pred = pred_batch.chunk(2)
-                pred = uncond_pred + self.cfg_scale * (cond_pred - uncond_pred)
-                
-                x = x - pred*dt
-                ts = ts - dt
-
-                local_history[:,-1] = x[:,-1]
-                ts_history[:,-1] = ts[:,-1]
-            
-            # Frame is entirely cleaned now
-            new_frame = local_history[:,-1:]
-            clean_history = torch.cat([clean_history, new_frame], dim = 1)
-
-        x = clean_history
         if self.only_return_generated:
-            x = x[:,-num_frames:]
             extended_mouse = extended_mouse[:,-num_frames:]
             extended_btn = extended_btn[:,-num_frames:]
 
@@ -101,6 +134,123 @@ class WindowCFGSampler:
     
         return x, extended_mouse, extended_btn
 
+    @torch.no_grad()
+    def stream(self, model, dummy_batch, mouse, btn, num_frames = None, decode_fn = None, scale = 1):
+        """
+        Generator version of __call__, yields every new frame as soon as it's denoised:
+        [b,1,c,h,w] latents, or decode_fn(frame * scale) if decode_fn is given.
+
+        Controls for the next frame can be sent in between frames,
+        frame = frames.send((mouse, btn)) with mouse [b,2] and btn [b,n_button] (or [b,1,...]).
+        Frames nothing was sent for use mouse/btn extended to the rollout length, like __call__.
+        To decode in the background instead, wrap the latents with utils.decode_worker.pipelined.
+
+        :param num_frames: Frames to generate, defaults to self.num_frames
+        """
+        num_frames = self.num_frames if num_frames is None else num_frames
+        window = RollingWindow(dummy_batch, self.window_length)
+
+        # Own copy since sent controls are written into it
+        mouse, btn = (c.clone() for c in batch_permute_to_length(mouse, btn, num_frames + self.window_length))
+
+        kv_cache = None
+        if self.use_kv_cache:
+            assert model.config.causal, "KV cached sampling needs a causal model"
+            kv_cache = KVCache(model.config).to(dummy_batch.device, self.get_cache_dtype(model, dummy_batch.device))
+
+        timesteps = get_timesteps(self.schedule, self.n_steps, **self.schedule_kwargs)
+        guidance = CFGGuidance(self.cfg_scale, self.guidance_interval, self.skip_cfg_steps)
+        guidance.prepare(mouse, btn, timesteps)
+
+        def step_history():
+            clean_history = window.view() # last 60 frames
+            new_history = torch.empty_like(clean_history)
+
+            new_history[:,:-1] = zlerp(clean_history[:,1:],self.noise_prev) # pop off first frame and noise context
+            new_history[:,-1] = torch.randn_like(new_history[:,0]) # Add noise to last
+            return new_history
+
+        timer = self.timer
+        for frame_idx in range(num_frames):
+            with timer.frame():
+                with timer.stage("noise_context"):
+                    local_history = step_history()
+                    ts_history = torch.ones(local_history.shape[0], local_history.shape[1], device=local_history.device,dtype=local_history.dtype)
+                    ts_history[:,:-1] = self.noise_prev
+
+                frames = slice(frame_idx, frame_idx + self.window_length)
+                if kv_cache is not None:
+                    self.sample_frame_cached(model, guidance, timesteps, frames, kv_cache, local_history, ts_history)
+                else:
+                    self.sample_frame(model, guidance, timesteps, frames, local_history, ts_history)
+
+                # Frame is entirely cleaned now
+                new_frame = local_history[:,-1:].clone()
+                window.append(new_frame)
+
+                if decode_fn is not None:
+                    with timer.stage("decode_video"):
+                        new_frame = decode_fn(new_frame * scale)
+
+            sent = yield new_frame
+            if sent is not None:
+                with timer.stage("control_ingest"):
+                    # The next frame is the last one of its window
+                    next_mouse, next_btn = (c if c.ndim == 2 else c[:,-1] for c in sent)
+                    guidance.set_controls(frame_idx + self.window_length, next_mouse, next_btn)
+
+    @staticmethod
+    def get_cache_dtype(model, device):
+        # K/V come out of the qkv projections, in the autocast dtype if autocast is on
+        device_type = torch.device(device).type
+        if torch.is_autocast_enabled(device_type):
+            return torch.get_autocast_dtype(device_type)
+        return next(model.parameters()).dtype
+
+    def sample_frame(self, model, guidance, timesteps, frames, local_history, ts_history):
+        """
+        Denoises the last frame of local_history in place, running the whole window every step.
+        frames selects the window's controls from the ones guidance was prepared with.
+        """
+        def fn(x_last, t):
+            x = local_history.clone()
+            ts = ts_history.clone()
+            x[:,-1:] = x_last
+            ts[:,-1] = t
+            with self.timer.stage("diffusion_step"):
+                return guidance(model, (x,), ts, t, frames)[:,-1:]
+
+        local_history[:,-1:] = self.solver.solve(fn, local_history[:,-1:].clone(), timesteps)
+
+    def sample_frame_cached(self, model, guidance, timesteps, frames, kv_cache, local_history, ts_history):
+        """
+        Denoises the last frame of local_history in place. The context frames only go through
+        the model once (filling kv_cache), each diffusion step then runs on the last frame alone.
+        """
+        b = local_history.shape[0]
+        mouse_batch, btn_batch = (c[:,frames] for c in guidance.batched_controls)
+
+        kv_cache.reset(2 * b)
+        if local_history.shape[1] > 1:
+            ctx = local_history[:,:-1]
+            kv_cache.enable_cache_updates()
+            with self.timer.stage("kv_prefill"):
+                model(
+                    torch.cat([ctx, ctx], dim=0),
+                    torch.cat([ts_history[:,:-1], ts_history[:,:-1]], dim=0),
+                    mouse_batch[:,:-1], btn_batch[:,:-1],
+                    kv_cache = kv_cache
+                )
+        kv_cache.disable_cache_updates()
+
+        last_frame = slice(frames.stop - 1, frames.stop)
+        def fn(x, t):
+            ts = torch.full((b, 1), t, device=x.device, dtype=x.dtype)
+            with self.timer.stage("diffusion_step"):
+                return guidance(model, (x,), ts, t, last_frame, kv_cache = kv_cache)
+
+        local_history[:,-1:] = self.solver.solve(fn, local_history[:,-1:].clone(), timesteps)
+
 
 def test_window_cfg_sampler():
     sampler = WindowCFGSampler()
@@ -112,5 +262,148 @@ def test_window_cfg_sampler():
     x = sampler(model, dummy_batch, mouse, btn)
     print(x.shape)
 
+@torch.no_grad()
+def test_kv_cached_sampler_parity():
+    """
+    Cached sampling of a causal model should match the uncached sampler, and be faster
+    """
+    import time
+    from ..configs import TransformerConfig
+    from ..models.gamerft import GameRFTCore
+
+    config = TransformerConfig(
+        n_layers = 3, n_heads = 4, d_model = 128,
+        channels = 16, sample_size = 2, tokens_per_frame = 4,
+        n_buttons = 11, n_frames = 16, causal = True
+    )
+    model = GameRFTCore(config).eval()
+
+    history = torch.randn(2, 20, config.channels, 2, 2)
+    mouse = torch.randn(2, 20, 2)
+    btn = (torch.rand(2, 20, 11) > 0.5).float()
+
+    out = {}
+    for use_kv_cache in [False, True]:
+        sampler = WindowCFGSampler(
+            n_steps = 8, window_length = config.n_frames, num_frames = 4,
+            only_return_generated = True, use_kv_cache = use_kv_cache
+        )
+        torch.manual_seed(0)
+        start = time.perf_counter()
+        out[use_kv_cache] = sampler(model, history, mouse, btn)[0]
+        print(f"use_kv_cache={use_kv_cache}: {(time.perf_counter() - start) / 4 * 1000:.1f}ms/frame")
+
+    err = (out[True] - out[False]).abs().max().item()
+    assert err < 1.0e-3, f"Cached sampler differs from uncached by {err}"
+    print("KV cached sampler parity OK")
+
+def _tiny_causal_model(n_frames = 16):
+    from ..configs import TransformerConfig
+    from ..models.gamerft import GameRFTCore
+
+    config = TransformerConfig(
+        n_layers = 3, n_heads = 4, d_model = 128,
+        channels = 16, sample_size = 2, tokens_per_frame = 4,
+        n_buttons = 11, n_frames = n_frames, causal = True
+    )
+    return GameRFTCore(config).eval()
+
+@torch.no_grad()
+def test_stream_controls():
+    """
+    Streaming with controls sent in between frames should match __call__ given the same controls upfront
+    """
+    model = _tiny_causal_model()
+    W, num_frames = model.config.n_frames, 4
+    history = torch.randn(2, W, 16, 2, 2)
+    mouse = torch.randn(2, W + num_frames, 2)
+    btn = (torch.rand(2, W + num_frames, 11) > 0.5).float()
+
+    sampler = WindowCFGSampler(n_steps = 4, window_length = W, num_frames = num_frames, only_return_generated = True)
+    torch.manual_seed(0)
+    expected = sampler(model, history, mouse, btn)[0]
+
+    # Only the first frame's controls are known upfront, the rest arrive while streaming
+    torch.manual_seed(0)
+    unknown = lambda c: torch.cat([c[:,:W], torch.zeros_like(c[:,W:])], dim = 1)
+    frames = sampler.stream(model, history, unknown(mouse), unknown(btn), num_frames)
+    streamed = [next(frames)]
+    for i in range(1, num_frames):
+        streamed.append(frames.send((mouse[:,W+i-1], btn[:,W+i-1])))
+
+    err = (torch.cat(streamed, dim = 1) - expected).abs().max().item()
+    assert err == 0, f"Streamed frames differ from __call__ by {err}"
+    print("Stream controls OK")
+
+@torch.no_grad()
+def bench_stream(num_frames = 8):
+    """
+    Time to first frame of stream() against waiting for __call__ to return
+    """
+    import time
+
+    model = _tiny_causal_model()
+    W = model.config.n_frames
+    history = torch.randn(1, W, 16, 2, 2)
+    mouse = torch.randn(1, W, 2)
+    btn = (torch.rand(1, W, 11) > 0.5).float()
+    sampler = WindowCFGSampler(n_steps = 8, window_length = W, num_frames = num_frames, use_kv_cache = True)
+
+    start = time.perf_counter()
+    sampler(model, history, mouse, btn)
+    full = time.perf_counter() - start
+
+    start = time.perf_counter()
+    frames = sampler.stream(model, history, mouse, btn)
+    next(frames)
+    first = time.perf_counter() - start
+    for _ in frames:
+        pass
+
+    print(f"{num_frames} frames: __call__ returns after {full*1000:.1f}ms, stream's first frame after {first*1000:.1f}ms")
+
+@torch.no_grad()
+def bench_rolling_window(window_length = 60, frame_shape = (128, 4, 4), rollout_lengths = (250, 1000, 4000)):
+    """
+    History bookkeeping per frame: growing clean_history with cat + clone-and-slice (old)
+    against the rolling window and a preallocated output. The model is left out.
+    """
+    import time
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    history = torch.randn(1, window_length, *frame_shape, device = device)
+    frame = torch.randn(1, 1, *frame_shape, device = device)
+
+    def sync():
+        if device == 'cuda':
+            torch.cuda.synchronize()
+
+    def old(num_frames):
+        clean_history = history.clone()
+        for _ in range(num_frames):
+            clean_history.clone()[:,-window_length:]
+            clean_history = torch.cat([clean_history, frame], dim = 1)
+        return clean_history
+
+    def new(num_frames):
+        window = RollingWindow(history, window_length)
+        x = alloc_output(history, num_frames, 'cpu')
+        for i in range(num_frames):
+            window.view()
+            window.append(frame)
+            x[:,i:i+1].copy_(frame, non_blocking = x.is_pinned())
+        sync()
+        return x
+
+    print(f"window {window_length}, frames {list(frame_shape)}, {device}")
+    for num_frames in rollout_lengths:
+        for name, fn in [("cat", old), ("rolling", new)]:
+            sync()
+            start = time.perf_counter()
+            fn(num_frames)
+            sync()
+            per_frame = (time.perf_counter() - start) / num_frames
+            print(f"  {num_frames:6d} frames  {name:<8} {per_frame*1e6:9.1f}us/frame")
+
 if __name__ == "__main__":
     test_window_cfg_sampler()
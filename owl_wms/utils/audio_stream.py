@@ -0,0 +1,90 @@
+"""
+Streaming audio decode: decode only the newest audio latent and the left context the
+decoder's receptive field needs, instead of the whole window, for every new frame.
+"""
+
+import time
+
+import torch
+
+def decode_last_frame(audio_decode_fn, audio_window, left_context, samples_per_frame):
+    """
+    Samples of the last latent in audio_window.
+
+    :param audio_decode_fn: [b,n,c] latents -> [b,n*samples_per_frame,2] (see make_batched_audio_decode_fn)
+    :param audio_window: [b,n,c] latents ending with the new frame
+    :param left_context: Latents before the new one to decode with, None for the whole window
+    :return: [b,samples_per_frame,2]
+    """
+    if left_context is not None:
+        audio_window = audio_window[:,-(left_context + 1):]
+    return audio_decode_fn(audio_window)[:,-samples_per_frame:]
+
+@torch.no_grad()
+def find_left_context(audio_decode_fn, audio_window, samples_per_frame, tolerance = 1.0e-3):
+    """
+    Smallest left context whose last frame matches decoding the whole window,
+    within tolerance (max abs error relative to the max abs sample).
+
+    :return: (left_context, error)
+    """
+    ref = decode_last_frame(audio_decode_fn, audio_window, None, samples_per_frame).float()
+    scale = ref.abs().max().clamp(min = 1.0e-8)
+    for left_context in range(audio_window.shape[1]):
+        out = decode_last_frame(audio_decode_fn, audio_window, left_context, samples_per_frame).float()
+        err = ((out - ref).abs().max() / scale).item()
+        if err <= tolerance:
+            return left_context, err
+    return audio_window.shape[1] - 1, 0.
+
+def _toy_audio_decoder(channels = 64, samples_per_frame = 735, n_convs = 3):
+    # Stands in for the audio VAE decoder: convolutions over latents (receptive field of n_convs latents
+    # each side), upsampling to samples and a conv over samples. Same [b,n,c] -> [b,n*f,2] as the bridge.
+    torch.manual_seed(0)
+    net = torch.nn.Sequential(
+        *[torch.nn.Sequential(torch.nn.Conv1d(channels, channels, 3, padding = 1), torch.nn.SiLU()) for _ in range(n_convs)],
+        torch.nn.Upsample(scale_factor = samples_per_frame),
+        torch.nn.Conv1d(channels, 2, 7, padding = 3)
+    ).eval()
+
+    def decode(x):
+        return net(x.transpose(1, 2)).transpose(1, 2)
+    return decode
+
+@torch.no_grad()
+def test_streaming_audio_decode():
+    decode = _toy_audio_decoder()
+    window = torch.randn(1, 60, 64)
+    left_context, err = find_left_context(decode, window, 735)
+    # 3 convs see 3 latents back, the zero padding of a shorter window must stay out of the last frame
+    assert left_context <= 4, f"Left context {left_context} larger than the receptive field"
+
+    # The context found on one window holds on others
+    for _ in range(4):
+        window = torch.randn(1, 60, 64)
+        ref = decode_last_frame(decode, window, None, 735)
+        out = decode_last_frame(decode, window, left_context, 735)
+        assert (out - ref).abs().max() <= 1.0e-3 * ref.abs().max(), "Streaming decode doesn't match the full window"
+    print(f"Streaming audio decode OK (left context {left_context})")
+
+@torch.no_grad()
+def bench_streaming_audio_decode(window_length = 60, n_iters = 20):
+    """
+    Per frame audio decode cost, whole window against new latent plus left context
+    """
+    decode = _toy_audio_decoder()
+    window = torch.randn(1, window_length, 64)
+    left_context, err = find_left_context(decode, window, 735)
+
+    for name, ctx in [("full window", None), (f"left context {left_context}", left_context)]:
+        decode_last_frame(decode, window, ctx, 735)
+        start = time.perf_counter()
+        for _ in range(n_iters):
+            decode_last_frame(decode, window, ctx, 735)
+        per_frame = (time.perf_counter() - start) / n_iters
+        print(f"  {name:<16} {per_frame*1000:7.2f}ms/frame")
+    print(f"  error vs full window {err:.2e}")
+
+if __name__ == "__main__":
+    test_streaming_audio_decode()
+    bench_streaming_audio_decode()
@@ -0,0 +1,235 @@
+"""
+Background VAE decoding, so decoding frame t overlaps the diffusion of frame t+1.
+"""
+
+import queue
+import threading
+import time
+
+import torch
+
+class DecodeWorker:
+    """
+    Runs decode_fn on worker threads, each with its own CUDA stream when on GPU.
+    Latents go in through a bounded queue (submit blocks when it's full) and outputs
+    come back in submission order.
+
+    :param decode_fn: Called as decode_fn(*latents) on a worker thread
+    :param max_pending: Most latents queued or being decoded at once
+    :param n_workers: Worker threads. Keep 1 on GPU, more help on CPU where ops release the GIL.
+    """
+    def __init__(self, decode_fn, max_pending = 2, n_workers = 1):
+        self.decode_fn = decode_fn
+        self.inputs = queue.Queue(maxsize = max_pending)
+        self.outputs = {}
+        self.cond = threading.Condition()
+
+        self.n_submitted = 0
+        self.n_returned = 0
+        self.decode_time = 0. # Spent decoding, on the workers
+        self.wait_time = 0. # Spent by the caller blocked on submit() or get()
+        self.first_submit = None # perf_counter() of the first submit and of the last output returned
+        self.last_return = None
+        self.error = None
+
+        self.workers = [threading.Thread(target = self._work, daemon = True) for _ in range(n_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    @torch.no_grad() # Grad mode is per thread, the caller's no_grad doesn't reach the workers
+    def _work(self):
+        stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        while True:
+            item = self.inputs.get()
+            if item is None:
+                return
+            ticket, latents, event = item
+            start = time.perf_counter()
+            try:
+                if event is not None:
+                    with torch.cuda.stream(stream):
+                        # Latents were made on the caller's stream
+                        stream.wait_event(event)
+                        for x in latents:
+                            if torch.is_tensor(x) and x.is_cuda:
+                                x.record_stream(stream)
+                        out = self.decode_fn(*latents)
+                    stream.synchronize()
+                else:
+                    out = self.decode_fn(*latents)
+            except Exception as e:
+                out, self.error = None, e
+            with self.cond:
+                self.decode_time += time.perf_counter() - start
+                self.outputs[ticket] = out
+                self.cond.notify_all()
+
+    @property
+    def n_pending(self):
+        return self.n_submitted - self.n_returned
+
+    def submit(self, *latents):
+        """
+        Queue latents for decoding, they must not be modified afterwards.
+        :return: Ticket, outputs are returned in ticket order
+        """
+        event = None
+        if torch.cuda.is_available() and any(torch.is_tensor(x) and x.is_cuda for x in latents):
+            event = torch.cuda.Event()
+            event.record()
+
+        start = time.perf_counter()
+        if self.first_submit is None:
+            self.first_submit = start
+        ticket = self.n_submitted
+        self.inputs.put((ticket, latents, event))
+        self.wait_time += time.perf_counter() - start
+        self.n_submitted += 1
+        return ticket
+
+    def get(self, timeout = None):
+        """
+        Output of the oldest submission not returned yet, blocks until it's decoded
+        """
+        assert self.n_pending > 0, "Nothing submitted"
+        ticket = self.n_returned
+        start = time.perf_counter()
+        with self.cond:
+            if not self.cond.wait_for(lambda: ticket in self.outputs or self.error is not None, timeout):
+                raise TimeoutError(f"Decode {ticket} not done after {timeout}s")
+            if self.error is not None:
+                raise self.error
+            out = self.outputs.pop(ticket)
+        self.last_return = time.perf_counter()
+        self.wait_time += self.last_return - start
+        self.n_returned += 1
+        return out
+
+    def stats(self):
+        """
+        wall_ms is the caller's wall time per frame from the first submit to the last output,
+        the number to compare against a serial run. hidden (the fraction of decode time the
+        caller didn't spend waiting) is only a diagnostic: on CPU the workers compete with the
+        caller for cores, so decode can be mostly hidden while the frames still come out slower.
+        """
+        hidden = 0. if self.decode_time == 0 else max(0., 1. - self.wait_time / self.decode_time)
+        wall_time = 0. if self.last_return is None else self.last_return - self.first_submit
+        return {
+            "frames" : self.n_returned,
+            "wall_ms" : 1000 * wall_time / max(self.n_returned, 1),
+            "decode_ms" : 1000 * self.decode_time / max(self.n_returned, 1),
+            "wait_ms" : 1000 * self.wait_time / max(self.n_returned, 1),
+            "hidden" : hidden
+        }
+
+    def close(self):
+        for _ in self.workers:
+            self.inputs.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def pipelined(latents, decode_fn, max_lag = 1, max_pending = 2, n_workers = 1, worker = None):
+    """
+    Decode the frames of a latent generator (i.e. sampler.stream(...)) on a DecodeWorker.
+    Output t is yielded after latent t+max_lag is generated, so decode of t overlaps diffusion of t+1.
+    Tuples are unpacked into decode_fn's arguments.
+
+    :param worker: Existing DecodeWorker to use (kept open, check its stats()), otherwise one is made
+    """
+    own_worker = worker is None
+    if own_worker:
+        worker = DecodeWorker(decode_fn, max(max_pending, max_lag + 1), n_workers)
+    try:
+        for x in latents:
+            worker.submit(*(x if isinstance(x, tuple) else (x,)))
+            while worker.n_pending > max_lag:
+                yield worker.get()
+        while worker.n_pending > 0:
+            yield worker.get()
+    finally:
+        if own_worker:
+            worker.close()
+
+def _toy_decoder():
+    # Stands in for a VAE decoder, a few convolutions and an upsample
+    torch.manual_seed(0)
+    return torch.nn.Sequential(
+        torch.nn.Conv2d(16, 128, 3, padding = 1),
+        torch.nn.Upsample(scale_factor = 8),
+        torch.nn.Conv2d(128, 64, 3, padding = 1),
+        torch.nn.Conv2d(64, 3, 3, padding = 1)
+    ).eval()
+
+@torch.no_grad()
+def test_decode_worker(n_frames = 8):
+    decoder = _toy_decoder()
+    latents = [torch.randn(1, 16, 4, 4) for _ in range(n_frames)]
+    expected = [decoder(x) for x in latents]
+
+    for n_workers in [1, 3]:
+        out = list(pipelined(iter(latents), decoder, max_lag = 2, n_workers = n_workers))
+        assert len(out) == n_frames
+        for a, b in zip(out, expected):
+            assert torch.equal(a, b), "Outputs out of order or wrong"
+            assert not a.requires_grad, "Decoded with grad enabled"
+
+    def fails(x):
+        raise ValueError("decode failed")
+    try:
+        list(pipelined(iter(latents), fails))
+        raise AssertionError("Worker error wasn't raised")
+    except ValueError:
+        pass
+    print("Decode worker OK")
+
+@torch.no_grad()
+def bench_decode_worker(n_frames = 16):
+    """
+    Serial diffuse-then-decode against pipelined decoding with a toy decoder and denoiser,
+    wall time per frame of both measured in the same run
+    """
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    decoder = _toy_decoder().to(device)
+    denoiser = torch.nn.Sequential(*[torch.nn.Linear(512, 512) for _ in range(8)]).to(device)
+
+    def frames():
+        for _ in range(n_frames):
+            x = torch.randn(64, 512, device = device)
+            for _ in range(8):
+                x = denoiser(x)
+            yield x[:1].view(1, 16, 4, 8)[...,:4].contiguous()
+
+    def sync():
+        if device == 'cuda':
+            torch.cuda.synchronize()
+
+    list(pipelined(frames(), decoder)) # warmup
+
+    sync()
+    start = time.perf_counter()
+    for x in frames():
+        decoder(x)
+    sync()
+    serial = time.perf_counter() - start
+
+    worker = DecodeWorker(decoder)
+    start = time.perf_counter()
+    for _ in pipelined(frames(), decoder, worker = worker):
+        pass
+    sync()
+    overlapped = time.perf_counter() - start
+    stats = worker.stats()
+    worker.close()
+
+    print(f"{device}: serial {serial / n_frames * 1000:.1f}ms/frame, pipelined {overlapped / n_frames * 1000:.1f}ms/frame ({serial / overlapped:.2f}x)")
+    print(f"  diagnostics: decode {stats['decode_ms']:.1f}ms/frame, caller waited {stats['wait_ms']:.1f}ms/frame, {100 * stats['hidden']:.0f}% of decode hidden")
+
+if __name__ == "__main__":
+    test_decode_worker()
+    bench_decode_worker()
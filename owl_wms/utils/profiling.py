@@ -0,0 +1,168 @@
+"""
+Per stage wall time for interactive inference: rolling percentiles and deadline misses.
+"""
+
+import contextlib
+import json
+import time
+from collections import deque
+
+import numpy as np
+import torch
+
+_NULL_STAGE = contextlib.nullcontext()
+
+class _Stage:
+    __slots__ = ("timer", "name", "start")
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        if self.timer.sync_cuda:
+            torch.cuda.synchronize()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        if self.timer.sync_cuda:
+            torch.cuda.synchronize()
+        self.timer.record(self.name, time.perf_counter_ns() - self.start)
+
+class StageTimer:
+    """
+    Records wall time of named stages (with timer.stage("decode_video"): ...) and of whole
+    frames (with timer.frame(): ...), keeping the last `window` samples of each.
+
+    Times are host side. Without sync_cuda, GPU stages only measure the launches and the
+    time shows up wherever the host next waits (i.e. the decode or the frame).
+
+    :param deadline_ms: Frame budget, longer frames count as missed. Default is 30fps.
+    :param window: Samples per stage the percentiles are computed over
+    :param sync_cuda: Synchronize CUDA around every stage for accurate (but slower) GPU times
+    :param enabled: When False every stage is a no-op
+    """
+    def __init__(self, deadline_ms = 1000 / 30, window = 1000, sync_cuda = False, enabled = True):
+        self.deadline_ms = deadline_ms
+        self.window = window
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.samples = {} # name -> deque of ns
+        self.n_frames = 0
+        self.deadline_misses = 0
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def frame(self):
+        return self.stage("frame")
+
+    def record(self, name, duration_ns):
+        if name not in self.samples:
+            self.samples[name] = deque(maxlen = self.window)
+        self.samples[name].append(duration_ns)
+
+        if name == "frame":
+            self.n_frames += 1
+            if duration_ns > self.deadline_ms * 1.0e6:
+                self.deadline_misses += 1
+
+    def last_ms(self, name = "frame"):
+        samples = self.samples.get(name)
+        return samples[-1] / 1.0e6 if samples else None
+
+    def summary(self):
+        """
+        :return: {"stages" : {name : {count, mean_ms, p50_ms, p95_ms, p99_ms, max_ms}}, frames, deadline_ms, deadline_misses, miss_rate}
+            Percentiles are over the last `window` samples, frames and misses since reset()
+        """
+        stages = {}
+        for name, samples in self.samples.items():
+            ms = np.array(samples, dtype = np.float64) / 1.0e6
+            p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+            stages[name] = {
+                "count" : len(ms),
+                "mean_ms" : float(ms.mean()),
+                "p50_ms" : float(p50),
+                "p95_ms" : float(p95),
+                "p99_ms" : float(p99),
+                "max_ms" : float(ms.max())
+            }
+        return {
+            "stages" : stages,
+            "frames" : self.n_frames,
+            "deadline_ms" : self.deadline_ms,
+            "deadline_misses" : self.deadline_misses,
+            "miss_rate" : self.deadline_misses / max(self.n_frames, 1)
+        }
+
+    def write_jsonl(self, path, **extra):
+        """
+        Appends the summary (plus a timestamp and any extra fields) as one line of path
+        """
+        line = {"time" : time.time(), **extra, **self.summary()}
+        with open(path, "a") as f:
+            f.write(json.dumps(line) + "\n")
+
+    def format(self):
+        summary = self.summary()
+        lines = [f"{summary['frames']} frames, {summary['deadline_misses']} over {summary['deadline_ms']:.1f}ms"]
+        for name, s in summary["stages"].items():
+            lines.append(f"  {name:<16} x{s['count']:<6d} p50 {s['p50_ms']:8.3f}ms  p95 {s['p95_ms']:8.3f}ms  p99 {s['p99_ms']:8.3f}ms")
+        return "\n".join(lines)
+
+def test_stage_timer():
+    import os
+    import tempfile
+
+    timer = StageTimer(deadline_ms = 15, window = 8)
+    for i in range(10):
+        with timer.frame():
+            with timer.stage("a"):
+                time.sleep(0.002)
+            for _ in range(2):
+                with timer.stage("b"):
+                    pass
+            if i % 5 == 0:
+                time.sleep(0.02)
+
+    summary = timer.summary()
+    assert summary["frames"] == 10 and summary["deadline_misses"] == 2, summary
+    assert summary["stages"]["a"]["count"] == 8 and summary["stages"]["b"]["count"] == 8, "window not applied"
+    assert summary["stages"]["a"]["p50_ms"] >= 2.0
+
+    disabled = StageTimer(enabled = False)
+    with disabled.frame(), disabled.stage("a"):
+        pass
+    assert disabled.summary()["frames"] == 0
+
+    path = os.path.join(tempfile.mkdtemp(), "timing.jsonl")
+    timer.write_jsonl(path, run = "test")
+    timer.write_jsonl(path, run = "test")
+    with open(path) as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == 2 and lines[0]["run"] == "test" and "frame" in lines[0]["stages"]
+    print(timer.format())
+    print("Stage timer OK")
+
+def bench_stage_timer(n = 100000):
+    """
+    Overhead of a stage, enabled and disabled
+    """
+    for enabled in [True, False]:
+        timer = StageTimer(enabled = enabled)
+        start = time.perf_counter_ns()
+        for _ in range(n):
+            with timer.stage("x"):
+                pass
+        print(f"enabled={enabled}: {(time.perf_counter_ns() - start) / n:.0f}ns/stage")
+
+if __name__ == "__main__":
+    test_stage_timer()
+    bench_stage_timer()